@@ -17,13 +17,23 @@
 # You should have received a copy of the GNU General Public License
 # along with Linaro Image Tools.  If not, see <http://www.gnu.org/licenses/>.
 
+import atexit
+import json
 import os
 import subprocess
+import sys
+import threading
+import time
 
 
 DEFAULT_PATH = '/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin'
 CHROOT_ARGS = ['chroot']
 SUDO_ARGS = ['sudo', '-E']
+# How often, in seconds, gather() checks which of its commands finished.
+GATHER_POLL_INTERVAL = 0.05
+
+# The CommandTracer recording the commands run, if tracing is enabled.
+_tracer = None
 
 
 def sanitize_path(env):
@@ -63,6 +73,69 @@ def run(args, as_root=False, chroot=None, stdin=None, stdout=None,
     return Popen(args, stdin=stdin, stdout=stdout, stderr=stderr, cwd=cwd)
 
 
+def run_module(module, args=(), **kwargs):
+    """Run the given module of this package as a script, like python -m.
+
+    It's run with the same Python interpreter, from the directory containing
+    the linaro_image_tools package, so that it's found when running from a
+    checkout too.  The keyword arguments are passed to run().
+
+    Return a Popen instance.
+    """
+    package_parent = os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__)))
+    return run([sys.executable, '-m', module] + list(args),
+               cwd=package_parent, **kwargs)
+
+
+def gather(commands, max_concurrency=1, outputs=None, **kwargs):
+    """Run the given commands, at most max_concurrency of them at a time.
+
+    Unlike run(), this waits for all the commands to finish.  They're all run
+    even if some of them fail; once they're finished,
+    SubcommandNonZeroReturnValue is raised for the first one (in the order
+    given) which failed.
+
+    :param commands: A list of commands, each a list or tuple like the args
+        of run().
+    :param max_concurrency: How many of the commands may run at the same
+        time, or None for no limit.
+    :param outputs: A list of files, one per command, to which the stdout
+        and stderr of each command are written, or None.
+    :param kwargs: Passed to run() for each of the commands.
+    :return: The list of the return codes of the commands, in order.
+    """
+    procs = [None] * len(commands)
+    returncodes = [None] * len(commands)
+    pending = range(len(commands))
+    running = []
+    try:
+        while pending or running:
+            while pending and (max_concurrency is None or
+                               len(running) < max_concurrency):
+                index = pending.pop(0)
+                if outputs is not None:
+                    kwargs.update(stdout=outputs[index], stderr=outputs[index])
+                procs[index] = run(commands[index], **kwargs)
+                # Failures are only raised once all the commands finished.
+                procs[index].except_on_cmd_fail = False
+                running.append(index)
+            finished = [i for i in running if procs[i].poll() is not None]
+            if not finished:
+                time.sleep(GATHER_POLL_INTERVAL)
+            for index in finished:
+                running.remove(index)
+                returncodes[index] = procs[index].wait()
+    finally:
+        # Don't leave anything running behind if starting a command failed.
+        for index in running:
+            returncodes[index] = procs[index].wait()
+    for proc, returncode in zip(procs, returncodes):
+        if returncode != 0:
+            raise SubcommandNonZeroReturnValue(proc._my_args, returncode)
+    return returncodes
+
+
 class Popen(subprocess.Popen):
     """A version of Popen which raises an error on non-zero returncode.
 
@@ -80,12 +153,18 @@ class Popen(subprocess.Popen):
         sanitize_path(os.environ)
         # and for subcommands
         sanitize_path(env)
+        self._trace_record = None
+        if _tracer is not None:
+            self._trace_record = _tracer.start(args)
         super(Popen, self).__init__(args, env=env, **kwargs)
 
     def communicate(self, input=None):
         self.except_on_cmd_fail = False
         stdout, stderr = super(Popen, self).communicate(input)
         self.except_on_cmd_fail = True
+        if self._trace_record is not None:
+            _tracer.finish(self._trace_record, self.returncode,
+                           len(stdout or '') + len(stderr or ''))
 
         if self.returncode != 0:
             raise SubcommandNonZeroReturnValue(self._my_args,
@@ -96,6 +175,8 @@ class Popen(subprocess.Popen):
 
     def wait(self):
         returncode = super(Popen, self).wait()
+        if self._trace_record is not None:
+            _tracer.finish(self._trace_record, returncode)
         if returncode != 0 and self.except_on_cmd_fail:
             raise SubcommandNonZeroReturnValue(self._my_args, returncode)
         return returncode
@@ -119,3 +200,115 @@ class SubcommandNonZeroReturnValue(Exception):
             message += '\nstderr was\n{0}'.format(self.stderr)
 
         return message
+
+
+class CommandTracer(object):
+    """Records the commands run through Popen and how long they took.
+
+    :param trace_file: Where to write the raw trace, as one JSON object per
+        command, or None.
+    :param top: How many of the slowest commands to list in the summary.
+    """
+
+    def __init__(self, trace_file=None, top=10):
+        self.trace_file = trace_file
+        self.top = top
+        self.records = []
+        self._lock = threading.Lock()
+
+    def start(self, args):
+        """Record the start of the given command; return its record."""
+        if isinstance(args, basestring):
+            args = [args]
+        argv = list(args)
+        sudo = argv[:len(SUDO_ARGS)] == SUDO_ARGS
+        if sudo:
+            argv = argv[len(SUDO_ARGS):]
+        chroot = None
+        if argv[:len(CHROOT_ARGS)] == CHROOT_ARGS and len(argv) > 1:
+            chroot = argv[len(CHROOT_ARGS)]
+            argv = argv[len(CHROOT_ARGS) + 1:]
+        record = {
+            'argv': list(args),
+            'binary': os.path.basename(argv[0]) if argv else None,
+            'sudo': sudo,
+            'chroot': chroot,
+            'start': time.time(),
+            'end': None,
+            'returncode': None,
+            'output_size': None,
+        }
+        with self._lock:
+            self.records.append(record)
+        return record
+
+    def finish(self, record, returncode, output_size=None):
+        """Record the end of the command with the given record.
+
+        :param output_size: The number of bytes the command wrote to its
+            stdout and stderr, if they were captured.
+        """
+        if record['end'] is None:
+            record['end'] = time.time()
+            record['returncode'] = returncode
+        if output_size is not None:
+            record['output_size'] = output_size
+
+    def _duration(self, record):
+        if record['end'] is None:
+            return None
+        return record['end'] - record['start']
+
+    def summary(self):
+        """Return the slowest commands and totals per binary, as text."""
+        finished = [r for r in self.records if r['end'] is not None]
+        slowest = sorted(finished, key=self._duration, reverse=True)
+        lines = ['%d commands run, %d not waited for' % (
+            len(self.records), len(self.records) - len(finished))]
+        lines.append('Slowest commands:')
+        for record in slowest[:self.top]:
+            lines.append('  %8.2fs  %s' % (
+                self._duration(record), ' '.join(record['argv'])))
+        totals = {}
+        for record in finished:
+            count, seconds = totals.get(record['binary'], (0, 0))
+            totals[record['binary']] = (
+                count + 1, seconds + self._duration(record))
+        lines.append('Totals per command:')
+        for binary, (count, seconds) in sorted(
+                totals.items(), key=lambda item: item[1][1], reverse=True):
+            lines.append('  %8.2fs  %5d  %s' % (seconds, count, binary))
+        return '\n'.join(lines)
+
+    def write_trace(self):
+        with open(self.trace_file, 'w') as fd:
+            for record in self.records:
+                record = dict(record, duration=self._duration(record))
+                fd.write(json.dumps(record, sort_keys=True) + '\n')
+
+    def report(self, stream=None):
+        """Write the raw trace, if asked to, and print the summary."""
+        if self.trace_file is not None:
+            self.write_trace()
+        if stream is None:
+            stream = sys.stderr
+        stream.write(self.summary() + '\n')
+
+
+def enable_tracing(trace_file=None, top=10):
+    """Trace all the commands run from now on.
+
+    When the program exits, the summary is printed to stderr and the raw
+    trace written to trace_file.
+
+    :return: The CommandTracer doing the tracing.
+    """
+    global _tracer
+    _tracer = CommandTracer(trace_file, top)
+    atexit.register(_tracer.report)
+    return _tracer
+
+
+def disable_tracing():
+    global _tracer
+    _tracer = None
@@ -30,7 +30,7 @@ from glob import iglob
 from debian.debfile import DebFile
 from debian.arfile import ArError
 
-from linaro_image_tools import cmd_runner
+from linaro_image_tools import cmd_runner, profiling
 
 from linaro_image_tools.hwpack.config import Config
 from linaro_image_tools.hwpack.hardwarepack import HardwarePack, Metadata
@@ -270,10 +270,11 @@ class HardwarePackBuilder(object):
                             self.packages,
                             download_content=self.config.include_debs)
 
-                        if self.format.format_as_string == '3.0':
-                            self.extract_files()
-                        else:
-                            self._old_format_extract_files()
+                        with profiling.stage('extract'):
+                            if self.format.format_as_string == '3.0':
+                                self.extract_files()
+                            else:
+                                self._old_format_extract_files()
 
                         self._add_packages_to_hwpack(local_packages)
 
@@ -286,12 +287,14 @@ class HardwarePackBuilder(object):
                             manifest_name = os.path.splitext(manifest_name)[0]
                         manifest_name += '.manifest.txt'
 
-                        self._write_hwpack_and_manifest(out_name,
-                                                        manifest_name)
+                        with profiling.stage('tar write'):
+                            self._write_hwpack_and_manifest(out_name,
+                                                            manifest_name)
 
                         cache_dir = fetcher.cache.tempdir
-                        self._extract_build_info(cache_dir, out_name,
-                                                 manifest_name)
+                        with profiling.stage('extract build-info'):
+                            self._extract_build_info(cache_dir, out_name,
+                                                     manifest_name)
 
     def _write_hwpack_and_manifest(self, out_name, manifest_name):
         """Write the real hwpack file and its manifest file.
@@ -24,7 +24,6 @@ from operator import attrgetter
 import os
 import re
 import string
-import yaml
 
 from linaro_image_tools.hwpack.hardwarepack_format import (
     HardwarePackFormatV1,
@@ -175,6 +174,7 @@ class Config(object):
             # obfuscated_e being set indicates that something went wrong.
             # It could be that the input is in fact YAML. Try the YAML
             # parser.
+            import yaml
             try:
                 fp.seek(0)
                 self.parser = yaml.safe_load(fp)
@@ -27,7 +27,6 @@ import tarfile
 import tempfile
 
 from linaro_image_tools.hwpack.config import Config
-from linaro_image_tools.hwpack.builder import PackageUnpacker
 from linaro_image_tools.utils import DEFAULT_LOGGER_NAME
 
 
@@ -278,6 +277,9 @@ class HardwarepackHandler(object):
         tar_file.extractall(tempdir)
         package_path = os.path.join(tempdir, package)
 
+        # The builder needs python-apt, so it's only imported once a file
+        # has to be extracted from one of the packages.
+        from linaro_image_tools.hwpack.builder import PackageUnpacker
         with PackageUnpacker() as self.package_unpacker:
             extracted_file = self.package_unpacker.get_file(package_path,
                                                             file_path)
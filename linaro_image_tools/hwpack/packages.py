@@ -36,7 +36,7 @@ import apt_pkg
 
 from debian.debfile import DebFile
 
-from linaro_image_tools import cmd_runner
+from linaro_image_tools import cmd_runner, profiling
 
 
 logger = logging.getLogger(__name__)
@@ -552,12 +552,14 @@ class IsolatedAptCache(object):
         apt_pkg.config.set("Dir::bin::dpkg", "/bin/false")
         self.cache = Cache(rootdir=self.tempdir, memonly=True)
         logger.debug("Updating apt cache")
-        try:
-            self.cache.update()
-        except FetchFailedException, e:
-            obfuscated_e = re.sub(r"([^ ]https://).+?(@)", r"\1***\2", str(e))
-            raise FetchFailedException(obfuscated_e)
-        self.cache.open()
+        with profiling.stage('apt update'):
+            try:
+                self.cache.update()
+            except FetchFailedException, e:
+                obfuscated_e = re.sub(
+                    r"([^ ]https://).+?(@)", r"\1***\2", str(e))
+                raise FetchFailedException(obfuscated_e)
+            self.cache.open()
         return self
 
     def set_installed_packages(self, packages, reopen=True):
@@ -730,18 +732,19 @@ class PackageFetcher(object):
                     ", ".join([p.name for p in self.cache.cache
                                if p.is_inst_broken]))
 
-        for package in packages:
-            try:
-                self.cache.cache[package].mark_install(auto_fix=True)
-            except SystemError:
-                # Either we raise a DependencyNotSatisfied error
-                # if some packages are broken, or we raise the original
-                # error if there was another cause
+        with profiling.stage('resolve'):
+            for package in packages:
+                try:
+                    self.cache.cache[package].mark_install(auto_fix=True)
+                except SystemError:
+                    # Either we raise a DependencyNotSatisfied error
+                    # if some packages are broken, or we raise the original
+                    # error if there was another cause
+                    check_no_broken_packages()
+                    raise
+                # Check that nothing was broken, even if mark_install didn't
+                # raise SystemError, just to make sure.
                 check_no_broken_packages()
-                raise
-            # Check that nothing was broken, even if mark_install didn't
-            # raise SystemError, just to make sure.
-            check_no_broken_packages()
         self._filter_ignored(fetched)
         if not download_content:
             self.cache.cache.clear()
@@ -773,7 +776,8 @@ class PackageFetcher(object):
             else:
                 logger.debug(" ... from %s" % acqfile.desc_uri)
         self.cache.cache.clear()
-        acq.run()
+        with profiling.stage('download'):
+            acq.run()
         for acqfile, result_package, destfile in acqfiles:
             if acqfile.status != acqfile.STAT_DONE:
                 raise FetchError(
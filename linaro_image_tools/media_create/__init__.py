@@ -22,7 +22,9 @@ import subprocess
 import os
 
 from linaro_image_tools import cmd_runner
+from linaro_image_tools.profiling import add_profiling_options
 from linaro_image_tools.media_create.boards import board_configs
+from linaro_image_tools.media_create.partitions import FORMAT_PROFILES
 from linaro_image_tools.media_create.android_boards import (
     android_board_configs)
 from linaro_image_tools.__version__ import __version__
@@ -78,6 +80,27 @@ def add_common_options(parser):
     parser.add_argument(
         '--extra-boot-args-file', dest='extra_boot_args_file',
         required=False, help=('File containing extra boot arguments.'))
+    parser.add_argument(
+        '--root-helper', dest='root_helper', action='store_true',
+        help=('Start a single helper process as root to copy, move and write '
+              'files owned by root, instead of running sudo for each of '
+              'them.'))
+    parser.add_argument(
+        '--mkfs-jobs', dest='mkfs_jobs', type=int, default=1,
+        help=('The number of partitions to format at the same time. Their '
+              'output is then printed once all of them are formatted.'))
+    parser.add_argument(
+        '--format-profile', dest='format_profile', default='default',
+        choices=FORMAT_PROFILES,
+        help=('The mkfs options to use: "fast-image" skips zeroing the inode '
+              'tables and discarding and uses a small journal, for image '
+              'files; '
+              '"sdcard" runs blkdiscard on each partition of a device '
+              'before formatting it. Default: default'))
+    parser.add_argument(
+        '--no-bmap', dest='should_create_bmap', action='store_false',
+        help=('Do not write a block map (IMAGE.bmap) next to the image '
+              'file; use with --image_file only.'))
     parser.add_argument("--debug", action="store_true")
 
 
@@ -140,6 +163,19 @@ def get_args_parser():
     parser.add_argument(
         '--hwpack-force-yes', action='store_true',
         help='Pass --force-yes to linaro-hwpack-install')
+    parser.add_argument(
+        '--host-hwpack-install', dest='host_hwpack_install',
+        action='store_true',
+        help=('Install the hwpacks whose packages have no maintainer scripts '
+              'from the host, rather than with linaro-hwpack-install under '
+              'qemu. The others are still installed with '
+              'linaro-hwpack-install.'))
+    parser.add_argument(
+        '--merge-hwpacks', dest='merge_hwpacks', action='store_true',
+        help=('Install all the hwpacks with a single run of '
+              'linaro-hwpack-install, which updates the apt package lists '
+              'and installs the packages of all of them at once, rather '
+              'than once per hwpack.'))
     parser.add_argument(
         '--image-size', '--image_size', default='3G',
         help=('The image size, specified in mega/giga bytes (e.g. 3000M or '
@@ -164,6 +200,62 @@ def get_args_parser():
         '--align-boot-part', dest='should_align_boot_part',
         action='store_true',
         help='Align boot partition too (might break older x-loaders).')
+    parser.add_argument(
+        '--direct-rootfs', dest='direct_rootfs', action='store_true',
+        help=('Create and mount the root partition first and unpack the '
+              'binary tarball and install the hwpacks straight into it, '
+              'instead of staging the rootfs in a temporary directory and '
+              'moving it onto the partition afterwards.'))
+    parser.add_argument(
+        '--build-fs-images', dest='build_fs_images', action='store_true',
+        help=('Use with --image_file only. Build the boot and root '
+              'filesystems as separate images straight from the rootfs '
+              'directory (mkfs -d/mcopy) and write them into the image file, '
+              'instead of formatting and mounting loop devices.'))
+    parser.add_argument(
+        '--build-in-ram', dest='build_in_ram', action='store_true',
+        help=('Use with --mmc only. Build the whole image in an image file '
+              'under --ram-dir and then write it to the device in large '
+              'sequential writes, skipping the unused parts of the image, '
+              'and verify it by reading it back.'))
+    parser.add_argument(
+        '--ram-dir', dest='ram_dir', default='/dev/shm',
+        help=('The directory, normally on a tmpfs, in which to build the '
+              'image when using --build-in-ram. It needs as much free space '
+              'as the device is big, though only the data actually written '
+              'to the image uses memory. Default: /dev/shm'))
+    parser.add_argument(
+        '--rootfs-cache', dest='rootfs_cache', metavar='DIR',
+        help=('Cache the rootfs, with the hwpacks installed, in the given '
+              'directory and reuse it on later runs with the same binary '
+              'tarball and hwpacks instead of unpacking and installing '
+              'them again.'))
+    parser.add_argument(
+        '--rootfs-cache-size', dest='rootfs_cache_size', default='20G',
+        help=('The maximum size of the rootfs cache, specified in mega/giga '
+              'bytes (e.g. 3000M or 3G); the least recently used rootfs '
+              'trees are removed once it is exceeded.'))
+    parser.add_argument(
+        '--rootfs-filter', dest='rootfs_filter', metavar='FILE',
+        help=('Leave the files matching the path-exclude=GLOB rules in FILE '
+              '(and not a later path-include=GLOB rule) out of the rootfs, '
+              'as dpkg does. The rules are also installed in '
+              '/etc/dpkg/dpkg.cfg.d for the packages installed later on.'))
+    parser.add_argument(
+        '--stage-jobs', dest='stage_jobs', type=int, default=1,
+        help=('The maximum number of independent stages (e.g. unpacking the '
+              'binary tarball and formatting the partitions) to run at the '
+              'same time. With more than 1, the media may be partitioned '
+              'before the rootfs is known to build. Default: 1, which runs '
+              'them one after the other.'))
+    parser.add_argument(
+        '--stage-limit', dest='stage_limits', action='append', default=[],
+        metavar='RESOURCE=N',
+        help=('Run at most N stages using the given resource at the same '
+              'time. The resources are "rootfs" (unpacking the binary '
+              'tarball and installing the hwpacks) and "media" '
+              '(partitioning and writing to the media). May be given '
+              'multiple times.'))
     parser.add_argument(
         '--nocheck-mmc', dest='nocheck_mmc',
         action='store_true',
@@ -175,6 +267,7 @@ def get_args_parser():
              "than one. If not specified, it will default to '%s'." %
              DEFAULT_BOOTLOADER)
 
+    add_profiling_options(parser)
     add_common_options(parser)
     return parser
 
@@ -223,3 +316,24 @@ def get_android_args_parser():
         help='Align boot partition too (might break older x-loaders).')
     add_common_options(parser)
     return parser
+
+
+def get_flash_args_parser():
+    """Get the ArgumentParser for the arguments given on the command line."""
+    parser = argparse.ArgumentParser(version='%(prog)s ' + get_version())
+    parser.add_argument(
+        '--image-file', '--image_file', dest='image_file', required=True,
+        help='The image file to write, e.g. one built by linaro-media-create.')
+    parser.add_argument(
+        '--mmc', dest='devices', action='append', required=True,
+        help=('A storage device to write the image to; this parameter can be '
+              'defined multiple times, and the image is written to all the '
+              'devices at the same time.'))
+    parser.add_argument(
+        '--nocheck-mmc', dest='nocheck_mmc', action='store_true',
+        help=("Don't ask for confirmation before writing to the devices."))
+    parser.add_argument(
+        '--no-verify', dest='verify', action='store_false',
+        help=("Don't read back what was written to compare it to the image."))
+    parser.add_argument("--debug", action="store_true")
+    return parser
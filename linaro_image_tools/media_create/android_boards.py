@@ -28,7 +28,6 @@ and add the board to 'android_board_configs' at the end of this file.
 """
 
 import os
-import yaml
 import logging
 
 from linaro_image_tools import cmd_runner
@@ -132,6 +131,7 @@ class AndroidBoardConfig(BoardConfig):
         :param hwpack: The Android hwpack configuration file.
         :return The configuration read from the file as a dictionary.
         """
+        import yaml
         try:
             with open(hwpack, 'r') as hw:
                 config = yaml.safe_load(hw)
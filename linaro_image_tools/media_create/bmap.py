@@ -0,0 +1,172 @@
+# Copyright (C) 2012 Linaro
+#
+# This file is part of Linaro Image Tools.
+#
+# Linaro Image Tools is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Linaro Image Tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Linaro Image Tools.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Block maps of sparse image files.
+
+A block map (bmap) lists the ranges of blocks of an image file which hold
+data, together with a checksum of each range, so that tools like bmaptool
+only need to write those ranges when flashing the image.  The files written
+here follow version 2.0 of bmaptool's format.
+
+Only the blocks that were never written are left out of the block map;
+blocks which were written with zeros (e.g. in a file on one of the image's
+filesystems) must still be written when flashing, so holes must never be
+punched into an image file whose block map is going to be used.
+"""
+
+import errno
+import hashlib
+import os
+
+BMAP_BLOCK_SIZE = 4096
+BMAP_SUFFIX = '.bmap'
+# os.SEEK_DATA and os.SEEK_HOLE are not available in Python 2.
+SEEK_DATA = 3
+SEEK_HOLE = 4
+
+
+def _get_data_extents(fd, size):
+    """Return the (start, end) byte offsets of the data in the given file.
+
+    Uses SEEK_DATA/SEEK_HOLE, which raise EINVAL on filesystems or kernels
+    not supporting them.
+    """
+    extents = []
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, SEEK_DATA)
+        except OSError, e:
+            if e.errno == errno.ENXIO:
+                # No more data after offset.
+                break
+            raise
+        end = os.lseek(fd, start, SEEK_HOLE)
+        extents.append((start, end))
+        offset = end
+    return extents
+
+
+def get_data_extents(path):
+    """Return the (start, end) byte offsets of the data in the given file.
+
+    Only the ranges which were never written (holes) are left out.  If the
+    filesystem doesn't support SEEK_DATA/SEEK_HOLE there's no telling holes
+    from blocks of zeros that were written, so the whole file is returned as
+    a single extent.
+    """
+    size = os.path.getsize(path)
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        try:
+            return _get_data_extents(fd, size)
+        except OSError, e:
+            if e.errno != errno.EINVAL:
+                raise
+            return [(0, size)]
+    finally:
+        os.close(fd)
+
+
+def get_mapped_ranges(image_file, block_size=BMAP_BLOCK_SIZE):
+    """Return the ranges of blocks of image_file holding data.
+
+    :return: A list of (first, last) block numbers, both inclusive, sorted
+        and with adjacent ranges merged.
+    """
+    size = os.path.getsize(image_file)
+    extents = get_data_extents(image_file)
+    ranges = []
+    for start, end in extents:
+        if end <= start:
+            continue
+        first = start // block_size
+        last = (min(end, size) - 1) // block_size
+        if ranges and first <= ranges[-1][1] + 1:
+            ranges[-1] = (ranges[-1][0], max(last, ranges[-1][1]))
+        else:
+            ranges.append((first, last))
+    return ranges
+
+
+def _range_checksum(fd, first, last, block_size):
+    checksum = hashlib.sha256()
+    os.lseek(fd, first * block_size, os.SEEK_SET)
+    remaining = (last - first + 1) * block_size
+    while remaining > 0:
+        data = os.read(fd, min(remaining, 1024 * 1024))
+        if not data:
+            break
+        checksum.update(data)
+        remaining -= len(data)
+    return checksum.hexdigest()
+
+
+def generate_bmap(image_file, block_size=BMAP_BLOCK_SIZE):
+    """Return the block map of image_file, as a string."""
+    size = os.path.getsize(image_file)
+    ranges = get_mapped_ranges(image_file, block_size)
+    blocks_count = (size + block_size - 1) // block_size
+    mapped_blocks_count = sum(last - first + 1 for first, last in ranges)
+
+    range_lines = []
+    fd = os.open(image_file, os.O_RDONLY)
+    try:
+        for first, last in ranges:
+            if first == last:
+                blocks = '%d' % first
+            else:
+                blocks = '%d-%d' % (first, last)
+            range_lines.append(
+                '        <Range chksum="%s"> %s </Range>' % (
+                    _range_checksum(fd, first, last, block_size), blocks))
+    finally:
+        os.close(fd)
+
+    # The checksum of the bmap itself is calculated with the checksum
+    # field set to all zeros.
+    lines = [
+        '<?xml version="1.0" ?>',
+        '<bmap version="2.0">',
+        '    <ImageSize> %d </ImageSize>' % size,
+        '    <BlockSize> %d </BlockSize>' % block_size,
+        '    <BlocksCount> %d </BlocksCount>' % blocks_count,
+        '    <MappedBlocksCount> %d </MappedBlocksCount>' % (
+            mapped_blocks_count),
+        '    <ChecksumType> sha256 </ChecksumType>',
+        '    <BmapFileChecksum> %s </BmapFileChecksum>' % ('0' * 64),
+        '    <BlockMap>',
+    ]
+    lines.extend(range_lines)
+    lines.extend(['    </BlockMap>', '</bmap>', ''])
+    bmap = '\n'.join(lines)
+    return bmap.replace('0' * 64, hashlib.sha256(bmap).hexdigest(), 1)
+
+
+def write_bmap(image_file, bmap_file=None):
+    """Write the block map of image_file next to it.
+
+    :param bmap_file: Where to write the block map; defaults to image_file
+        plus BMAP_SUFFIX.
+    :return: The path to the block map.
+    """
+    if bmap_file is None:
+        bmap_file = image_file + BMAP_SUFFIX
+    bmap = generate_bmap(image_file)
+    with open(bmap_file, 'w') as fd:
+        fd.write(bmap)
+    return bmap_file
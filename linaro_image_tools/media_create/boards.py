@@ -25,7 +25,6 @@ board_configs at the bottom of this file.
 """
 
 from binascii import crc32
-from parted import Device
 import atexit
 import glob
 import logging
@@ -35,7 +34,7 @@ import string
 import struct
 import tempfile
 
-from linaro_image_tools import cmd_runner
+from linaro_image_tools import cmd_runner, root_helper
 
 from linaro_image_tools.hwpack.handler import HardwarepackHandler
 from linaro_image_tools.media_create.partitions import (
@@ -640,8 +639,7 @@ class BoardConfig(object):
                             to_file = os.path.basename(from_file)
 
                         if not os.path.exists(to_dir):
-                            cmd_runner.run(["mkdir", "-p", to_dir],
-                                           as_root=True).wait()
+                            root_helper.make_dirs(to_dir)
                         dtb = _get_file_matching(os.path.join(search_dir,
                                                               from_file))
                         if not dtb:
@@ -651,8 +649,7 @@ class BoardConfig(object):
                         else:
                             dest = os.path.join(to_dir, to_file)
                             logger.debug('Copying %s into %s' % (dtb, dest))
-                            cmd_runner.run(['cp', dtb, dest],
-                                           as_root=True).wait()
+                            root_helper.copy(dtb, dest)
                 else:
                     # Hopefully we should never get here.
                     # This should only happen if the hwpack config YAML file is
@@ -742,45 +739,63 @@ class BoardConfig(object):
 
     def populate_boot(self, chroot_dir, rootfs_id, boot_partition, boot_disk,
                       boot_device_or_file, is_live, is_lowmem, consoles):
+        """Populate the boot partition, mounting it on boot_disk.
+
+        If boot_partition is None nothing is mounted and the boot files are
+        only staged in boot_disk; it's then up to the caller to put them on
+        the media.
+        """
+        cmd_runner.run(['mkdir', '-p', boot_disk]).wait()
+        if boot_partition is None:
+            self._populate_boot_disk(
+                chroot_dir, rootfs_id, boot_disk, boot_device_or_file,
+                is_live, is_lowmem, consoles)
+            return
+        with partition_mounted(boot_partition, boot_disk):
+            self._populate_boot_disk(
+                chroot_dir, rootfs_id, boot_disk, boot_device_or_file,
+                is_live, is_lowmem, consoles)
+
+    def _populate_boot_disk(self, chroot_dir, rootfs_id, boot_disk,
+                            boot_device_or_file, is_live, is_lowmem,
+                            consoles):
         parts_dir = 'boot'
         if is_live:
             parts_dir = 'casper'
         bootloader_parts_dir = os.path.join(chroot_dir, parts_dir)
-        cmd_runner.run(['mkdir', '-p', boot_disk]).wait()
-        with partition_mounted(boot_partition, boot_disk):
-            with self.hardwarepack_handler:
-                if self.bootloader_file_in_boot_part:
-                    # <legacy v1 support>
-                    if self.bootloader_flavor is not None:
+        with self.hardwarepack_handler:
+            if self.bootloader_file_in_boot_part:
+                # <legacy v1 support>
+                if self.bootloader_flavor is not None:
+                    default = os.path.join(
+                        chroot_dir, 'usr', 'lib', 'u-boot',
+                        self.bootloader_flavor, 'u-boot.img')
+                    if not os.path.exists(default):
                         default = os.path.join(
                             chroot_dir, 'usr', 'lib', 'u-boot',
-                            self.bootloader_flavor, 'u-boot.img')
-                        if not os.path.exists(default):
-                            default = os.path.join(
-                                chroot_dir, 'usr', 'lib', 'u-boot',
-                                self.bootloader_flavor, 'u-boot.bin')
-                    else:
-                        default = None
-                    # </legacy v1 support>
-                    bootloader_bin = self.get_file('bootloader_file',
-                                                   default=default)
-                    assert bootloader_bin is not None, (
-                        "bootloader binary could not be found")
-
-                    proc = cmd_runner.run(
-                        ['cp', '-v', bootloader_bin, boot_disk], as_root=True)
-                    proc.wait()
-
-                # Handle copy_files field.
+                            self.bootloader_flavor, 'u-boot.bin')
+                else:
+                    default = None
+                # </legacy v1 support>
+                bootloader_bin = self.get_file('bootloader_file',
+                                               default=default)
+                assert bootloader_bin is not None, (
+                    "bootloader binary could not be found")
+
+                root_helper.copy(bootloader_bin, boot_disk, verbose=True)
+
+            # Handle copy_files field.
+            with root_helper.batch():
                 self.copy_files(boot_disk)
 
-            # Handle dtb_files field.
-            if self.dtb_files:
+        # Handle dtb_files field.
+        if self.dtb_files:
+            with root_helper.batch():
                 self._copy_dtb_files(self.dtb_files, boot_disk, chroot_dir)
 
-            self.make_boot_files(
-                bootloader_parts_dir, is_live, is_lowmem, consoles, chroot_dir,
-                rootfs_id, boot_disk, boot_device_or_file)
+        self.make_boot_files(
+            bootloader_parts_dir, is_live, is_lowmem, consoles, chroot_dir,
+            rootfs_id, boot_disk, boot_device_or_file)
 
     def copy_files(self, boot_disk):
         """Handle the copy_files metadata field."""
@@ -805,12 +820,10 @@ class BoardConfig(object):
                     dirname = os.path.dirname(dest_path)
                     dirname = os.path.join(boot_disk, dirname)
                     if not os.path.exists(dirname):
-                        cmd_runner.run(["mkdir", "-p", dirname],
-                                       as_root=True).wait()
-                    proc = cmd_runner.run(
-                        ['cp', '-v', source,
-                         os.path.join(boot_disk, dest_path)], as_root=True)
-                    proc.wait()
+                        root_helper.make_dirs(dirname)
+                    root_helper.copy(
+                        source, os.path.join(boot_disk, dest_path),
+                        verbose=True)
 
     def _get_kflavor_files(self, path):
         """Search for kernel, initrd and optional dtb in path."""
@@ -1163,21 +1176,24 @@ class SnowballEmmcConfig(SnowballSdConfig):
         A sector size of 1 is used for some files, as they do not
         necessarily start on an even address. '''
         assert os.path.getsize(toc_file_name) <= self.TOC_SIZE
-        _dd(toc_file_name, boot_device_or_file, seek=start_sector)
+        writes = [(toc_file_name, SECTOR_SIZE, None, start_sector, None)]
 
         for file in files:
-            # XXX We need checks that these files do not overwrite each
-            # other. This code assumes that offset and file sizes are ok.
             filename = file['filename']
             if (file['offset'] % SECTOR_SIZE) != 0:
                 seek_bytes = start_sector * SECTOR_SIZE + file['offset']
-                _dd(filename, boot_device_or_file, block_size=1,
-                    seek=seek_bytes)
+                writes.append((filename, 1, None, seek_bytes, None))
             else:
                 seek_sectors = start_sector + file['offset'] / SECTOR_SIZE
-                _dd(filename, boot_device_or_file, seek=seek_sectors)
-            if delete_startupfiles:
-                self.delete_file(filename)
+                writes.append(
+                    (filename, SECTOR_SIZE, None, seek_sectors, None))
+        # All the files are written in one go, so that the device is opened
+        # and synced only once.
+        _write_blocks(boot_device_or_file, writes)
+
+        if delete_startupfiles:
+            for file in files:
+                self.delete_file(file['filename'])
 
     def delete_file(self, file_path):
             cmd = ["rm", "%s" % file_path]
@@ -1681,6 +1697,7 @@ class I386Config(BoardConfig):
         cmd_runner.run(['cp', i_img_data, boot_dir], as_root=True).wait()
 
         # create a loop device with the whole image
+        from parted import Device
         device = Device(boot_device_or_file)
         img_size = device.getLength() * SECTOR_SIZE
         img_loop = register_loopback(boot_device_or_file, 0, img_size)
@@ -1759,18 +1776,76 @@ def get_board_config(board):
 
 def _dd(input_file, output_file, block_size=SECTOR_SIZE, count=None, seek=None,
         skip=None):
-    """Wrapper around the dd command"""
-    cmd = [
-        "dd", "if=%s" % input_file, "of=%s" % output_file,
-        "bs=%s" % block_size, "conv=notrunc"]
-    if count is not None:
-        cmd.append("count=%s" % count)
-    if seek is not None:
-        cmd.append("seek=%s" % seek)
-    if skip is not None:
-        cmd.append("skip=%s" % skip)
-    proc = cmd_runner.run(cmd, as_root=True)
-    proc.wait()
+    """Write input_file into output_file, like dd with conv=notrunc.
+
+    count, seek and skip are in blocks of block_size bytes, as for dd.
+    """
+    _write_blocks(output_file, [(input_file, block_size, count, seek, skip)])
+
+
+def _write_blocks(output_file, writes):
+    """Write the given files into output_file, as root.
+
+    Each file is written with large writes at its byte offset, whatever
+    the block_size it is given in.  When that can be done without sudo,
+    output_file is opened and synced only once; otherwise dd is run for
+    each file, with byte counts.
+
+    The files must not overlap each other in output_file.
+
+    :param writes: A list of (input_file, block_size, count, seek, skip)
+        tuples, as taken by _dd().
+    """
+    byte_writes = []
+    for input_file, block_size, count, seek, skip in writes:
+        length = offset = skip_bytes = None
+        if count is not None:
+            length = count * block_size
+        if seek is not None:
+            offset = seek * block_size
+        if skip is not None:
+            skip_bytes = skip * block_size
+        byte_writes.append((input_file, offset, length, skip_bytes))
+    if len(byte_writes) > 1:
+        _check_writes_do_not_overlap(byte_writes)
+    if root_helper.can_write_blocks():
+        root_helper.write_blocks(
+            output_file, [(write[0], write[1] or 0, write[2], write[3] or 0)
+                          for write in byte_writes])
+        return
+    for input_file, offset, length, skip in byte_writes:
+        cmd = [
+            "dd", "if=%s" % input_file, "of=%s" % output_file,
+            "bs=%s" % root_helper.WRITE_BLOCKS_BUFFER_SIZE, "conv=notrunc",
+            "iflag=skip_bytes,count_bytes", "oflag=seek_bytes"]
+        if length is not None:
+            cmd.append("count=%s" % length)
+        if offset is not None:
+            cmd.append("seek=%s" % offset)
+        if skip is not None:
+            cmd.append("skip=%s" % skip)
+        proc = cmd_runner.run(cmd, as_root=True)
+        proc.wait()
+
+
+def _check_writes_do_not_overlap(writes):
+    """Check that none of the given byte writes overruns the next one.
+
+    :param writes: A list of (input_file, offset, length, skip) tuples, as
+        taken by root_helper.write_blocks() but with None for a zero offset
+        or skip.
+    """
+    extents = []
+    for input_file, offset, length, skip in writes:
+        if length is None:
+            length = os.path.getsize(input_file) - (skip or 0)
+        extents.append((offset or 0, length, input_file))
+    extents.sort()
+    for (offset, length, input_file), (next_offset, _, next_file) in zip(
+            extents, extents[1:]):
+        assert offset + length <= next_offset, (
+            "%s (%d bytes at offset %d) overruns %s at offset %d" % (
+                input_file, length, offset, next_file, next_offset))
 
 
 def _run_mkimage(img_type, load_addr, entry_point, name, img_data, img,
@@ -1820,7 +1895,7 @@ def make_dtb(img_data, boot_disk):
     img = None
     if img_data is not None:
         img = '%s/board.dtb' % boot_disk
-        cmd_runner.run(['cp', img_data, img], as_root=True).wait()
+        root_helper.copy(img_data, img)
     return img
 
 
@@ -1919,7 +1994,7 @@ def install_omap_boot_loader(chroot_dir, boot_disk, cls):
         except AssertionError:
             default = None
         mlo_file = cls.get_file('spl_file', default=default)
-        cmd_runner.run(["cp", "-v", mlo_file, boot_disk], as_root=True).wait()
+        root_helper.copy(mlo_file, boot_disk, verbose=True)
         # XXX: Is this really needed?
         cmd_runner.run(["sync"]).wait()
 
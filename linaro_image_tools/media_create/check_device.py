@@ -19,8 +19,6 @@
 
 import glob
 
-import dbus
-
 from linaro_image_tools.media_create import partitions
 
 
@@ -29,6 +27,7 @@ def _get_system_bus_and_udisks_iface():
 
     :return: System bus and UDisks inteface tuple.
     """
+    import dbus
     bus = dbus.SystemBus()
     udisks = dbus.Interface(
         bus.get_object("org.freedesktop.UDisks", "/org/freedesktop/UDisks"),
@@ -55,6 +54,7 @@ def _does_device_exist(path):
     :param path: Disk device path.
     :return: True if the device exist, else False.
     """
+    import dbus
     bus, udisks = _get_system_bus_and_udisks_iface()
     try:
         udisks.get_dbus_method('FindDeviceByDeviceFile')(path)
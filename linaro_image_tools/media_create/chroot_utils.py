@@ -44,10 +44,8 @@ def prepare_chroot(chroot_dir, tmp_dir):
                   os.path.join(chroot_dir, 'usr', 'bin'))
 
 
-def install_hwpacks(
-        rootfs_dir, tmp_dir, tools_dir, hwpack_force_yes, verified_files,
-        extract_kpkgs=False, *hwpack_files):
-    """Install the given hwpacks onto the given rootfs."""
+def _prepare_hwpack_install(rootfs_dir, tmp_dir, tools_dir, extract_kpkgs):
+    """Set up rootfs_dir for linaro-hwpack-install to run in it."""
 
     # In case we just want to extract the kernel packages, don't force qemu
     # with chroot, as we could have archs without qemu support
@@ -80,24 +78,96 @@ def install_hwpacks(
                    "configured before trying again.")
             raise
 
+
+def install_hwpacks(
+        rootfs_dir, tmp_dir, tools_dir, hwpack_force_yes, verified_files,
+        extract_kpkgs=False, *hwpack_files, **kwargs):
+    """Install the given hwpacks onto the given rootfs.
+
+    If the skip_installed keyword argument is True, the packages of the
+    hwpacks installed at their version in the hwpack are left alone.
+    """
+    skip_installed = kwargs.pop('skip_installed', False)
+    _prepare_hwpack_install(rootfs_dir, tmp_dir, tools_dir, extract_kpkgs)
     try:
         for hwpack_file in hwpack_files:
             hwpack_verified = False
             if os.path.basename(hwpack_file) in verified_files:
                 hwpack_verified = True
             install_hwpack(rootfs_dir, hwpack_file, extract_kpkgs,
-                           hwpack_force_yes or hwpack_verified)
+                           hwpack_force_yes or hwpack_verified,
+                           skip_installed)
     finally:
         run_local_atexit_funcs()
 
 
-def install_hwpack(rootfs_dir, hwpack_file, extract_kpkgs, hwpack_force_yes):
+def install_merged_hwpacks(
+        rootfs_dir, tmp_dir, tools_dir, hwpack_force_yes, verified_files,
+        extract_kpkgs=False, *hwpack_files, **kwargs):
+    """Install the given hwpacks onto the given rootfs, all at once.
+
+    Unlike install_hwpacks(), linaro-hwpack-install is only run once, so
+    that the apt sources of all the hwpacks are updated once and their
+    packages installed by a single apt-get run.  It takes the same
+    skip_installed keyword argument.
+    """
+    skip_installed = kwargs.pop('skip_installed', False)
+    _prepare_hwpack_install(rootfs_dir, tmp_dir, tools_dir, extract_kpkgs)
+    try:
+        hwpacks_verified = not [
+            hwpack_file for hwpack_file in hwpack_files
+            if os.path.basename(hwpack_file) not in verified_files]
+        args = ['linaro-hwpack-install']
+        if hwpack_force_yes or hwpacks_verified:
+            args.append('--force-yes')
+        if skip_installed:
+            args.append('--skip-installed')
+        if extract_kpkgs:
+            args.append('--extract-kernel-only')
+            chroot_dir = None
+        else:
+            chroot_dir = rootfs_dir
+        names = []
+        for hwpack_file in hwpack_files:
+            hwpack_basename = os.path.basename(hwpack_file)
+            names.append(hwpack_basename)
+            copy_file(hwpack_file, rootfs_dir)
+            args.extend(_get_hwpack_args(hwpack_file))
+            if extract_kpkgs:
+                args.append(os.path.join(rootfs_dir, hwpack_basename))
+            else:
+                args.append('/%s' % hwpack_basename)
+        print "-" * 60
+        print "Installing (linaro-hwpack-install) %s in target rootfs." % (
+            ', '.join(names))
+        cmd_runner.run(args, as_root=True, chroot=chroot_dir).wait()
+        print "-" * 60
+    finally:
+        run_local_atexit_funcs()
+
+
+def _get_hwpack_args(hwpack_file):
+    """Return the linaro-hwpack-install options describing the hwpack."""
+    # Get infromation required by linaro-hwpack-install
+    with HardwarepackHandler([hwpack_file]) as hwpack:
+        version, _ = hwpack.get_field("version")
+        architecture, _ = hwpack.get_field("architecture")
+        name, _ = hwpack.get_field("name")
+    return ['--hwpack-version', version,
+            '--hwpack-arch', architecture,
+            '--hwpack-name', name]
+
+
+def install_hwpack(rootfs_dir, hwpack_file, extract_kpkgs, hwpack_force_yes,
+                   skip_installed=False):
     """Install an hwpack on the given rootfs.
 
     Copy the hwpack file to the rootfs and run linaro-hwpack-install passing
     that hwpack file to it.  If hwpack_force_yes is True, also pass
     --force-yes to linaro-hwpack-install. In case extract_kpkgs is True, it
     will not install all the packages, but just extract the kernel ones.
+    If skip_installed is True, pass --skip-installed, for the packages
+    installed from the host to be left alone.
     """
     hwpack_basename = os.path.basename(hwpack_file)
     copy_file(hwpack_file, rootfs_dir)
@@ -105,18 +175,11 @@ def install_hwpack(rootfs_dir, hwpack_file, extract_kpkgs, hwpack_force_yes):
     print "Installing (linaro-hwpack-install) %s in target rootfs." % (
         hwpack_basename)
 
-    # Get infromation required by linaro-hwpack-install
-    with HardwarepackHandler([hwpack_file]) as hwpack:
-        version, _ = hwpack.get_field("version")
-        architecture, _ = hwpack.get_field("architecture")
-        name, _ = hwpack.get_field("name")
-
-    args = ['linaro-hwpack-install',
-            '--hwpack-version', version,
-            '--hwpack-arch', architecture,
-            '--hwpack-name', name]
+    args = ['linaro-hwpack-install'] + _get_hwpack_args(hwpack_file)
     if hwpack_force_yes:
         args.append('--force-yes')
+    if skip_installed:
+        args.append('--skip-installed')
 
     if extract_kpkgs:
         args.append('--extract-kernel-only')
@@ -0,0 +1,392 @@
+# Copyright (C) 2012 Linaro
+#
+# This file is part of Linaro Image Tools.
+#
+# Linaro Image Tools is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Linaro Image Tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Linaro Image Tools.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Write image files to block devices.
+
+Only the data extents of the image file are written, merged into large,
+aligned, sequential writes, which is what SD cards and other flash media are
+fastest at.  What was written can then be verified by reading it back from
+the device.
+
+Writing to a device needs root, so flash_image() runs this module as a
+script through cmd_runner:
+
+  python -m linaro_image_tools.media_create.flash IMAGE_FILE DEVICE
+
+flash_image_to_devices() runs one such process per device, all at the same
+time, so that a failure writing to one device doesn't affect the others.
+"""
+
+import argparse
+import errno
+import fcntl
+import os
+import select
+import stat
+import subprocess
+import sys
+import time
+
+from linaro_image_tools import cmd_runner
+from linaro_image_tools.media_create.bmap import get_data_extents
+
+# The size of each write to the device; also the alignment of the ranges
+# written.
+FLASH_CHUNK_SIZE = 4 * 1024 * 1024
+# Holes in the image file smaller than this are written as zeros rather than
+# skipped, as that is cheaper than breaking up a sequential write.
+MIN_SKIPPED_HOLE = FLASH_CHUNK_SIZE
+# From <linux/fs.h>.
+BLKRRPART = 0x125f
+BLKFLSBUF = 0x1261
+SYS_CLASS_BLOCK = '/sys/class/block'
+# How often, in seconds, the progress of flash_image_to_devices() is
+# reported.
+PROGRESS_INTERVAL = 2
+
+
+class FlashVerificationError(Exception):
+    """What was read back from the device doesn't match the image."""
+
+
+def get_block_device_size(device):
+    """Return the size of the given block device, in bytes.
+
+    The size is read from sysfs, so no root is needed.
+    """
+    name = os.path.basename(os.path.realpath(device))
+    with open(os.path.join(SYS_CLASS_BLOCK, name, 'size')) as fd:
+        # sysfs always counts 512-byte sectors.
+        return int(fd.read()) * 512
+
+
+def get_write_ranges(image_file, chunk_size=FLASH_CHUNK_SIZE,
+                     min_skipped_hole=MIN_SKIPPED_HOLE):
+    """Return the (start, end) byte ranges of image_file to write.
+
+    The data extents of the image file are aligned to chunk_size (without
+    going past the end of the file) and merged when the holes between them
+    are smaller than min_skipped_hole.
+    """
+    size = os.path.getsize(image_file)
+    ranges = []
+    for start, end in get_data_extents(image_file):
+        start = start - start % chunk_size
+        end = min(size, end + (-end % chunk_size))
+        if ranges and start - ranges[-1][1] < min_skipped_hole:
+            ranges[-1] = (ranges[-1][0], max(end, ranges[-1][1]))
+        else:
+            ranges.append((start, end))
+    return ranges
+
+
+def _read_fully(fd, size):
+    chunks = []
+    while size > 0:
+        data = os.read(fd, size)
+        if not data:
+            break
+        chunks.append(data)
+        size -= len(data)
+    return ''.join(chunks)
+
+
+def _copy_ranges(ranges, source_fd, target_fd, chunk_size, progress):
+    done = 0
+    total = sum(end - start for start, end in ranges)
+    for start, end in ranges:
+        os.lseek(source_fd, start, os.SEEK_SET)
+        os.lseek(target_fd, start, os.SEEK_SET)
+        position = start
+        while position < end:
+            data = _read_fully(source_fd, min(chunk_size, end - position))
+            written = 0
+            while written < len(data):
+                written += os.write(target_fd, data[written:])
+            position += len(data)
+            done += len(data)
+            if progress is not None:
+                progress(done, total)
+
+
+def _verify_ranges(ranges, image_fd, device_fd, chunk_size, progress):
+    done = 0
+    total = sum(end - start for start, end in ranges)
+    for start, end in ranges:
+        os.lseek(image_fd, start, os.SEEK_SET)
+        os.lseek(device_fd, start, os.SEEK_SET)
+        position = start
+        while position < end:
+            size = min(chunk_size, end - position)
+            expected = _read_fully(image_fd, size)
+            if _read_fully(device_fd, size) != expected:
+                raise FlashVerificationError(
+                    "Data read back from the device differs from the image "
+                    "in the %d bytes at offset %d" % (size, position))
+            position += size
+            done += size
+            if progress is not None:
+                progress(done, total)
+
+
+def write_image(image_file, device, verify=True,
+                chunk_size=FLASH_CHUNK_SIZE, progress=None,
+                verify_progress=None):
+    """Write image_file to device, skipping the holes in the image.
+
+    :param verify: Whether to read what was written back from the device and
+        compare it to the image file.
+    :param progress: A callable given the number of bytes written so far
+        and the total, or None.
+    :param verify_progress: Like progress, but for the verification;
+        defaults to progress.
+    :raises FlashVerificationError: If the verification fails.
+    """
+    if verify_progress is None:
+        verify_progress = progress
+    ranges = get_write_ranges(image_file, chunk_size)
+    image_fd = os.open(image_file, os.O_RDONLY)
+    try:
+        device_fd = os.open(device, os.O_RDWR)
+        try:
+            _copy_ranges(ranges, image_fd, device_fd, chunk_size, progress)
+            os.fsync(device_fd)
+            if verify:
+                if _is_block_device(device_fd):
+                    # Drop the device's buffer cache so that what's read
+                    # back comes from the device rather than from memory.
+                    fcntl.ioctl(device_fd, BLKFLSBUF)
+                _verify_ranges(
+                    ranges, image_fd, device_fd, chunk_size, verify_progress)
+            if _is_block_device(device_fd):
+                _reread_partition_table(device_fd)
+        finally:
+            os.close(device_fd)
+    finally:
+        os.close(image_fd)
+
+
+def _is_block_device(fd):
+    return stat.S_ISBLK(os.fstat(fd).st_mode)
+
+
+def _reread_partition_table(fd):
+    try:
+        fcntl.ioctl(fd, BLKRRPART)
+    except IOError, e:
+        # The kernel refuses to do it while any partition is in use, in
+        # which case the new partitions show up on the next reboot.
+        if e.errno != errno.EBUSY:
+            raise
+
+
+def _run_flash_helper(image_file, device, verify, machine_readable=False,
+                      stdout=None, stderr=None):
+    args = [image_file, device]
+    if not verify:
+        args.append('--no-verify')
+    if machine_readable:
+        args.append('--machine-readable')
+    return cmd_runner.run_module(
+        'linaro_image_tools.media_create.flash', args, as_root=True,
+        stdout=stdout, stderr=stderr)
+
+
+def flash_image(image_file, device, verify=True):
+    """Write image_file to device as root, using a helper process."""
+    _run_flash_helper(image_file, device, verify).wait()
+
+
+class FlashJob(object):
+    """The writing of an image file to one device by a helper process."""
+
+    def __init__(self, image_file, device, verify=True):
+        self.device = device
+        self.verify = verify
+        self.phase = 'starting'
+        self.done = 0
+        self.total = 0
+        self.written = 0
+        self.write_seconds = None
+        self.output = []
+        self.returncode = None
+        self._buffer = ''
+        self.started = time.time()
+        self.proc = _run_flash_helper(
+            image_file, device, verify, machine_readable=True,
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        # The return code is checked by succeeded, rather than by having
+        # wait() raise.
+        self.proc.except_on_cmd_fail = False
+
+    def fileno(self):
+        return self.proc.stdout.fileno()
+
+    @property
+    def finished(self):
+        return self.returncode is not None
+
+    @property
+    def succeeded(self):
+        return self.returncode == 0
+
+    def throughput(self):
+        """Return the rate at which the image was written, in bytes/s."""
+        seconds = self.write_seconds
+        if seconds is None:
+            seconds = time.time() - self.started
+        if seconds <= 0:
+            return 0
+        return self.written / seconds
+
+    def _handle_line(self, line):
+        fields = line.split()
+        if (len(fields) == 3 and fields[0] in ('write', 'verify') and
+                fields[1].isdigit() and fields[2].isdigit()):
+            phase, done, total = fields[0], int(fields[1]), int(fields[2])
+            if phase == 'verify' and self.write_seconds is None:
+                self.write_seconds = time.time() - self.started
+            if phase == 'write':
+                self.written = done
+            self.phase, self.done, self.total = phase, done, total
+        elif line.strip():
+            self.output.append(line)
+
+    def read(self):
+        """Process the output of the helper available for reading.
+
+        Once the helper closes its output it's waited for, and the job is
+        finished.
+        """
+        data = os.read(self.fileno(), 64 * 1024)
+        if not data:
+            if self._buffer:
+                self._handle_line(self._buffer)
+            self.proc.stdout.close()
+            self.returncode = self.proc.wait()
+            if self.write_seconds is None:
+                self.write_seconds = time.time() - self.started
+            self.phase = 'done' if self.succeeded else 'failed'
+            return
+        lines = (self._buffer + data).split('\n')
+        self._buffer = lines.pop()
+        for line in lines:
+            self._handle_line(line)
+
+    def describe(self):
+        """Return a one-line description of the state of the job."""
+        rate = self.throughput() / 1024 ** 2
+        if self.phase == 'done':
+            if self.verify:
+                status = 'verified'
+            else:
+                status = 'not verified'
+            return '%s: done, %s (%.1f MiB/s)' % (self.device, status, rate)
+        if self.phase == 'failed':
+            reason = 'exit code %d' % self.returncode
+            if self.output:
+                reason = self.output[-1]
+            return '%s: FAILED: %s' % (self.device, reason)
+        percent = 0
+        if self.total:
+            percent = self.done * 100 / self.total
+        if self.phase == 'verify':
+            return '%s: verifying %d%%' % (self.device, percent)
+        return '%s: writing %d%% (%.1f MiB/s)' % (self.device, percent, rate)
+
+
+def flash_image_to_devices(image_file, devices, verify=True, report=None):
+    """Write image_file to all the given devices at the same time.
+
+    There's one helper process per device, so a failure writing to one of
+    them doesn't stop the others.
+
+    :param report: A callable given the list of jobs every
+        PROGRESS_INTERVAL seconds and whenever one of them finishes, or
+        None.
+    :return: The list of FlashJobs, one per device, all finished.
+    """
+    jobs = [FlashJob(image_file, device, verify) for device in devices]
+    running = list(jobs)
+    last_report = time.time()
+    while running:
+        readable, _, _ = select.select(running, [], [], PROGRESS_INTERVAL)
+        some_finished = False
+        for job in readable:
+            job.read()
+            if job.finished:
+                running.remove(job)
+                some_finished = True
+        now = time.time()
+        if report is not None and (
+                some_finished or now - last_report >= PROGRESS_INTERVAL):
+            report(jobs)
+            last_report = now
+    return jobs
+
+
+def _print_progress(label):
+    def progress(done, total):
+        percent = 100
+        if total:
+            percent = done * 100 / total
+        sys.stdout.write("\r%s: %d%% (%d of %d MiB)" % (
+            label, percent, done / 2 ** 20, total / 2 ** 20))
+        if done == total:
+            sys.stdout.write("\n")
+        sys.stdout.flush()
+    return progress
+
+
+def _print_machine_readable_progress(phase):
+    def progress(done, total):
+        print '%s %d %d' % (phase, done, total)
+        sys.stdout.flush()
+    return progress
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Write an image file to a block device.")
+    parser.add_argument('image_file')
+    parser.add_argument('device')
+    parser.add_argument(
+        '--no-verify', dest='verify', action='store_false',
+        help="Don't read back what was written to compare it to the image.")
+    parser.add_argument(
+        '--machine-readable', action='store_true',
+        help=('Report progress as "write DONE TOTAL" and "verify DONE TOTAL" '
+              'lines.'))
+    args = parser.parse_args(argv)
+    if args.machine_readable:
+        write_progress = _print_machine_readable_progress('write')
+        verify_progress = _print_machine_readable_progress('verify')
+    else:
+        write_progress = _print_progress('Writing %s' % args.device)
+        verify_progress = _print_progress('Verifying %s' % args.device)
+    try:
+        write_image(args.image_file, args.device, verify=args.verify,
+                    progress=write_progress, verify_progress=verify_progress)
+    except FlashVerificationError, e:
+        print >> sys.stderr, "Verification of %s failed: %s" % (
+            args.device, e)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
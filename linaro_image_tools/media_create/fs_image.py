@@ -0,0 +1,153 @@
+# Copyright (C) 2012 Linaro
+#
+# This file is part of Linaro Image Tools.
+#
+# Linaro Image Tools is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Linaro Image Tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Linaro Image Tools.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Build image files without loop devices or mounts.
+
+Rather than formatting loop devices for the partitions of the image file and
+mounting them to copy files over, the filesystems are built as separate
+images straight from a directory tree and then written into the image file at
+the partitions' offsets.
+"""
+
+import os
+
+from linaro_image_tools import cmd_runner, profiling
+from linaro_image_tools.media_create.bmap import get_data_extents
+from linaro_image_tools.media_create.mbr import write_partition_table
+from linaro_image_tools.media_create.partitions import (
+    CYLINDER_SIZE,
+    EXT_FILESYSTEMS,
+    get_mkfs_options,
+    get_partition_size_in_bytes,
+    HEADS,
+    record_format_profile,
+    SECTOR_SIZE,
+    SECTORS,
+)
+
+# The size of the chunks in which filesystem images are written into the
+# image file.
+SPLICE_BLOCK_SIZE = 1024 * 1024
+
+
+def create_partitioned_image_file(board_config, image_file, image_size,
+                                  should_align_boot_part=False):
+    """Create image_file and partition it for the given board.
+
+    Neither the partitions are formatted nor is root needed, and no
+    subprocess is run.
+
+    :return: A 4-tuple containing the size and offset of the boot partition
+        followed by the size and offset of the root partition, in bytes.
+    """
+    image_size_in_bytes = get_partition_size_in_bytes(image_size)
+    cylinders = image_size_in_bytes / CYLINDER_SIZE
+    with open(image_file, 'wb') as fd:
+        fd.truncate(image_size_in_bytes)
+    sfdisk_cmd = board_config.get_sfdisk_cmd(
+        should_align_boot_part=should_align_boot_part)
+    partitions = write_partition_table(
+        image_file, sfdisk_cmd, HEADS, SECTORS,
+        cylinders * HEADS * SECTORS)
+    # Like calculate_partition_size_and_offset(), the root partition is the
+    # one following the boot partition.
+    boot = [p for p in partitions if p.bootable][0]
+    root = partitions[partitions.index(boot) + 1]
+    return (boot.size * SECTOR_SIZE, boot.start * SECTOR_SIZE,
+            root.size * SECTOR_SIZE, root.start * SECTOR_SIZE)
+
+
+def _create_sparse_file(path, size):
+    with open(path, 'wb') as fd:
+        fd.truncate(size)
+
+
+def make_rootfs_image(rootfs_dir, fs_image, size, rootfs_type, label, uuid,
+                      format_profile='default'):
+    """Create fs_image, a rootfs_type filesystem populated from rootfs_dir.
+
+    mkfs is run as root only so that it can read the files in rootfs_dir,
+    whose ownership and permissions are preserved in the filesystem.
+
+    :param size: The size of the filesystem, in bytes.
+    :param uuid: The UUID to give the filesystem.
+    :param format_profile: One of FORMAT_PROFILES; "sdcard" is the same as
+        "default" here, as the filesystem is built in a file.
+    """
+    _create_sparse_file(fs_image, size)
+    if format_profile == 'sdcard':
+        format_profile = 'default'
+    if rootfs_type in EXT_FILESYSTEMS:
+        # Without nodiscard, mkfs discards the whole image and then assumes
+        # the inode tables read back as zeros, which they won't on media the
+        # holes of the image are never written to.
+        mkfs_options = get_mkfs_options(
+            rootfs_type, format_profile, ['nodiscard'])
+        args = (['mkfs.%s' % rootfs_type, '-F', '-q'] + mkfs_options +
+                ['-d', rootfs_dir])
+    elif rootfs_type == 'btrfs':
+        mkfs_options = get_mkfs_options(rootfs_type, format_profile)
+        args = ['mkfs.btrfs', '-f'] + mkfs_options + ['--rootdir', rootfs_dir]
+    else:
+        raise ValueError(
+            "Can't create a %s filesystem from a directory" % rootfs_type)
+    record_format_profile(format_profile, {rootfs_type: mkfs_options})
+    args.extend(['-L', label, '-U', uuid, fs_image])
+    with profiling.stage('mkfs'):
+        cmd_runner.run(args, as_root=True).wait()
+
+
+def make_bootfs_image(boot_dir, fs_image, size, fat_size, label):
+    """Create fs_image, a FAT filesystem holding the contents of boot_dir.
+
+    :param size: The size of the filesystem, in bytes.
+    """
+    # mkfs.vfat -C refuses to overwrite an existing file.
+    if os.path.exists(fs_image):
+        os.remove(fs_image)
+    with profiling.stage('mkfs'):
+        cmd_runner.run(
+            ['mkfs.vfat', '-C', '-F', str(fat_size), '-n', label, fs_image,
+             str(size / 1024)]).wait()
+    entries = sorted(os.listdir(boot_dir))
+    if entries:
+        args = ['mcopy', '-s', '-p', '-i', fs_image]
+        args.extend(os.path.join(boot_dir, entry) for entry in entries)
+        args.append('::')
+        cmd_runner.run(args).wait()
+
+
+def splice_fs_image(fs_image, image_file, offset):
+    """Write the contents of fs_image into image_file at the given offset.
+
+    Only the data extents of fs_image are written, so the holes in it are
+    left as they are in image_file.  The target range of image_file must
+    therefore be zeroed already, as it is in a freshly created image file,
+    which also keeps the image file sparse.
+    """
+    with open(fs_image, 'rb') as source:
+        with open(image_file, 'r+b') as target:
+            for start, end in get_data_extents(fs_image):
+                source.seek(start)
+                target.seek(offset + start)
+                remaining = end - start
+                while remaining > 0:
+                    data = source.read(min(remaining, SPLICE_BLOCK_SIZE))
+                    if not data:
+                        break
+                    target.write(data)
+                    remaining -= len(data)
@@ -0,0 +1,662 @@
+# Copyright (C) 2012 Linaro
+#
+# This file is part of Linaro Image Tools.
+#
+# Linaro Image Tools is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Linaro Image Tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Linaro Image Tools.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Install hwpacks in a rootfs from the host, without emulating anything.
+
+linaro-hwpack-install runs apt-get in the rootfs, so on anything but an ARM
+host each step of the install is run by qemu.  Yet most packages only need
+their files unpacked and to be recorded in the dpkg database of the rootfs,
+and that is done here by the host: dpkg-deb reads packages of any
+architecture.
+
+Only the packages dpkg would do nothing else for are installed here: those
+without maintainer scripts, as these must run in the rootfs (and what the
+kernel's do is needed to make the boot partition), whose dependencies are
+installed, whose files belong to no other package and are neither diverted
+nor of interest to a trigger.  The other packages of the hwpack are left to
+linaro-hwpack-install, which is given --skip-installed so that apt-get
+installs just those.  Unlike it, the package lists of the hwpack's apt
+sources are not downloaded: they are once apt-get update is run on the
+board.
+"""
+
+import hashlib
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+
+from linaro_image_tools import cmd_runner
+from linaro_image_tools.hwpack.handler import HardwarepackHandler
+from linaro_image_tools.media_create.path_filter import (
+    DPKG_CONFIG_FILE,
+    PathFilter,
+    filter_tarball,
+)
+from linaro_image_tools.media_create.rootfs import (
+    protected_file_edits,
+    write_data_to_protected_file,
+)
+from linaro_image_tools.utils import DEFAULT_LOGGER_NAME
+
+logger = logging.getLogger(DEFAULT_LOGGER_NAME)
+
+SUPPORTED_FORMATS = ['1.0', '2.0', '3.0']
+# The control files which make dpkg run something in the rootfs.
+MAINTAINER_SCRIPTS = [
+    'preinst', 'postinst', 'prerm', 'postrm', 'config', 'triggers']
+DPKG_STATUS_FILE = 'var/lib/dpkg/status'
+DPKG_INFO_DIR = 'var/lib/dpkg/info'
+DPKG_DIVERSIONS_FILE = 'var/lib/dpkg/diversions'
+# The directives of a triggers control file through which a package is
+# triggered by the packages installing files in the given paths.
+TRIGGER_INTERESTS = ['interest', 'interest-await', 'interest-noawait']
+APT_EXTENDED_STATES_FILE = 'var/lib/apt/extended_states'
+APT_SOURCES_LIST = 'etc/apt/sources.list'
+APT_SOURCES_LIST_DIR = 'etc/apt/sources.list.d'
+_RELATION_CHECKS = {
+    '<<': lambda result: result < 0,
+    '<=': lambda result: result <= 0,
+    '=': lambda result: result == 0,
+    '>=': lambda result: result >= 0,
+    '>>': lambda result: result > 0,
+}
+
+
+class NotInstallableOnHost(Exception):
+    """The hwpack or package has to be installed by linaro-hwpack-install.
+    """
+
+
+def _read_control_files(deb):
+    """Return a dict mapping the names of deb's control files to their data.
+    """
+    proc = cmd_runner.run(
+        ['dpkg-deb', '--ctrl-tarfile', deb], stdout=subprocess.PIPE)
+    files = {}
+    tar = tarfile.open(fileobj=proc.stdout, mode='r|')
+    for member in tar:
+        if member.isreg():
+            files[os.path.basename(member.name)] = (
+                tar.extractfile(member).read())
+    tar.close()
+    proc.stdout.close()
+    proc.wait()
+    return files
+
+
+class _Package(object):
+    """A binary package of a hwpack."""
+
+    def __init__(self, path):
+        from debian.deb822 import Deb822
+        self.path = path
+        self.control_files = _read_control_files(path)
+        self.control = Deb822(self.control_files['control'])
+        self.name = self.control['Package']
+        self.version = self.control['Version']
+        self.architecture = self.control['Architecture']
+
+    @property
+    def info_name(self):
+        """The name of the package's files in dpkg's info directory."""
+        if self.control.get('Multi-Arch') == 'same':
+            return '%s:%s' % (self.name, self.architecture)
+        return self.name
+
+    @property
+    def maintainer_scripts(self):
+        return sorted(
+            name for name in self.control_files if name in MAINTAINER_SCRIPTS)
+
+    def get_relations(self, *fields):
+        """Return the relations of the given fields, as lists of options."""
+        from debian.deb822 import PkgRelation
+        relations = []
+        for field in fields:
+            if field in self.control:
+                relations.extend(
+                    PkgRelation.parse_relations(self.control[field]))
+        return relations
+
+
+def _read_status(rootfs_dir):
+    """Return the stanzas of the dpkg status file of rootfs_dir."""
+    from debian.deb822 import Deb822
+    path = os.path.join(rootfs_dir, DPKG_STATUS_FILE)
+    if not os.path.exists(path):
+        return []
+    with open(path) as fd:
+        return list(Deb822.iter_paragraphs(fd))
+
+
+def _is_installed(stanza):
+    return stanza.get('Status', '').split()[-1:] == ['installed']
+
+
+def _is_satisfied(options, versions, provided):
+    """Whether one of the options of a relation is satisfied.
+
+    :param versions: A dict mapping the names of the available packages to
+        their versions.
+    :param provided: The set of virtual packages provided by them.
+    """
+    from debian.debian_support import version_compare
+    for option in options:
+        name = option['name']
+        if option['version'] is None:
+            if name in versions or name in provided:
+                return True
+        elif name in versions:
+            relation, version = option['version']
+            if _RELATION_CHECKS[relation](
+                    version_compare(versions[name], version)):
+                return True
+    return False
+
+
+def _get_provided(stanzas):
+    provided = set()
+    for stanza in stanzas:
+        if 'Provides' in stanza:
+            provided.update(
+                name.strip().split(' ')[0]
+                for name in stanza['Provides'].split(','))
+    return provided
+
+
+def _format_options(options):
+    return ' | '.join(option['name'] for option in options)
+
+
+def read_manifest(hwpack_dir):
+    """Return the list of name=version lines of the hwpack's manifest.
+
+    :raises NotInstallableOnHost: If the hwpack has to be installed by
+        linaro-hwpack-install.
+    """
+    with open(os.path.join(hwpack_dir, 'FORMAT')) as fd:
+        hwpack_format = fd.read().strip()
+    if hwpack_format not in SUPPORTED_FORMATS:
+        raise NotInstallableOnHost(
+            "unsupported hwpack format %s" % hwpack_format)
+    gpg_dir = os.path.join(hwpack_dir, 'sources.list.d.gpg')
+    if os.path.isdir(gpg_dir) and os.listdir(gpg_dir):
+        raise NotInstallableOnHost("its apt sources have keys to install")
+    with open(os.path.join(hwpack_dir, 'manifest')) as fd:
+        return [line.strip() for line in fd if line.strip()]
+
+
+def _get_candidate(line, packages, stanzas, architecture):
+    """Return the package of the manifest line to install from the host.
+
+    Returns None if it's installed already.
+
+    :raises NotInstallableOnHost: If the package has to be installed by
+        linaro-hwpack-install.
+    """
+    if line not in packages:
+        raise NotInstallableOnHost("%s is not in the hwpack" % line)
+    package = packages[line]
+    if package.architecture not in ('all', architecture):
+        raise NotInstallableOnHost(
+            "%s is for %s" % (package.name, package.architecture))
+    stanza = stanzas.get(package.name)
+    if stanza is not None:
+        if _is_installed(stanza) and stanza['Version'] == package.version:
+            return None
+        raise NotInstallableOnHost(
+            "another version of %s is in the rootfs" % package.name)
+    if package.maintainer_scripts:
+        raise NotInstallableOnHost("%s has maintainer scripts (%s)" % (
+            package.name, ', '.join(package.maintainer_scripts)))
+    return package
+
+
+def _check_relations(package, versions, provided):
+    """Check the dependencies and conflicts of the package.
+
+    :param versions: A dict mapping the names of the packages installed
+        once the package is to their versions.
+    :param provided: The set of virtual packages provided by them.
+    :raises NotInstallableOnHost: If they're not satisfied.
+    """
+    for options in package.get_relations('Pre-Depends', 'Depends'):
+        if not _is_satisfied(options, versions, provided):
+            raise NotInstallableOnHost(
+                "the dependency of %s on %s is not in the rootfs" % (
+                    package.name, _format_options(options)))
+    others = dict(
+        (name, version) for name, version in versions.items()
+        if name != package.name)
+    for options in package.get_relations('Conflicts', 'Breaks'):
+        if _is_satisfied(options, others, set()):
+            raise NotInstallableOnHost("%s conflicts with %s" % (
+                package.name, _format_options(options)))
+
+
+def _resolve(candidates, installed, left):
+    """Return the candidates whose relations are satisfied.
+
+    A candidate depending on one which isn't installed from the host isn't
+    either, until all those left are satisfied.
+
+    :param installed: The status stanzas of the installed packages.
+    :param left: A list to append the reason each candidate left out is
+        left to linaro-hwpack-install to.
+    """
+    while True:
+        versions = dict(
+            (stanza['Package'], stanza['Version']) for stanza in installed)
+        versions.update(
+            (package.name, package.version) for package in candidates)
+        provided = _get_provided(
+            installed + [package.control for package in candidates])
+        resolved = []
+        for package in candidates:
+            try:
+                _check_relations(package, versions, provided)
+            except NotInstallableOnHost, e:
+                left.append(str(e))
+            else:
+                resolved.append(package)
+        if len(resolved) == len(candidates):
+            return resolved
+        candidates = resolved
+
+
+def _read_owners(rootfs_dir):
+    """Return a dict mapping the paths of the installed files to a package.
+    """
+    owners = {}
+    info_dir = os.path.join(rootfs_dir, DPKG_INFO_DIR)
+    if not os.path.isdir(info_dir):
+        return owners
+    for name in os.listdir(info_dir):
+        if name.endswith('.list'):
+            package = name[:-len('.list')].split(':')[0]
+            with open(os.path.join(info_dir, name)) as fd:
+                for line in fd:
+                    owners[line.rstrip('\n')] = package
+    return owners
+
+
+def _read_diversions(rootfs_dir):
+    """Return a dict mapping the diverted paths to the diverting package.
+
+    The package is ':' for a local diversion.
+    """
+    path = os.path.join(rootfs_dir, DPKG_DIVERSIONS_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as fd:
+        lines = fd.read().splitlines()
+    # Each diversion is a diverted path, where it's diverted to and the
+    # diverting package, one per line.
+    return dict(
+        (lines[i], lines[i + 2]) for i in range(0, len(lines) - 2, 3))
+
+
+def _read_trigger_interests(rootfs_dir):
+    """Return the (path, package) of each file trigger of the rootfs."""
+    interests = []
+    info_dir = os.path.join(rootfs_dir, DPKG_INFO_DIR)
+    if not os.path.isdir(info_dir):
+        return interests
+    for name in sorted(os.listdir(info_dir)):
+        if name.endswith('.triggers'):
+            package = name[:-len('.triggers')].split(':')[0]
+            with open(os.path.join(info_dir, name)) as fd:
+                for line in fd:
+                    fields = line.split('#')[0].split()
+                    if (len(fields) == 2 and fields[0] in TRIGGER_INTERESTS and
+                            fields[1].startswith('/')):
+                        interests.append((fields[1].rstrip('/'), package))
+    return interests
+
+
+def _list_contents(package, path_filter):
+    """Return the (path, is_dir) of each file of the package to unpack.
+
+    The paths are absolute, as listed by dpkg, and those left out by
+    path_filter aren't returned.
+    """
+    proc = cmd_runner.run(
+        ['dpkg-deb', '--fsys-tarfile', package.path], stdout=subprocess.PIPE)
+    contents = []
+    tar = tarfile.open(fileobj=proc.stdout, mode='r|')
+    for member in tar:
+        path = _get_dpkg_path(member.name)
+        if (member.isdir() or path_filter is None or
+                path_filter.is_included(path)):
+            contents.append((path, member.isdir()))
+    tar.close()
+    proc.stdout.close()
+    proc.wait()
+    return contents
+
+
+def _check_contents(package, contents, owners, diversions, interests):
+    """Check that dpkg would just unpack the files of the package.
+
+    :param contents: The package's files, as returned by _list_contents().
+    :param owners: As returned by _read_owners().
+    :param diversions: As returned by _read_diversions().
+    :param interests: As returned by _read_trigger_interests().
+    :raises NotInstallableOnHost: If a file belongs to another package, is
+        diverted or triggers a package.
+    """
+    for path, is_dir in contents:
+        if is_dir:
+            continue
+        owner = owners.get(path, package.name)
+        if owner != package.name:
+            raise NotInstallableOnHost(
+                "%s of %s belongs to %s" % (path, package.name, owner))
+        if diversions.get(path, package.name) != package.name:
+            raise NotInstallableOnHost(
+                "%s of %s is diverted" % (path, package.name))
+        for interest, interested in interests:
+            if path == interest or path.startswith(interest + '/'):
+                raise NotInstallableOnHost("%s of %s triggers %s" % (
+                    path, package.name, interested))
+
+
+def plan_install(hwpack_dir, manifest, architecture, status, rootfs_dir,
+                 path_filter=None):
+    """Return the packages of the extracted hwpack to unpack in the rootfs.
+
+    The packages already installed at the version in the hwpack are left
+    out, as are those which have to be installed by linaro-hwpack-install.
+
+    :param manifest: The lines of the hwpack's manifest.
+    :param architecture: The dpkg architecture of the rootfs.
+    :param status: The stanzas of the dpkg status file of the rootfs.
+    :param path_filter: The PathFilter installed in the rootfs, or None.
+    :return: A (packages, left) tuple, left being the reason each of the
+        other packages is left to linaro-hwpack-install.
+    """
+    pkgs_dir = os.path.join(hwpack_dir, 'pkgs')
+    packages = {}
+    for filename in sorted(os.listdir(pkgs_dir)):
+        if filename.endswith('.deb'):
+            package = _Package(os.path.join(pkgs_dir, filename))
+            packages['%s=%s' % (package.name, package.version)] = package
+    stanzas = dict((stanza['Package'], stanza) for stanza in status)
+    installed = [stanza for stanza in status if _is_installed(stanza)]
+    left = []
+    candidates = []
+    for line in manifest:
+        try:
+            package = _get_candidate(line, packages, stanzas, architecture)
+        except NotInstallableOnHost, e:
+            left.append(str(e))
+            continue
+        if package is not None:
+            candidates.append(package)
+    candidates = _resolve(candidates, installed, left)
+    if not candidates:
+        return candidates, left
+
+    # Only the files of the packages which could be installed are looked
+    # at, as that means reading all of them.
+    owners = _read_owners(rootfs_dir)
+    diversions = _read_diversions(rootfs_dir)
+    interests = _read_trigger_interests(rootfs_dir)
+    checked = []
+    for package in candidates:
+        contents = _list_contents(package, path_filter)
+        try:
+            _check_contents(package, contents, owners, diversions, interests)
+        except NotInstallableOnHost, e:
+            left.append(str(e))
+            continue
+        checked.append(package)
+        # No two packages of the hwpack may have the same file either.
+        owners.update(
+            (path, package.name) for path, is_dir in contents if not is_dir)
+    if len(checked) < len(candidates):
+        checked = _resolve(checked, installed, left)
+    return checked, left
+
+
+def _get_dpkg_path(name):
+    """Return the path dpkg lists for the data tarball member name."""
+    if name.startswith('./'):
+        name = name[2:]
+    return '/' + (name.strip('/') or '.')
+
+
+def _unpack(package, rootfs_dir, path_filter):
+    """Unpack the files of the package in rootfs_dir.
+
+    :return: The absolute paths unpacked, as listed by dpkg.
+    """
+    data = cmd_runner.run(
+        ['dpkg-deb', '--fsys-tarfile', package.path], stdout=subprocess.PIPE)
+    # Like dpkg, follow the symlinks to directories of the rootfs (e.g.
+    # /var/run -> /run) rather than replacing them with directories.
+    tar = cmd_runner.run(
+        ['tar', '-x', '-p', '--numeric-owner', '--keep-directory-symlink',
+         '-f', '-', '-C', rootfs_dir],
+        stdin=subprocess.PIPE, as_root=True)
+    names = []
+    try:
+        filter_tarball(data.stdout, tar.stdin, path_filter, kept=names)
+    except:
+        exc_info = sys.exc_info()
+        data.stdout.close()
+        tar.stdin.close()
+        # Their failure is most likely caused by this one, which is the one
+        # worth reporting.
+        for proc in (data, tar):
+            proc.except_on_cmd_fail = False
+            proc.wait()
+        raise exc_info[0], exc_info[1], exc_info[2]
+    data.stdout.close()
+    tar.stdin.close()
+    data.wait()
+    tar.wait()
+    return [_get_dpkg_path(name) for name in names]
+
+
+def _get_md5sum(package, rootfs_dir, path):
+    for line in package.control_files.get('md5sums', '').splitlines():
+        md5sum, _, name = line.partition(' ')
+        if '/' + name.strip() == path:
+            return md5sum
+    with open(os.path.join(rootfs_dir, path.lstrip('/'))) as fd:
+        return hashlib.md5(fd.read()).hexdigest()
+
+
+def _make_status_stanza(package, rootfs_dir):
+    """Return the dpkg status stanza of the package once installed."""
+    from debian.deb822 import Deb822
+    stanza = Deb822()
+    for field, value in package.control.items():
+        stanza[field] = value
+        if field == 'Package':
+            stanza['Status'] = 'install ok installed'
+    conffiles = package.control_files.get('conffiles', '').split()
+    if conffiles:
+        stanza['Conffiles'] = ''.join(
+            '\n %s %s' % (path, _get_md5sum(package, rootfs_dir, path))
+            for path in conffiles)
+    return stanza.dump().encode('utf-8')
+
+
+def _append_stanzas(path, stanzas):
+    data = ''
+    if os.path.exists(path):
+        data = open(path).read().rstrip('\n')
+    if data:
+        data += '\n\n'
+    write_data_to_protected_file(path, data + '\n'.join(stanzas))
+
+
+def _get_new_sources(hwpack_dir, rootfs_dir):
+    """Return the apt sources of the hwpack which the rootfs doesn't have.
+
+    :return: A dict mapping the paths of sources.list files to add to the
+        rootfs to their contents, named as linaro-hwpack-install does.
+    """
+    existing = []
+    paths = [os.path.join(rootfs_dir, APT_SOURCES_LIST)]
+    sources_dir = os.path.join(rootfs_dir, APT_SOURCES_LIST_DIR)
+    if os.path.isdir(sources_dir):
+        paths.extend(
+            os.path.join(sources_dir, name)
+            for name in sorted(os.listdir(sources_dir))
+            if name.endswith('.list'))
+    for path in paths:
+        if os.path.exists(path):
+            existing.extend(line.strip() for line in open(path))
+    new_sources = {}
+    hwpack_sources_dir = os.path.join(hwpack_dir, 'sources.list.d')
+    if not os.path.isdir(hwpack_sources_dir):
+        return new_sources
+    for name in sorted(os.listdir(hwpack_sources_dir)):
+        data = open(os.path.join(hwpack_sources_dir, name)).read()
+        lines = [line.strip() for line in data.splitlines() if line.strip()]
+        if [line for line in lines if line not in existing]:
+            new_sources[os.path.join(sources_dir, 'hwpack.' + name)] = data
+    return new_sources
+
+
+def _get_path_filter(rootfs_dir):
+    """Return the PathFilter installed in rootfs_dir, or None."""
+    path = os.path.join(rootfs_dir, DPKG_CONFIG_FILE)
+    if not os.path.exists(path):
+        return None
+    return PathFilter.from_file(path)
+
+
+def _check_architecture(status, architecture):
+    """Check that the rootfs with the given dpkg status is for architecture.
+    """
+    architectures = [
+        stanza.get('Architecture') for stanza in status
+        if stanza['Package'] == 'dpkg' and _is_installed(stanza)]
+    if architectures != [architecture]:
+        raise NotInstallableOnHost(
+            "it is for %s and the rootfs for %s" % (
+                architecture, ', '.join(architectures) or 'nothing'))
+
+
+def install_hwpack_on_host(rootfs_dir, hwpack_dir, name, version,
+                           architecture):
+    """Install the extracted hwpack in rootfs_dir, from the host.
+
+    :return: The reason each package of the hwpack which has to be
+        installed by linaro-hwpack-install is left to it; an empty list if
+        the hwpack is installed.
+    :raises NotInstallableOnHost: If the whole hwpack has to be installed by
+        linaro-hwpack-install; nothing was changed in rootfs_dir then.
+    """
+    status = _read_status(rootfs_dir)
+    _check_architecture(status, architecture)
+    manifest = read_manifest(hwpack_dir)
+    path_filter = _get_path_filter(rootfs_dir)
+    to_install, left = plan_install(
+        hwpack_dir, manifest, architecture, status, rootfs_dir, path_filter)
+    if not to_install:
+        return left
+    lists = {}
+    for package in to_install:
+        logger.info("Unpacking %s %s" % (package.name, package.version))
+        lists[package.name] = _unpack(package, rootfs_dir, path_filter)
+
+    info_dir = os.path.join(rootfs_dir, DPKG_INFO_DIR)
+    dependency_package = 'hwpack-%s' % name
+    with protected_file_edits():
+        for package in to_install:
+            info_path = os.path.join(info_dir, package.info_name)
+            write_data_to_protected_file(
+                info_path + '.list',
+                ''.join(path + '\n' for path in lists[package.name]))
+            for control_file, data in package.control_files.items():
+                if control_file != 'control':
+                    write_data_to_protected_file(
+                        '%s.%s' % (info_path, control_file), data)
+        _append_stanzas(
+            os.path.join(rootfs_dir, DPKG_STATUS_FILE),
+            [_make_status_stanza(package, rootfs_dir)
+             for package in to_install])
+        # As linaro-hwpack-install does, the packages the hwpack's
+        # dependency package pulls in are marked as automatically installed.
+        if '%s=%s' % (dependency_package, version) in manifest:
+            auto = [package for package in to_install
+                    if package.name != dependency_package]
+            if auto:
+                _append_stanzas(
+                    os.path.join(rootfs_dir, APT_EXTENDED_STATES_FILE),
+                    ['Package: %s\nArchitecture: %s\nAuto-Installed: 1\n' % (
+                        package.name, architecture) for package in auto])
+        for path, data in _get_new_sources(hwpack_dir, rootfs_dir).items():
+            write_data_to_protected_file(path, data)
+    return left
+
+
+def install_hwpacks_on_host(rootfs_dir, tmp_dir, hwpack_files):
+    """Install the hwpacks in rootfs_dir from the host, as far as possible.
+
+    They are installed in order, until one can't be entirely installed this
+    way.
+
+    :return: The list of the hwpacks left for linaro-hwpack-install, to be
+        run with --skip-installed: the first which couldn't be entirely
+        installed from the host and the following ones, which may depend on
+        it.
+    """
+    for i, hwpack_file in enumerate(hwpack_files):
+        hwpack_basename = os.path.basename(hwpack_file)
+        with HardwarepackHandler([hwpack_file]) as hwpack:
+            version, _ = hwpack.get_field("version")
+            architecture, _ = hwpack.get_field("architecture")
+            name, _ = hwpack.get_field("name")
+        try:
+            # Checked before the hwpack is extracted, for nothing then.
+            _check_architecture(_read_status(rootfs_dir), architecture)
+        except NotInstallableOnHost, e:
+            logger.info(
+                "Installing %s with linaro-hwpack-install, as %s." % (
+                    hwpack_basename, e))
+            return hwpack_files[i:]
+        hwpack_dir = tempfile.mkdtemp(dir=tmp_dir)
+        try:
+            tar = tarfile.open(hwpack_file, mode='r:gz')
+            tar.extractall(hwpack_dir)
+            tar.close()
+            left = install_hwpack_on_host(
+                rootfs_dir, hwpack_dir, name, version, architecture)
+        except NotInstallableOnHost, e:
+            logger.info(
+                "Installing %s with linaro-hwpack-install, as %s." % (
+                    hwpack_basename, e))
+            return hwpack_files[i:]
+        finally:
+            shutil.rmtree(hwpack_dir)
+        if left:
+            logger.info(
+                "Installing the rest of %s with linaro-hwpack-install, "
+                "as %s." % (hwpack_basename, '; '.join(left)))
+            return hwpack_files[i:]
+        logger.info("Installed %s from the host." % hwpack_basename)
+    return []
@@ -0,0 +1,242 @@
+# Copyright (C) 2012 Linaro
+#
+# This file is part of Linaro Image Tools.
+#
+# Linaro Image Tools is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Linaro Image Tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Linaro Image Tools.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Write MBR partition tables without sfdisk.
+
+The layout is given as the sfdisk commands returned by the boards'
+get_sfdisk_cmd(), one "start,size,id,bootable" line per partition in
+sectors, and laid out the way sfdisk -uS does: the first four lines are the
+primary partitions, the following ones the logical partitions of the
+extended partition.  Each logical partition is preceded by an extended boot
+record (EBR); when there is no room for it before the start given for the
+partition, the partition is shifted by one track to make room for it.
+
+Only regular files can be partitioned this way, as a block device's
+partition table has to be re-read by the kernel.
+"""
+
+import os
+import struct
+
+SECTOR_SIZE = 512
+MBR_PARTITION_TABLE_OFFSET = 446
+MBR_SIGNATURE = '\x55\xaa'
+# The partition ids sfdisk accepts as letters.
+PARTITION_IDS = {
+    'L': 0x83,
+    'S': 0x82,
+    'E': 0x05,
+    'X': 0x85,
+}
+EXTENDED_PARTITION_IDS = [0x05, 0x0f, 0x85]
+BOOTABLE = 0x80
+
+
+class Partition(object):
+    """A partition of an MBR partition table.
+
+    The start and size are in sectors.
+    """
+
+    def __init__(self, number, start, size, partition_id, bootable=False):
+        self.number = number
+        self.start = start
+        self.size = size
+        self.partition_id = partition_id
+        self.bootable = bootable
+        # The sector of the EBR describing a logical partition.
+        self.ebr = None
+
+    @property
+    def end(self):
+        return self.start + self.size - 1
+
+    @property
+    def is_extended(self):
+        return self.partition_id in EXTENDED_PARTITION_IDS
+
+    def __repr__(self):
+        return '<Partition %d: %d+%d 0x%02x>' % (
+            self.number, self.start, self.size, self.partition_id)
+
+
+def _parse_partition_id(value):
+    if value == '':
+        return PARTITION_IDS['L']
+    if value.upper() in PARTITION_IDS:
+        return PARTITION_IDS[value.upper()]
+    return int(value, 16)
+
+
+def _parse_line(line):
+    """Return the start, size, id and bootable flag given on the line.
+
+    The start and size are None when not given.
+    """
+    fields = [field.strip() for field in line.split(',')]
+    fields.extend([''] * (4 - len(fields)))
+    if len(fields) > 4:
+        raise ValueError("Invalid sfdisk command: %r" % line)
+    start, size, partition_id, bootable = fields
+    if start in ('', '-'):
+        start = None
+    else:
+        start = int(start)
+    if size in ('', '-'):
+        size = None
+    else:
+        size = int(size)
+    if bootable not in ('', '-', '*'):
+        raise ValueError("Invalid sfdisk command: %r" % line)
+    return start, size, _parse_partition_id(partition_id), bootable == '*'
+
+
+def parse_sfdisk_commands(commands, disk_size, sectors):
+    """Lay out the partitions described by the given sfdisk commands.
+
+    :param commands: A string of sfdisk commands, one per line, in sectors.
+    :param disk_size: The size of the disk, in sectors.
+    :param sectors: The number of sectors per track, by which a logical
+        partition is shifted when its EBR has to go where it starts.
+    :return: The list of Partitions, numbered like the kernel does: primary
+        partitions 1 to 4, then the logical ones from 5.
+    """
+    lines = [line for line in commands.splitlines() if line.strip()]
+    primaries = []
+    logicals = []
+    extended = None
+    for i, line in enumerate(lines):
+        start, size, partition_id, bootable = _parse_line(line)
+        if i < 4:
+            if start is None:
+                start = max([p.end + 1 for p in primaries] + [1])
+            if size is None:
+                size = disk_size - start
+            partition = Partition(i + 1, start, size, partition_id, bootable)
+            if partition.is_extended:
+                if extended is not None:
+                    raise ValueError("Only one extended partition is allowed")
+                extended = partition
+            primaries.append(partition)
+            continue
+        if extended is None:
+            raise ValueError(
+                "Logical partitions need an extended partition: %r" % line)
+        if logicals:
+            ebr = logicals[-1].end + 1
+        else:
+            ebr = extended.start
+        if start is None:
+            start = ebr
+        if start < ebr:
+            raise ValueError(
+                "Partition overlaps the previous one: %r" % line)
+        if size is None:
+            size = extended.end + 1 - start
+        if start == ebr:
+            # No room for the EBR before the partition, so it's moved.
+            start += sectors
+            size -= sectors
+        partition = Partition(
+            5 + len(logicals), start, size, partition_id, bootable)
+        partition.ebr = ebr
+        logicals.append(partition)
+    for partition in primaries + logicals:
+        if partition.size <= 0 or partition.end >= disk_size:
+            raise ValueError("Partition %d doesn't fit on the disk" % (
+                partition.number))
+        if partition.ebr is not None and partition.end > extended.end:
+            raise ValueError(
+                "Partition %d doesn't fit in the extended partition" % (
+                    partition.number))
+    return primaries + logicals
+
+
+def _chs(lba, heads, sectors):
+    cylinder = lba / (heads * sectors)
+    if cylinder > 1023:
+        # What can't be addressed in CHS gets the largest address there is.
+        return '\xfe\xff\xff'
+    head = (lba / sectors) % heads
+    sector = lba % sectors + 1
+    return struct.pack(
+        '<BBB', head, sector | ((cylinder >> 2) & 0xc0), cylinder & 0xff)
+
+
+def _pack_entry(start, size, partition_id, bootable, heads, sectors,
+                relative_to=0):
+    """Return the 16 bytes of a partition table entry.
+
+    :param relative_to: The sector the LBA start is relative to; the CHS
+        addresses are always absolute.
+    """
+    status = 0
+    if bootable:
+        status = BOOTABLE
+    return (struct.pack('<B', status) +
+            _chs(start, heads, sectors) +
+            struct.pack('<B', partition_id) +
+            _chs(start + size - 1, heads, sectors) +
+            struct.pack('<II', start - relative_to, size))
+
+
+def _pack_table(entries):
+    entries = entries + ['\0' * 16] * (4 - len(entries))
+    return ''.join(entries) + MBR_SIGNATURE
+
+
+def write_partition_table(path, commands, heads, sectors, disk_size=None):
+    """Partition the file at path as sfdisk would given the commands.
+
+    The boot code in the first sector is left as it is.
+
+    :param heads: The number of heads of the disk geometry, used for the
+        CHS addresses.
+    :param sectors: The number of sectors per track of the disk geometry.
+    :param disk_size: The size of the disk, in sectors; defaults to the size
+        of the file.
+    :return: The list of Partitions written.
+    """
+    if disk_size is None:
+        disk_size = os.path.getsize(path) / SECTOR_SIZE
+    partitions = parse_sfdisk_commands(commands, disk_size, sectors)
+    primaries = [p for p in partitions if p.ebr is None]
+    logicals = [p for p in partitions if p.ebr is not None]
+    extended = [p for p in primaries if p.is_extended]
+    with open(path, 'r+b') as fd:
+        fd.seek(MBR_PARTITION_TABLE_OFFSET)
+        fd.write(_pack_table([
+            _pack_entry(p.start, p.size, p.partition_id, p.bootable, heads,
+                        sectors)
+            for p in primaries]))
+        for i, partition in enumerate(logicals):
+            entries = [_pack_entry(
+                partition.start, partition.size, partition.partition_id,
+                partition.bootable, heads, sectors,
+                relative_to=partition.ebr)]
+            if i + 1 < len(logicals):
+                # The link to the next EBR, relative to the extended
+                # partition.
+                next_partition = logicals[i + 1]
+                entries.append(_pack_entry(
+                    next_partition.ebr,
+                    next_partition.end + 1 - next_partition.ebr,
+                    PARTITION_IDS['E'], False, heads, sectors,
+                    relative_to=extended[0].start))
+            fd.seek(partition.ebr * SECTOR_SIZE)
+            fd.write('\0' * MBR_PARTITION_TABLE_OFFSET + _pack_table(entries))
+    return partitions
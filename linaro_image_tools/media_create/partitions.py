@@ -20,21 +20,17 @@
 from contextlib import contextmanager
 from math import ceil
 import atexit
-import dbus
 import glob
 import logging
+import os
 import re
 import subprocess
+import sys
+import tempfile
 import time
 
-from parted import (
-    Device,
-    Disk,
-    PARTITION_NORMAL,
-    PARTITION_EXTENDED,
-)
-
-from linaro_image_tools import cmd_runner
+from linaro_image_tools import cmd_runner, profiling
+from linaro_image_tools.media_create.mbr import write_partition_table
 
 logger = logging.getLogger(__name__)
 
@@ -44,9 +40,26 @@ SECTOR_SIZE = 512  # bytes
 CYLINDER_SIZE = HEADS * SECTORS * SECTOR_SIZE
 DBUS_PROPERTIES = 'org.freedesktop.DBus.Properties'
 UDISKS = "org.freedesktop.UDisks"
+SYS_CLASS_BLOCK = '/sys/class/block'
+# How long, in seconds, to wait for udev to create the device files of new
+# partitions.
+UDEV_SETTLE_TIMEOUT = 10
 # Max number of attempts to sleep (total sleep time in seconds =
 # 1+2+...+MAX_TTS)
 MAX_TTS = 10
+# How often and for how long, in seconds, wait_partition_to_settle() tries
+# to read the partition table.
+PARTITION_SETTLE_POLL_INTERVAL = 0.2
+PARTITION_SETTLE_TIMEOUT = 30
+# The --format-profile choices: "default" runs mkfs with its defaults,
+# "fast-image" skips the work mkfs would waste on an image file and "sdcard"
+# runs blkdiscard on each partition of a block device before formatting it,
+# so that the card knows its blocks are free.
+FORMAT_PROFILES = ['default', 'fast-image', 'sdcard']
+EXT_FILESYSTEMS = ['ext2', 'ext3', 'ext4']
+# The size of the journal of the filesystems formatted with the fast-image
+# profile, in MiB.
+FAST_IMAGE_JOURNAL_SIZE = 16
 # Image size should be a multiple of 1MiB, expressed in bytes. This is also
 # the minimum image size possible.
 ROUND_IMAGE_TO = 2 ** 20
@@ -55,7 +68,8 @@ MIN_IMAGE_SIZE = ROUND_IMAGE_TO
 
 def setup_android_partitions(board_config, media, image_size, bootfs_label,
                              should_create_partitions,
-                             should_align_boot_part=False):
+                             should_align_boot_part=False, mkfs_jobs=1,
+                             format_profile='default'):
     cylinders = None
     if not media.is_block_device:
         image_size_in_bytes = get_partition_size_in_bytes(image_size)
@@ -87,26 +101,26 @@ def setup_android_partitions(board_config, media, image_size, bootfs_label,
         data = partitions[3]
         sdcard = partitions[4]
 
-    print "\nFormating boot partition\n"
-    proc = cmd_runner.run(
-        ['mkfs.vfat', '-F', str(board_config.fat_size), bootfs, '-n',
-         bootfs_label],
-        as_root=True)
-    proc.wait()
-
+    mkfs_commands = [
+        ('boot partition',
+         ['mkfs.vfat', '-F', str(board_config.fat_size), bootfs, '-n',
+          bootfs_label])]
     ext4_partitions = {"system": system, "cache": cache, "userdata": data}
+    mkfs_options = get_mkfs_options('ext4', format_profile)
     for label, dev in ext4_partitions.iteritems():
         mkfs = 'mkfs.%s' % "ext4"
-        proc = cmd_runner.run(
-            [mkfs, dev, '-L', label],
-            as_root=True)
-        proc.wait()
-
-    proc = cmd_runner.run(
-        ['mkfs.vfat', '-F32', sdcard, '-n',
-         "sdcard"],
-        as_root=True)
-    proc.wait()
+        mkfs_commands.append(
+            ('%s partition' % label,
+             [mkfs] + mkfs_options + [dev, '-L', label]))
+    mkfs_commands.append(
+        ('sdcard partition',
+         ['mkfs.vfat', '-F32', sdcard, '-n', "sdcard"]))
+    discarded = None
+    if format_profile == 'sdcard' and media.is_block_device:
+        discarded = discard_partitions(
+            [bootfs, system, cache, data, sdcard])
+    record_format_profile(format_profile, {'ext4': mkfs_options}, discarded)
+    format_partitions(mkfs_commands, mkfs_jobs)
 
     return bootfs, system, cache, data, sdcard
 
@@ -118,7 +132,8 @@ def setup_android_partitions(board_config, media, image_size, bootfs_label,
 def setup_partitions(board_config, media, image_size, bootfs_label,
                      rootfs_label, rootfs_type, should_create_partitions,
                      should_format_bootfs, should_format_rootfs,
-                     should_align_boot_part=False):
+                     should_align_boot_part=False, mkfs_jobs=1,
+                     format_profile='default'):
     """Make sure the given device is partitioned to boot the given board.
 
     :param board_config: A BoardConfig class.
@@ -135,6 +150,9 @@ def setup_partitions(board_config, media, image_size, bootfs_label,
     :param should_format_rootfs: Whether to reuse the filesystem on the root
         partition.
     :param should_align_boot_part: Whether to align the boot partition too.
+    :param mkfs_jobs: How many partitions to format at the same time.
+    :param format_profile: One of FORMAT_PROFILES, to pick the mkfs options
+        of the root partition.
     """
     cylinders = None
     if not media.is_block_device:
@@ -162,25 +180,139 @@ def setup_partitions(board_config, media, image_size, bootfs_label,
     else:
         bootfs, rootfs = get_boot_and_root_loopback_devices(media.path)
 
+    mkfs_commands = []
+    formatted = []
     if should_format_bootfs:
-        print "\nFormating boot partition\n"
-        proc = cmd_runner.run(
-            ['mkfs.vfat', '-F', str(board_config.fat_size), bootfs, '-n',
-             bootfs_label],
-            as_root=True)
-        proc.wait()
+        mkfs_commands.append(
+            ('boot partition',
+             ['mkfs.vfat', '-F', str(board_config.fat_size), bootfs, '-n',
+              bootfs_label]))
+        formatted.append(bootfs)
 
+    mkfs_options = {}
     if should_format_rootfs:
-        print "\nFormating root partition\n"
         mkfs = 'mkfs.%s' % rootfs_type
-        proc = cmd_runner.run(
-            [mkfs, rootfs, '-L', rootfs_label],
-            as_root=True)
-        proc.wait()
+        mkfs_options[rootfs_type] = get_mkfs_options(
+            rootfs_type, format_profile)
+        mkfs_commands.append(
+            ('root partition',
+             [mkfs] + mkfs_options[rootfs_type] + [rootfs, '-L',
+                                                   rootfs_label]))
+        formatted.append(rootfs)
+    discarded = None
+    if format_profile == 'sdcard' and media.is_block_device:
+        discarded = discard_partitions(formatted)
+    if mkfs_commands:
+        record_format_profile(format_profile, mkfs_options, discarded)
+    format_partitions(mkfs_commands, mkfs_jobs)
 
     return bootfs, rootfs
 
 
+def get_mkfs_options(fs_type, format_profile='default',
+                     extended_options=()):
+    """Return the extra mkfs options for fs_type with the given profile.
+
+    :param format_profile: One of FORMAT_PROFILES.  With "sdcard", the
+        partition is expected to be discarded by discard_partitions()
+        already, so mkfs doesn't discard it again.
+    :param extended_options: Extended options (-E) to give mkfs.ext* in
+        any case.
+    :return: A list of arguments to mkfs.
+    """
+    extended = list(extended_options)
+    args = []
+    if fs_type in EXT_FILESYSTEMS:
+        if format_profile == 'fast-image':
+            # The inode tables are zeroed by the kernel in the background
+            # once the filesystem is mounted, rather than by mkfs.  The
+            # journal is still zeroed, but kept small: the holes of the
+            # image file aren't written when it's flashed using its block
+            # map, so a journal left as holes would hold whatever was on
+            # the card before.
+            extended.extend(['lazy_itable_init=1', 'nodiscard'])
+            if fs_type != 'ext2':
+                args.extend(['-J', 'size=%d' % FAST_IMAGE_JOURNAL_SIZE])
+        elif format_profile == 'sdcard':
+            extended.append('nodiscard')
+    elif fs_type == 'btrfs':
+        if format_profile in ('fast-image', 'sdcard'):
+            args.append('--nodiscard')
+    if extended:
+        unique = []
+        for option in extended:
+            if option not in unique:
+                unique.append(option)
+        args = ['-E', ','.join(unique)] + args
+    return args
+
+
+def record_format_profile(format_profile, mkfs_options, discarded=None):
+    """Log and record in the profiling report how partitions are formatted.
+
+    :param mkfs_options: A dict of the extra mkfs options of each type of
+        filesystem.
+    :param discarded: The partitions discard_partitions() discarded, if it
+        was run.
+    """
+    logger.debug("Format profile %s, extra mkfs options: %s" % (
+        format_profile, mkfs_options))
+    metadata = {'name': format_profile, 'mkfs_options': mkfs_options}
+    if discarded is not None:
+        metadata['discarded'] = discarded
+    profiling.set_metadata('format_profile', metadata)
+
+
+def discard_partitions(partitions):
+    """Discard the whole of each of the given partitions, as root.
+
+    A partition whose device doesn't support discarding is left alone.
+
+    :return: The partitions that were discarded.
+    """
+    discarded = []
+    with profiling.stage('discard'):
+        for partition in partitions:
+            try:
+                cmd_runner.run(['blkdiscard', partition], as_root=True).wait()
+            except (OSError, cmd_runner.SubcommandNonZeroReturnValue), e:
+                logger.warn("Couldn't discard %s: %s" % (partition, e))
+            else:
+                discarded.append(partition)
+    return discarded
+
+
+def format_partitions(mkfs_commands, mkfs_jobs=1):
+    """Run the given mkfs commands as root, mkfs_jobs of them at a time.
+
+    When more than one runs at a time the output of each is kept apart, and
+    printed once all of them finished.  In any case they are all run even if
+    some fail, and SubcommandNonZeroReturnValue is raised for the first one
+    that failed.
+
+    :param mkfs_commands: A list of (description, args) tuples, the
+        description being what is formatted, e.g. "boot partition".
+    """
+    if mkfs_jobs == 1:
+        for description, args in mkfs_commands:
+            print "\nFormating %s\n" % description
+            with profiling.stage('mkfs'):
+                cmd_runner.run(args, as_root=True).wait()
+        return
+    outputs = [tempfile.TemporaryFile() for _ in mkfs_commands]
+    try:
+        with profiling.stage('mkfs'):
+            cmd_runner.gather(
+                [args for _, args in mkfs_commands],
+                max_concurrency=mkfs_jobs, outputs=outputs, as_root=True)
+    finally:
+        for (description, _), output in zip(mkfs_commands, outputs):
+            print "\nFormating %s\n" % description
+            output.seek(0)
+            sys.stdout.write(output.read())
+            output.close()
+
+
 def umount(path):
     # The old code used to ignore failures here, but I don't think that's
     # desirable so I'm using cmd_runner.run()'s standard behaviour, which will
@@ -239,6 +371,7 @@ def ensure_partition_is_not_mounted(partition):
 
 def is_partition_mounted(partition):
     """Is the given partition mounted?"""
+    import dbus
     device_path = _get_udisks_device_path(partition)
     device = dbus.SystemBus().get_object(UDISKS, device_path)
     return device.Get(
@@ -299,6 +432,7 @@ def calculate_partition_size_and_offset(image_file):
     # Here we can use parted.Device to read the partitions because we're
     # reading from a regular file rather than a block device.  If it was a
     # block device we'd need root rights.
+    from parted import Device, Disk, PARTITION_NORMAL
     disk = Disk(Device(image_file))
     vfat_partition = None
     linux_partition = None
@@ -341,6 +475,7 @@ def calculate_android_partition_size_and_offset(image_file):
     # Here we can use parted.Device to read the partitions because we're
     # reading from a regular file rather than a block device.  If it was a
     # block device we'd need root rights.
+    from parted import Device, Disk, PARTITION_EXTENDED
     vfat_partition = None
     disk = Disk(Device(image_file))
     partition_info = []
@@ -434,9 +569,77 @@ def _get_device_file_for_partition_number(device, partition):
 
     e.g. /dev/sda1 for the first partition on device /dev/sda or
     /dev/mmcblk0p3 for the third partition on /dev/mmcblk0.
+
+    The partitions are looked up in sysfs, falling back to asking UDisks
+    if the device isn't there.
     """
+    device_file = _get_sysfs_device_file_for_partition_number(
+        device, partition)
+    if device_file is not None:
+        return device_file
+    return _get_udisks_device_file_for_partition_number(device, partition)
+
+
+def _get_sysfs_partitions(device):
+    """Return the partitions of device according to sysfs.
+
+    :return: A dict mapping the partition numbers to their device files, or
+        None if device is not in sysfs.
+    """
+    device = os.path.realpath(device)
+    device_dir = os.path.join(SYS_CLASS_BLOCK, os.path.basename(device))
+    if not os.path.isdir(device_dir):
+        return None
+    partitions = {}
+    for entry in os.listdir(device_dir):
+        try:
+            with open(os.path.join(device_dir, entry, 'partition')) as fd:
+                number = int(fd.read())
+        except (IOError, ValueError):
+            # Not a partition.
+            continue
+        partitions[number] = os.path.join(os.path.dirname(device), entry)
+    return partitions
+
+
+def _udev_settle():
+    """Wait for udev to handle the pending events.
+
+    That is, until the device files of the partitions the kernel just found
+    were created.
+    """
+    try:
+        cmd_runner.run(
+            ['udevadm', 'settle', '--timeout=%d' % UDEV_SETTLE_TIMEOUT]).wait()
+    except (OSError, cmd_runner.SubcommandNonZeroReturnValue), e:
+        logger.debug("udevadm settle failed: %s" % e)
+
+
+def _get_sysfs_device_file_for_partition_number(device, partition):
+    """Return the device file for the partition number, as found in sysfs.
+
+    If the partition isn't there, or its device file wasn't created yet, we
+    wait for udev before looking again.
+
+    :return: The device file, or None if it isn't found.
+    """
+    partitions = _get_sysfs_partitions(device)
+    if partitions is None:
+        return None
+    device_file = partitions.get(partition)
+    if device_file is None or not os.path.exists(device_file):
+        _udev_settle()
+        device_file = (_get_sysfs_partitions(device) or {}).get(partition)
+    if device_file is not None and os.path.exists(device_file):
+        return device_file
+    return None
+
+
+def _get_udisks_device_file_for_partition_number(device, partition):
+    """Return the device file for the partition number, asking UDisks."""
     # This could be simpler but UDisks doesn't make it easy for us:
     # https://bugs.freedesktop.org/show_bug.cgi?id=33113.
+    import dbus
     time_to_sleep = 1
     dev_files = glob.glob("%s?*" % device)
     i = 0
@@ -468,6 +671,7 @@ def _get_device_file_for_partition_number(device, partition):
 
 def _get_udisks_device_path(device):
     """Return the UDisks path for the given device."""
+    import dbus
     bus = dbus.SystemBus()
     udisks = dbus.Interface(
         bus.get_object(UDISKS, "/org/freedesktop/UDisks"), UDISKS)
@@ -476,6 +680,7 @@ def _get_udisks_device_path(device):
 
 def _get_udisks_device_file(path, part):
     """Return the UNIX special device file for the given partition."""
+    import dbus
     udisks_dev = dbus.SystemBus().get_object(UDISKS, path)
     part_number = udisks_dev.Get(
         path, 'PartitionNumber', dbus_interface=DBUS_PROPERTIES)
@@ -565,47 +770,67 @@ def create_partitions(board_config, media, heads, sectors, cylinders=None,
         If None the -C argument is not passed.
     :param should_align_boot_part: Whether to align the boot partition too.
     """
-    if media.is_block_device:
-        # Overwrite any existing partition tables with a fresh one.
-        proc = cmd_runner.run(
-            ['parted', '-s', media.path, 'mklabel', 'msdos'], as_root=True)
-        proc.wait()
-
-    wait_partition_to_settle(media)
-
     sfdisk_cmd = board_config.get_sfdisk_cmd(
         should_align_boot_part=should_align_boot_part)
 
+    if not media.is_block_device:
+        # An image file's partition table is just data, which we can write
+        # ourselves rather than wait for sfdisk and the partitions to
+        # settle.
+        disk_size = None
+        if cylinders:
+            disk_size = cylinders * heads * sectors
+        write_partition_table(
+            media.path, sfdisk_cmd, heads, sectors, disk_size)
+        return
+
+    # Overwrite any existing partition tables with a fresh one.
+    proc = cmd_runner.run(
+        ['parted', '-s', media.path, 'mklabel', 'msdos'], as_root=True)
+    proc.wait()
+
+    wait_partition_to_settle(media)
+
     run_sfdisk_commands(sfdisk_cmd, heads, sectors, cylinders, media.path)
 
-    # Sync and sleep to wait for the partition to settle.
+    # Sync and wait for the partition to settle.
     cmd_runner.run(['sync']).wait()
     wait_partition_to_settle(media)
 
 
 def wait_partition_to_settle(media):
-    """Sleep in a loop to wait partition to settle
+    """Wait for the partition table of media to be readable and in use.
+
+    It's read with sfdisk right away, and then every
+    PARTITION_SETTLE_POLL_INTERVAL seconds until that succeeds or
+    PARTITION_SETTLE_TIMEOUT seconds passed.  Reading the table doesn't
+    mean the kernel is done with it, so we then wait for udev to handle
+    the events of the partitions the kernel found.  sfdisk's complaints
+    are kept quiet while polling, and only those of the last attempt are
+    logged.
 
     :param media: A setup_partitions.Media object to partition.
     """
-    tts = 1
-    while (tts > 0) and (tts <= MAX_TTS):
+    attempts = int(PARTITION_SETTLE_TIMEOUT / PARTITION_SETTLE_POLL_INTERVAL)
+    for attempt in range(attempts + 1):
+        if attempt > 0:
+            time.sleep(PARTITION_SETTLE_POLL_INTERVAL)
         try:
-            logger.info("Sleeping for %s second(s) to wait "
-                        "for the partition to settle" % tts)
-            time.sleep(tts)
             proc = cmd_runner.run(
                 ['sfdisk', '-l', media.path],
-                as_root=True, stdout=open('/dev/null', 'w'))
-            proc.wait()
+                as_root=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            proc.communicate()
+            _udev_settle()
             return 0
-        except cmd_runner.SubcommandNonZeroReturnValue:
-            logger.info("Partition table is not available "
-                        "for device %s" % media.path)
-            tts += 1
+        except cmd_runner.SubcommandNonZeroReturnValue, e:
+            if attempt == 0:
+                logger.info("Partition table is not available for device %s "
+                            "yet, waiting for it to settle" % media.path)
     logger.error("Couldn't read partition table "
                  "for a reasonable time for device %s" % media.path)
-    raise
+    if e.stderr:
+        logger.error(e.stderr.rstrip())
+    raise e
 
 
 class Media(object):
@@ -0,0 +1,165 @@
+# Copyright (C) 2012 Linaro
+#
+# This file is part of Linaro Image Tools.
+#
+# Linaro Image Tools is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Linaro Image Tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Linaro Image Tools.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Leave files out of the rootfs, the way dpkg's path-exclude does.
+
+A filter file holds path-exclude=GLOB and path-include=GLOB lines, like the
+files dpkg reads from /etc/dpkg/dpkg.cfg.d, e.g.:
+
+  path-exclude=/usr/share/doc/*
+  path-include=/usr/share/doc/*/copyright
+  path-exclude=/usr/share/man/*
+
+A path is left out if the last rule matching it is a path-exclude.  As with
+dpkg, * matches / too, and directories are always kept.
+"""
+
+import fnmatch
+import os
+import re
+import tarfile
+
+from linaro_image_tools import root_helper
+
+# Where the filter is installed in the rootfs, for dpkg to apply it to the
+# packages installed later on.
+DPKG_CONFIG_FILE = 'etc/dpkg/dpkg.cfg.d/linaro-image-tools-rootfs-filter'
+RULES = {
+    'path-exclude': False,
+    'path-include': True,
+}
+
+
+class PathFilter(object):
+    """An ordered list of path-include and path-exclude rules.
+
+    :param rules: A list of (include, pattern) tuples, include being True
+        for path-include rules.
+    """
+
+    def __init__(self, rules):
+        self.rules = list(rules)
+        self._regexes = [
+            (include, re.compile(fnmatch.translate(pattern)))
+            for include, pattern in self.rules]
+
+    @classmethod
+    def parse(cls, text):
+        """Return the PathFilter with the rules of the given filter file.
+
+        :raises ValueError: If a line is neither a rule, a comment nor blank.
+        """
+        rules = []
+        for line in text.splitlines():
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            name, _, pattern = line.partition('=')
+            if name.strip() not in RULES or not pattern.strip():
+                raise ValueError("Invalid path filter rule: %s" % line)
+            rules.append((RULES[name.strip()], pattern.strip()))
+        return cls(rules)
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path) as fd:
+            return cls.parse(fd.read())
+
+    def is_included(self, path):
+        """Whether the file at the given absolute path is to be kept."""
+        included = True
+        for include, regex in self._regexes:
+            if regex.match(path):
+                included = include
+        return included
+
+    def to_dpkg_config(self):
+        """Return the rules in the format of dpkg's configuration files."""
+        names = dict((include, name) for name, include in RULES.items())
+        return ''.join(
+            '%s=%s\n' % (names[include], pattern)
+            for include, pattern in self.rules)
+
+
+def _get_rootfs_path(name, root):
+    """Return the path in the rootfs of the tarball member with that name.
+
+    Returns None if the member is not under root.
+    """
+    while name.startswith('./'):
+        name = name[2:]
+    name = name.strip('/')
+    if root:
+        if name == root:
+            return '/'
+        if not name.startswith(root + '/'):
+            return None
+        name = name[len(root) + 1:]
+    return '/' + name
+
+
+def filter_tarball(source, dest, path_filter, root='', kept=None):
+    """Copy the tarball read from source to dest, leaving filtered files out.
+
+    Both tarballs are uncompressed and streamed, so that the files left out
+    are never written anywhere.  The members are written in the GNU format.
+
+    :param source: A file object to read the tarball from.
+    :param dest: A file object to write the filtered tarball to.
+    :param path_filter: The PathFilter to apply, or None to keep it all.
+    :param root: The directory inside the tarball holding the rootfs, which
+        the filter's paths are relative to; what's outside it is kept.
+    :param kept: A list to append the names of the members kept to, or None.
+    :return: The number of members left out.
+    """
+    while root.startswith('./'):
+        root = root[2:]
+    root = root.strip('/')
+    tar_in = tarfile.open(fileobj=source, mode='r|')
+    tar_out = tarfile.open(
+        fileobj=dest, mode='w|', format=tarfile.GNU_FORMAT)
+    excluded = set()
+    for member in tar_in:
+        path = _get_rootfs_path(member.name, root)
+        if path is not None and not member.isdir() and (
+                (path_filter is not None and
+                 not path_filter.is_included(path)) or
+                # A hard link to a file left out can't be extracted.
+                (member.islnk() and member.linkname in excluded)):
+            excluded.add(member.name)
+            continue
+        if member.isreg():
+            if member.issparse():
+                # The data read is expanded, holes included.
+                member.type = tarfile.REGTYPE
+            tar_out.addfile(member, tar_in.extractfile(member))
+        else:
+            tar_out.addfile(member)
+        if kept is not None:
+            kept.append(member.name)
+    # Only closed once all of it went through, so that tar doesn't take
+    # the output of a failed filtering for a complete tarball.
+    tar_out.close()
+    tar_in.close()
+    return len(excluded)
+
+
+def install_path_filter(rootfs_dir, path_filter):
+    """Have dpkg apply path_filter to the packages installed in rootfs_dir."""
+    path = os.path.join(rootfs_dir, DPKG_CONFIG_FILE)
+    root_helper.make_dirs(os.path.dirname(path))
+    root_helper.write_file(path, path_filter.to_dpkg_config())
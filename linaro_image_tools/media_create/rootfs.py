@@ -17,14 +17,24 @@
 # You should have received a copy of the GNU General Public License
 # along with Linaro Image Tools.  If not, see <http://www.gnu.org/licenses/>.
 
+from contextlib import contextmanager
+from StringIO import StringIO
 import os
 import subprocess
-import tempfile
+import tarfile
+import threading
+import time
 
-from linaro_image_tools import cmd_runner
+from linaro_image_tools import cmd_runner, root_helper
 
+from linaro_image_tools.media_create.copy_tree import (
+    COPY_JOBS,
+    copy_tree_as_root,
+)
 from linaro_image_tools.media_create.partitions import partition_mounted
 
+_edits = threading.local()
+
 
 def populate_partition(content_dir, root_disk, partition):
     os.makedirs(root_disk)
@@ -51,9 +61,8 @@ def populate_rootfs(content_dir, root_disk, partition, rootfs_type,
       2. Mount the given partition onto the created directory.
       3. Setup an atexit handler to unmount the partition mounted above.
       4. Move the contents of content_dir to that directory.
-      5. If should_create_swap, then create it with the given size.
-      6. Add fstab entries for the / filesystem and swap (if created).
-      7. Create a /etc/flash-kernel.conf containing the target's boot device.
+      5. Call finalize_rootfs() to create the swap file, fstab entries,
+         /etc/flash-kernel.conf and network interfaces.
     """
     print "\nPopulating rootfs partition"
     print "Be patient, this may take a few minutes\n"
@@ -62,28 +71,37 @@ def populate_rootfs(content_dir, root_disk, partition, rootfs_type,
 
     with partition_mounted(partition, root_disk):
         move_contents(content_dir, root_disk)
+        finalize_rootfs(root_disk, rootfs_type, rootfs_id, should_create_swap,
+                        swap_size, mmc_device_id, partition_offset,
+                        board_config)
+
 
-        mount_options = rootfs_mount_options(rootfs_type)
-        fstab_additions = ["%s / %s  %s 0 1" % (
-            rootfs_id, rootfs_type, mount_options)]
-        if should_create_swap:
-            print "\nCreating SWAP File\n"
-            if has_space_left_for_swap(root_disk, swap_size):
-                proc = cmd_runner.run([
-                    'dd',
-                    'if=/dev/zero',
-                    'of=%s/SWAP.swap' % root_disk,
-                    'bs=1M',
-                    'count=%s' % swap_size], as_root=True)
-                proc.wait()
-                proc = cmd_runner.run(
-                    ['mkswap', '%s/SWAP.swap' % root_disk], as_root=True)
-                proc.wait()
-                fstab_additions.append("/SWAP.swap  none  swap  sw  0 0")
-            else:
-                print ("Swap file is bigger than space left on partition; "
-                       "continuing without swap.")
+def finalize_rootfs(root_disk, rootfs_type, rootfs_id, should_create_swap,
+                    swap_size, mmc_device_id, partition_offset,
+                    board_config=None):
+    """Make the necessary tweaks to the rootfs mounted on root_disk.
+
+    This consists of:
+      1. If should_create_swap, then create it with the given size.
+      2. Add fstab entries for the / filesystem and swap (if created).
+      3. Create a /etc/flash-kernel.conf containing the target's boot device.
+      4. Add the board's network interfaces to /etc/network/interfaces.
 
+    The files are all written at once, once they were all changed.
+    """
+    mount_options = rootfs_mount_options(rootfs_type)
+    fstab_additions = ["%s / %s  %s 0 1" % (
+        rootfs_id, rootfs_type, mount_options)]
+    if should_create_swap:
+        print "\nCreating SWAP File\n"
+        if has_space_left_for_swap(root_disk, swap_size):
+            create_swap_file('%s/SWAP.swap' % root_disk, swap_size)
+            fstab_additions.append("/SWAP.swap  none  swap  sw  0 0")
+        else:
+            print ("Swap file is bigger than space left on partition; "
+                   "continuing without swap.")
+
+    with protected_file_edits():
         append_to_fstab(root_disk, fstab_additions)
 
         print "\nCreating /etc/flash-kernel.conf\n"
@@ -95,6 +113,26 @@ def populate_rootfs(content_dir, root_disk, partition, rootfs_type,
             update_network_interfaces(root_disk, board_config)
 
 
+def create_swap_file(path, size_in_mega_bytes):
+    """Create a swap file of the given size at path, as root.
+
+    Its space is allocated with fallocate, without writing anything; only
+    on filesystems not supporting that is it filled with zeros.
+    """
+    try:
+        cmd_runner.run(
+            ['fallocate', '-l', '%sM' % size_in_mega_bytes, path],
+            stderr=subprocess.PIPE, as_root=True).communicate()
+    except cmd_runner.SubcommandNonZeroReturnValue:
+        cmd_runner.run([
+            'dd',
+            'if=/dev/zero',
+            'of=%s' % path,
+            'bs=1M',
+            'count=%s' % size_in_mega_bytes], as_root=True).wait()
+    cmd_runner.run(['mkswap', path], as_root=True).wait()
+
+
 def update_network_interfaces(root_disk, board_config):
     interfaces = []
     if board_config.wired_interfaces is not None:
@@ -142,12 +180,22 @@ def _list_files(directory):
     return stdout.split()
 
 
-def move_contents(from_, root_disk):
+def _is_same_filesystem(path, other_path):
+    return os.stat(path).st_dev == os.stat(other_path).st_dev
+
+
+def move_contents(from_, root_disk, copy_jobs=COPY_JOBS):
     """Move everything under from_ to the given root disk.
 
-    Uses sudo for moving.
+    Uses sudo for moving.  Within a filesystem that's a rename with mv;
+    otherwise the files are copied by copy_jobs threads at a time, with
+    their ownership, modes, extended attributes, hard links and holes, and
+    then removed from from_.
     """
     assert os.path.isdir(from_), "%s is not a directory" % from_
+    if not _is_same_filesystem(from_, root_disk):
+        copy_tree_as_root(from_, root_disk, copy_jobs, remove_source=True)
+        return
     files = _list_files(from_)
     mv_cmd = ['mv']
     mv_cmd.extend(sorted(files))
@@ -176,9 +224,68 @@ def write_data_to_protected_file(path, data):
 
     This is meant to be used when the given file is only writable by root, and
     we overcome that by writing the data to a tempfile and then moving the
-    tempfile on top of the given one using sudo.
+    tempfile on top of the given one using sudo, or by having the root helper
+    write it if it's running.  Within protected_file_edits() the file is
+    only written when the context exits.
+    """
+    files = getattr(_edits, 'files', None)
+    if files is not None:
+        files[os.path.abspath(path)] = data
+        return
+    root_helper.write_file(path, data)
+
+
+def _make_edits_tarball(files):
+    """Return a tarball of the given files, to be extracted in /.
+
+    :param files: A dict mapping absolute paths to their contents.  The
+        files which exist keep their owner and mode; new ones are owned by
+        root, with mode 0644.
+    """
+    tarball = StringIO()
+    tar = tarfile.open(fileobj=tarball, mode='w')
+    for path in sorted(files):
+        data = files[path]
+        info = tarfile.TarInfo(path.lstrip('/'))
+        info.size = len(data)
+        info.mtime = time.time()
+        info.mode = 0644
+        if os.path.exists(path):
+            st = os.stat(path)
+            info.mode = st.st_mode & 07777
+            info.uid, info.gid = st.st_uid, st.st_gid
+        tar.addfile(info, StringIO(data))
+    tar.close()
+    return tarball.getvalue()
+
+
+@contextmanager
+def protected_file_edits():
+    """Write the files changed within this context as root, all at once.
+
+    write_data_to_protected_file() only records what is to be written, and
+    the files are written when the context exits: by a single request to
+    the root helper, if it's running, or else by a single sudo tar.  Nothing
+    is written if an exception is raised.
     """
-    _, tmpfile = tempfile.mkstemp()
-    with open(tmpfile, 'w') as fd:
-        fd.write(data)
-    cmd_runner.run(['mv', '-f', tmpfile, path], as_root=True).wait()
+    if getattr(_edits, 'files', None) is not None:
+        # Already collecting.
+        yield
+        return
+    _edits.files = {}
+    try:
+        yield
+        files = _edits.files
+    finally:
+        _edits.files = None
+    if not files:
+        return
+    if root_helper.is_running():
+        with root_helper.batch():
+            for path in sorted(files):
+                root_helper.write_file(path, files[path])
+        return
+    proc = cmd_runner.run(
+        ['tar', '-x', '-p', '--same-owner', '-f', '-', '-C', '/'],
+        stdin=subprocess.PIPE, as_root=True)
+    proc.communicate(_make_edits_tarball(files))
@@ -0,0 +1,278 @@
+# Copyright (C) 2012 Linaro
+#
+# This file is part of Linaro Image Tools.
+#
+# Linaro Image Tools is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Linaro Image Tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Linaro Image Tools.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A cache of rootfs trees with the hwpacks already installed.
+
+Entries are keyed by the contents of the binary tarball, the hwpacks and the
+linaro-hwpack-install script used to build them, so a given combination of
+those is only unpacked and installed once.  Each entry lives in its own
+directory under the cache directory:
+
+  <key>/tree      the rootfs, owned by root as it would be on the media
+  <key>/size      the size of the tree, in bytes
+  <key>/last-used touched whenever the entry is stored or used
+
+The least recently used entries are evicted once the size of all the trees
+exceeds the size limit of the cache.
+
+Several runs may share a cache: the trees are copied under a lock file in
+the cache directory, shared by the runs copying from the cache and taken
+exclusively to put an entry in place or evict one.  A run which found an
+entry keeps the lock from the lookup until it copied the tree, so that the
+entry can't be evicted in between.
+"""
+
+from contextlib import contextmanager
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+import subprocess
+import tempfile
+
+from linaro_image_tools import cmd_runner
+from linaro_image_tools.__version__ import __version__
+from linaro_image_tools.utils import DEFAULT_LOGGER_NAME
+
+logger = logging.getLogger(DEFAULT_LOGGER_NAME)
+
+# Bump this whenever the way entries are built changes in a way that makes
+# existing entries unusable.
+CACHE_FORMAT_VERSION = 1
+LOCK_FILE = 'lock'
+
+
+def _file_digest(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as fd:
+        while True:
+            data = fd.read(1024 * 1024)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def get_cache_key(binary, hwpacks, hwpack_install_script, extra=()):
+    """Return the key of the rootfs built from the given files.
+
+    :param binary: The path to the binary tarball.
+    :param hwpacks: The paths to the hwpacks, in the order they're installed.
+    :param hwpack_install_script: The path to the linaro-hwpack-install
+        script used to install them.
+    :param extra: Any other strings affecting the contents of the rootfs.
+    """
+    key = hashlib.sha1()
+    key.update('format %d\n' % CACHE_FORMAT_VERSION)
+    key.update('linaro-image-tools %s\n' % __version__)
+    key.update('binary %s\n' % _file_digest(binary))
+    for hwpack in hwpacks:
+        key.update('hwpack %s\n' % _file_digest(hwpack))
+    key.update(
+        'linaro-hwpack-install %s\n' % _file_digest(hwpack_install_script))
+    for item in extra:
+        key.update('extra %s\n' % item)
+    return key.hexdigest()
+
+
+class RootfsCache(object):
+    """A size-bounded LRU cache of rootfs trees.
+
+    :param cache_dir: The directory holding the entries; it's created if
+        needed.
+    :param max_size: The maximum size, in bytes, of all the cached trees.
+    """
+
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_size = max_size
+        # The lock file held since lookup() found an entry.
+        self._lookup_lock = None
+
+    def _lock(self, exclusive=False):
+        """Lock the cache and return the open lock file."""
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        fd = open(os.path.join(self.cache_dir, LOCK_FILE), 'a')
+        try:
+            if exclusive:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            else:
+                fcntl.flock(fd, fcntl.LOCK_SH)
+        except:
+            fd.close()
+            raise
+        return fd
+
+    def _unlock(self, fd):
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        fd.close()
+
+    @contextmanager
+    def _locked(self, exclusive=False):
+        """Hold the lock of the cache within this context."""
+        fd = self._lock(exclusive)
+        try:
+            yield
+        finally:
+            self._unlock(fd)
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def _tree(self, key):
+        return os.path.join(self._entry_dir(key), 'tree')
+
+    def _touch(self, key):
+        open(os.path.join(self._entry_dir(key), 'last-used'), 'w').close()
+
+    def _entry_size(self, key):
+        try:
+            with open(os.path.join(self._entry_dir(key), 'size')) as fd:
+                return int(fd.read())
+        except (IOError, ValueError):
+            return None
+
+    def lookup(self, key):
+        """Return the path to the cached tree for the given key, or None.
+
+        When the entry is found, the cache stays locked against evictions
+        until the tree is copied by copy_to() or clone(), or release() is
+        called.
+        """
+        tree = self._tree(key)
+        fd = self._lock()
+        found = False
+        try:
+            if os.path.isdir(tree) and self._entry_size(key) is not None:
+                self._touch(key)
+                found = True
+        finally:
+            if not found:
+                self._unlock(fd)
+        if not found:
+            return None
+        self.release()
+        self._lookup_lock = fd
+        logger.info("Using cached rootfs %s" % key)
+        return tree
+
+    def release(self):
+        """Release the lock kept since lookup() found an entry, if any."""
+        if self._lookup_lock is not None:
+            self._unlock(self._lookup_lock)
+            self._lookup_lock = None
+
+    def store(self, key, rootfs_dir):
+        """Store a copy of the given rootfs tree under the given key.
+
+        The tree is copied under a temporary name unique to this run, and
+        only renamed into place once complete, so an interrupted run never
+        leaves behind an entry which looks usable.
+        """
+        entry_dir = self._entry_dir(key)
+        with self._locked():
+            if not os.path.isdir(entry_dir):
+                os.makedirs(entry_dir)
+            tmp_dir = tempfile.mkdtemp(prefix='tree.', dir=entry_dir)
+        tmp_tree = os.path.join(tmp_dir, 'tree')
+        logger.info("Storing rootfs in cache as %s" % key)
+        try:
+            cmd_runner.run(
+                ['cp', '-a', rootfs_dir, tmp_tree], as_root=True).wait()
+            proc = cmd_runner.run(
+                ['du', '-sb', tmp_tree], as_root=True, stdout=subprocess.PIPE)
+            du_output, _ = proc.communicate()
+            with self._locked(exclusive=True):
+                cmd_runner.run(
+                    ['rm', '-rf', self._tree(key)], as_root=True).wait()
+                cmd_runner.run(
+                    ['mv', tmp_tree, self._tree(key)], as_root=True).wait()
+                with open(os.path.join(entry_dir, 'size'), 'w') as fd:
+                    fd.write(du_output.split()[0])
+                self._touch(key)
+                self._evict(keep=key)
+        finally:
+            cmd_runner.run(['rm', '-rf', tmp_dir], as_root=True).wait()
+
+    def copy_to(self, key, target_dir):
+        """Copy the contents of the cached tree into target_dir.
+
+        The cached tree itself is left untouched.
+        """
+        tree = self._tree(key)
+        try:
+            with self._locked():
+                cmd_runner.run(
+                    ['cp', '-a', os.path.join(tree, '.'), target_dir],
+                    as_root=True).wait()
+        finally:
+            self.release()
+
+    def clone(self, key, path):
+        """Copy the cached tree to path, which must not exist yet."""
+        try:
+            with self._locked():
+                cmd_runner.run(
+                    ['cp', '-a', self._tree(key), path], as_root=True).wait()
+        finally:
+            self.release()
+
+    def evict(self, keep=None):
+        """Remove the least recently used entries until the cache fits.
+
+        :param keep: A key which must not be evicted, even if the cache
+            doesn't fit without doing so.
+        """
+        with self._locked(exclusive=True):
+            self._evict(keep)
+
+    def _evict(self, keep=None):
+        entries = []
+        total_size = 0
+        for key in os.listdir(self.cache_dir):
+            size = self._entry_size(key)
+            if size is None:
+                continue
+            stamp = os.path.join(self._entry_dir(key), 'last-used')
+            try:
+                last_used = os.path.getmtime(stamp)
+            except OSError:
+                last_used = 0
+            entries.append((last_used, key, size))
+            total_size += size
+        entries.sort()
+        for last_used, key, size in entries:
+            if total_size <= self.max_size:
+                break
+            if key == keep:
+                continue
+            logger.info("Evicting cached rootfs %s" % key)
+            # The entry's directory itself is only removed if no other run
+            # is storing a tree there.
+            entry_dir = self._entry_dir(key)
+            cmd_runner.run(
+                ['rm', '-rf'] + [os.path.join(entry_dir, name)
+                                 for name in ('size', 'last-used', 'tree')],
+                as_root=True).wait()
+            try:
+                os.rmdir(entry_dir)
+            except OSError, e:
+                if e.errno not in (errno.ENOTEMPTY, errno.ENOENT):
+                    raise
+            total_size -= size
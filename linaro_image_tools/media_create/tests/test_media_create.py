@@ -18,26 +18,32 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import atexit
+import errno
+import fcntl
 import glob
+import hashlib
 import os
 import random
+import re
 import string
 import subprocess
 import sys
 import tempfile
 import textwrap
+import threading
 import time
 import types
 import struct
 import tarfile
 import dbus
 import shutil
+import stat
 
 from mock import MagicMock
 from StringIO import StringIO
 from testtools import TestCase
 
-from linaro_image_tools import cmd_runner
+from linaro_image_tools import cmd_runner, profiling, root_helper
 from linaro_image_tools.hwpack.handler import HardwarepackHandler
 from linaro_image_tools.hwpack.packages import PackageMaker
 import linaro_image_tools.media_create
@@ -48,6 +54,20 @@ from linaro_image_tools.media_create import (
     partitions,
     rootfs,
 )
+from linaro_image_tools.media_create import (
+    bmap,
+    copy_tree,
+    flash,
+    host_install,
+    mbr,
+    path_filter,
+    unpack_binary_tarball as unpack_binary_tarball_module,
+)
+from linaro_image_tools.media_create.bmap import (
+    generate_bmap,
+    get_mapped_ranges,
+    write_bmap,
+)
 from linaro_image_tools.media_create.boards import (
     SECTOR_SIZE,
     align_up,
@@ -73,17 +93,33 @@ from linaro_image_tools.media_create.chroot_utils import (
     copy_file,
     install_hwpack,
     install_hwpacks,
+    install_merged_hwpacks,
     install_packages,
     mount_chroot_proc,
     prepare_chroot,
     run_local_atexit_funcs,
     temporarily_overwrite_file_on_dir,
 )
+from linaro_image_tools.media_create.flash import (
+    flash_image,
+    flash_image_to_devices,
+    FlashJob,
+    FlashVerificationError,
+    get_block_device_size,
+    get_write_ranges,
+    write_image,
+)
+from linaro_image_tools.media_create.fs_image import (
+    make_bootfs_image,
+    make_rootfs_image,
+    splice_fs_image,
+)
 from linaro_image_tools.media_create.partitions import (
     HEADS,
     MIN_IMAGE_SIZE,
     Media,
     SECTORS,
+    UDEV_SETTLE_TIMEOUT,
     _check_min_size,
     _get_device_file_for_partition_number,
     _parse_blkid_output,
@@ -104,6 +140,7 @@ from linaro_image_tools.media_create.partitions import (
 from linaro_image_tools.media_create.rootfs import (
     append_to_fstab,
     create_flash_kernel_config,
+    finalize_rootfs,
     has_space_left_for_swap,
     move_contents,
     populate_rootfs,
@@ -111,20 +148,31 @@ from linaro_image_tools.media_create.rootfs import (
     update_network_interfaces,
     write_data_to_protected_file,
 )
+from linaro_image_tools.media_create.rootfs_cache import (
+    get_cache_key,
+    RootfsCache,
+)
 from linaro_image_tools.media_create.tests.fixtures import (
     CreateTarballFixture,
     MockRunSfdiskCommandsFixture,
 )
 from linaro_image_tools.media_create.unpack_binary_tarball import (
+    detect_compression,
+    get_parallel_decompressor,
     unpack_binary_tarball,
 )
 from linaro_image_tools.testing import TestCaseWithFixtures
 from linaro_image_tools.tests.fixtures import (
     CreateTempDirFixture,
+    MockCmdRunnerPopen,
     MockCmdRunnerPopenFixture,
     MockSomethingFixture,
 )
-from linaro_image_tools.utils import find_command, preferred_tools_dir
+from linaro_image_tools.utils import (
+    find_command,
+    preferred_tools_dir,
+    TarballIndex,
+)
 
 from linaro_image_tools.hwpack.testing import ContextManagerFixture
 
@@ -132,6 +180,19 @@ chroot_args = " ".join(cmd_runner.CHROOT_ARGS)
 sudo_args = " ".join(cmd_runner.SUDO_ARGS)
 
 
+def dd_command(input_file, output_file, count=None, seek=None, skip=None):
+    # The dd run by boards._write_blocks() without a root helper; count, seek
+    # and skip are in bytes.
+    command = ('%s dd if=%s of=%s bs=%d conv=notrunc '
+               'iflag=skip_bytes,count_bytes oflag=seek_bytes' % (
+                   sudo_args, input_file, output_file,
+                   root_helper.WRITE_BLOCKS_BUFFER_SIZE))
+    for name, value in [('count', count), ('seek', seek), ('skip', skip)]:
+        if value is not None:
+            command += ' %s=%d' % (name, value)
+    return command
+
+
 class TestHardwarepackHandler(TestCaseWithFixtures):
     def setUp(self):
         super(TestHardwarepackHandler, self).setUp()
@@ -845,8 +906,7 @@ class TestArndaleBootFiles(TestCaseWithFixtures):
             d_img_data=None)
 
         expected_commands = [
-            ('sudo -E dd if=%s of=boot_device_or_file bs=512 conv=notrunc '
-             'seek=1' % bl0_file),
+            dd_command(bl0_file, 'boot_device_or_file', seek=512),
             ('sudo -E mkimage -A arm -O linux -T kernel -C none -a %s -e %s '
              '-n Linux -d %s %s/uImage' % (board_conf.load_addr,
              board_conf.load_addr, k_img_file, self.temp_bootdir_path)),
@@ -858,6 +918,67 @@ class TestArndaleBootFiles(TestCaseWithFixtures):
         shutil.rmtree(self.tempdir)
 
 
+class TestDd(TestCaseWithFixtures):
+
+    def setUp(self):
+        super(TestDd, self).setUp()
+        tempdir = self.useFixture(CreateTempDirFixture()).get_temp_dir()
+        self.input_file = os.path.join(tempdir, 'input')
+        with open(self.input_file, 'w') as fd:
+            fd.write('0123456789' * 205)
+        self.output_file = os.path.join(tempdir, 'output')
+        with open(self.output_file, 'w') as fd:
+            fd.write('x' * 4096)
+
+    def test_dd_without_root(self):
+        self.useFixture(MockSomethingFixture(os, 'getuid', lambda: 1000))
+        fixture = self.useFixture(MockCmdRunnerPopenFixture())
+        boards._dd('input', 'output', block_size=1, count=2, seek=3, skip=4)
+        self.assertEqual(
+            [dd_command('input', 'output', count=2, seek=3, skip=4)],
+            fixture.mock.commands_executed)
+
+    def test_dd_as_root_is_in_process(self):
+        self.useFixture(MockSomethingFixture(os, 'getuid', lambda: 0))
+        fixture = self.useFixture(MockCmdRunnerPopenFixture())
+        boards._dd(self.input_file, self.output_file, count=2, seek=1,
+                   skip=1)
+        self.assertEqual(None, fixture.mock.calls)
+        contents = open(self.output_file).read()
+        self.assertEqual(4096, len(contents))
+        self.assertEqual('x' * 512, contents[:512])
+        self.assertEqual(open(self.input_file).read()[512:1536],
+                         contents[512:1536])
+        self.assertEqual('x' * 2560, contents[1536:])
+
+    def test_dd_as_root_whole_file(self):
+        self.useFixture(MockSomethingFixture(os, 'getuid', lambda: 0))
+        boards._dd(self.input_file, self.output_file, block_size=1, seek=10)
+        contents = open(self.output_file).read()
+        self.assertEqual(
+            'x' * 10 + open(self.input_file).read(), contents[:2060])
+
+    def test_write_blocks_refuses_overlapping_files(self):
+        fixture = self.useFixture(MockCmdRunnerPopenFixture())
+        # input is 2050 bytes long, so it overruns the next 4 sectors.
+        self.assertRaises(
+            AssertionError, boards._write_blocks, self.output_file,
+            [(self.input_file, 512, None, 0, None),
+             ('/dev/zero', 512, 1, 4, None)])
+        self.assertEqual(None, fixture.mock.calls)
+
+    def test_write_blocks_counts_in_bytes(self):
+        self.useFixture(MockSomethingFixture(os, 'getuid', lambda: 1000))
+        fixture = self.useFixture(MockCmdRunnerPopenFixture())
+        boards._write_blocks(
+            'output', [(self.input_file, 512, None, 0, None),
+                       ('/dev/zero', 512, 1, 5, None)])
+        self.assertEqual(
+            [dd_command(self.input_file, 'output', seek=0),
+             dd_command('/dev/zero', 'output', count=512, seek=2560)],
+            fixture.mock.commands_executed)
+
+
 class TestCreateToc(TestCaseWithFixtures):
     ''' Tests boards.SnowballEmmcConfig.create_toc()'''
 
@@ -1075,22 +1196,21 @@ class TestSnowballBootFiles(TestCaseWithFixtures):
             files, "boot_device_or_file",
             self.snowball_config.SNOWBALL_LOADER_START_S)
         expected = [
-            '%s dd if=%s of=boot_device_or_file bs=512 conv=notrunc'
-            ' seek=%s' % (sudo_args, toc_filename,
-            self.snowball_config.SNOWBALL_LOADER_START_S),
-            '%s dd if=%s/boot_image_issw.bin of=boot_device_or_file bs=512'
-            ' conv=notrunc seek=257' % (sudo_args, self.temp_bootdir_path),
-            '%s dd if=%s/boot_image_x-loader.bin of=boot_device_or_file'
-            ' bs=1 conv=notrunc seek=131588'
-            % (sudo_args, self.temp_bootdir_path),
-            '%s dd if=%s/mem_init.bin of=boot_device_or_file bs=512'
-            ' conv=notrunc seek=3072' % (sudo_args, self.temp_bootdir_path),
-            '%s dd if=%s/power_management.bin of=boot_device_or_file bs=512'
-            ' conv=notrunc seek=3200' % (sudo_args, self.temp_bootdir_path),
-            '%s dd if=%s/u-boot.bin of=boot_device_or_file bs=512'
-            ' conv=notrunc seek=24064' % (sudo_args, self.temp_bootdir_path),
-            '%s dd if=%s/u-boot-env.bin of=boot_device_or_file bs=512'
-            ' conv=notrunc seek=25080' % (sudo_args, self.temp_bootdir_path)]
+            dd_command(
+                toc_filename, 'boot_device_or_file',
+                seek=self.snowball_config.SNOWBALL_LOADER_START_S * 512),
+            dd_command('%s/boot_image_issw.bin' % self.temp_bootdir_path,
+                       'boot_device_or_file', seek=131584),
+            dd_command('%s/boot_image_x-loader.bin' % self.temp_bootdir_path,
+                       'boot_device_or_file', seek=131588),
+            dd_command('%s/mem_init.bin' % self.temp_bootdir_path,
+                       'boot_device_or_file', seek=1572864),
+            dd_command('%s/power_management.bin' % self.temp_bootdir_path,
+                       'boot_device_or_file', seek=1638400),
+            dd_command('%s/u-boot.bin' % self.temp_bootdir_path,
+                       'boot_device_or_file', seek=12320768),
+            dd_command('%s/u-boot-env.bin' % self.temp_bootdir_path,
+                       'boot_device_or_file', seek=12840960)]
 
         self.assertEqual(expected, fixture.mock.commands_executed)
 
@@ -1103,30 +1223,30 @@ class TestSnowballBootFiles(TestCaseWithFixtures):
             files, "boot_device_or_file",
             self.snowball_config.SNOWBALL_LOADER_START_S, True)
         expected = [
-            '%s dd if=%s of=boot_device_or_file bs=512 conv=notrunc'
-            ' seek=%s' % (sudo_args, toc_filename,
-            self.snowball_config.SNOWBALL_LOADER_START_S),
-            '%s dd if=%s/boot_image_issw.bin of=boot_device_or_file bs=512'
-            ' conv=notrunc seek=257' % (sudo_args, self.temp_bootdir_path),
+            dd_command(
+                toc_filename, 'boot_device_or_file',
+                seek=self.snowball_config.SNOWBALL_LOADER_START_S * 512),
+            dd_command('%s/boot_image_issw.bin' % self.temp_bootdir_path,
+                       'boot_device_or_file', seek=131584),
+            dd_command('%s/boot_image_x-loader.bin' % self.temp_bootdir_path,
+                       'boot_device_or_file', seek=131588),
+            dd_command('%s/mem_init.bin' % self.temp_bootdir_path,
+                       'boot_device_or_file', seek=1572864),
+            dd_command('%s/power_management.bin' % self.temp_bootdir_path,
+                       'boot_device_or_file', seek=1638400),
+            dd_command('%s/u-boot.bin' % self.temp_bootdir_path,
+                       'boot_device_or_file', seek=12320768),
+            dd_command('%s/u-boot-env.bin' % self.temp_bootdir_path,
+                       'boot_device_or_file', seek=12840960),
+            # The files are only removed once all of them were written.
             '%s rm %s/boot_image_issw.bin' % (sudo_args,
             self.temp_bootdir_path),
-            '%s dd if=%s/boot_image_x-loader.bin of=boot_device_or_file'
-            ' bs=1 conv=notrunc seek=131588'
-            % (sudo_args, self.temp_bootdir_path),
             '%s rm %s/boot_image_x-loader.bin' % (sudo_args,
             self.temp_bootdir_path),
-            '%s dd if=%s/mem_init.bin of=boot_device_or_file bs=512'
-            ' conv=notrunc seek=3072' % (sudo_args, self.temp_bootdir_path),
             '%s rm %s/mem_init.bin' % (sudo_args, self.temp_bootdir_path),
-            '%s dd if=%s/power_management.bin of=boot_device_or_file bs=512'
-            ' conv=notrunc seek=3200' % (sudo_args, self.temp_bootdir_path),
             '%s rm %s/power_management.bin' % (sudo_args,
             self.temp_bootdir_path),
-            '%s dd if=%s/u-boot.bin of=boot_device_or_file bs=512'
-            ' conv=notrunc seek=24064' % (sudo_args, self.temp_bootdir_path),
             '%s rm %s/u-boot.bin' % (sudo_args, self.temp_bootdir_path),
-            '%s dd if=%s/u-boot-env.bin of=boot_device_or_file bs=512'
-            ' conv=notrunc seek=25080' % (sudo_args, self.temp_bootdir_path),
             '%s rm %s/u-boot-env.bin' % (sudo_args, self.temp_bootdir_path)]
 
         self.assertEqual(expected, fixture.mock.commands_executed)
@@ -1140,22 +1260,20 @@ class TestSnowballBootFiles(TestCaseWithFixtures):
             toc_filename, files, "boot_device_or_file",
             board_conf.SNOWBALL_LOADER_START_S)
         expected = [
-            '%s dd if=%s of=boot_device_or_file bs=512 conv=notrunc'
-            ' seek=%s' % (sudo_args, toc_filename,
-            board_conf.SNOWBALL_LOADER_START_S),
-            '%s dd if=%s/boot_image_issw.bin of=boot_device_or_file bs=512'
-            ' conv=notrunc seek=257' % (sudo_args, self.temp_bootdir_path),
-            '%s dd if=%s/boot_image_x-loader.bin of=boot_device_or_file'
-            ' bs=1 conv=notrunc seek=131588'
-            % (sudo_args, self.temp_bootdir_path),
-            '%s dd if=%s/mem_init.bin of=boot_device_or_file bs=512'
-            ' conv=notrunc seek=3072' % (sudo_args, self.temp_bootdir_path),
-            '%s dd if=%s/power_management.bin of=boot_device_or_file bs=512'
-            ' conv=notrunc seek=3200' % (sudo_args, self.temp_bootdir_path),
-            '%s dd if=%s/u-boot.bin of=boot_device_or_file bs=512'
-            ' conv=notrunc seek=24064' % (sudo_args, self.temp_bootdir_path),
-            '%s dd if=%s/u-boot-env.bin of=boot_device_or_file bs=512'
-            ' conv=notrunc seek=25080' % (sudo_args, self.temp_bootdir_path)]
+            dd_command(toc_filename, 'boot_device_or_file',
+                       seek=board_conf.SNOWBALL_LOADER_START_S * 512),
+            dd_command('%s/boot_image_issw.bin' % self.temp_bootdir_path,
+                       'boot_device_or_file', seek=131584),
+            dd_command('%s/boot_image_x-loader.bin' % self.temp_bootdir_path,
+                       'boot_device_or_file', seek=131588),
+            dd_command('%s/mem_init.bin' % self.temp_bootdir_path,
+                       'boot_device_or_file', seek=1572864),
+            dd_command('%s/power_management.bin' % self.temp_bootdir_path,
+                       'boot_device_or_file', seek=1638400),
+            dd_command('%s/u-boot.bin' % self.temp_bootdir_path,
+                       'boot_device_or_file', seek=12320768),
+            dd_command('%s/u-boot-env.bin' % self.temp_bootdir_path,
+                       'boot_device_or_file', seek=12840960)]
 
         self.assertEqual(expected, fixture.mock.commands_executed)
 
@@ -1186,29 +1304,28 @@ class TestSnowballBootFiles(TestCaseWithFixtures):
             '%s mkimage -A arm -O linux -T script -C none -a 0 -e 0 -n boot'
             ' script -d %s/boot/boot.txt %s/boot/flash.scr'
             % (sudo_args, self.tempdir, self.tempdir),
-            '%s dd if=/tmp/temp_snowball_make_boot_files'
-            ' of=boot_device_or_file bs=512 conv=notrunc seek=256'
-            % (sudo_args),
-            '%s dd if=%s/boot/boot_image_issw.bin of=boot_device_or_file'
-            ' bs=512 conv=notrunc seek=257' % (sudo_args, self.tempdir),
+            dd_command('/tmp/temp_snowball_make_boot_files',
+                       'boot_device_or_file', seek=131072),
+            dd_command('%s/boot/boot_image_issw.bin' % self.tempdir,
+                       'boot_device_or_file', seek=131584),
+            dd_command('%s/boot/boot_image_x-loader.bin' % self.tempdir,
+                       'boot_device_or_file', seek=131588),
+            dd_command('%s/boot/mem_init.bin' % self.tempdir,
+                       'boot_device_or_file', seek=1572864),
+            dd_command('%s/boot/power_management.bin' % self.tempdir,
+                       'boot_device_or_file', seek=1638400),
+            dd_command('%s/boot/u-boot.bin' % self.tempdir,
+                       'boot_device_or_file', seek=12320768),
+            dd_command('%s/boot/u-boot-env.bin' % self.tempdir,
+                       'boot_device_or_file', seek=12840960),
             '%s rm %s/boot_image_issw.bin' % (sudo_args,
             self.temp_bootdir_path),
-            '%s dd if=%s/boot/boot_image_x-loader.bin of=boot_device_or_file'
-            ' bs=1 conv=notrunc seek=131588' % (sudo_args, self.tempdir),
             '%s rm %s/boot_image_x-loader.bin' % (sudo_args,
             self.temp_bootdir_path),
-            '%s dd if=%s/boot/mem_init.bin of=boot_device_or_file bs=512'
-            ' conv=notrunc seek=3072' % (sudo_args, self.tempdir),
             '%s rm %s/mem_init.bin' % (sudo_args, self.temp_bootdir_path),
-            '%s dd if=%s/boot/power_management.bin of=boot_device_or_file'
-            ' bs=512 conv=notrunc seek=3200' % (sudo_args, self.tempdir),
             '%s rm %s/power_management.bin' % (sudo_args,
             self.temp_bootdir_path),
-            '%s dd if=%s/boot/u-boot.bin of=boot_device_or_file bs=512'
-            ' conv=notrunc seek=24064' % (sudo_args, self.tempdir),
             '%s rm %s/u-boot.bin' % (sudo_args, self.temp_bootdir_path),
-            '%s dd if=%s/boot/u-boot-env.bin of=boot_device_or_file bs=512'
-            ' conv=notrunc seek=25080' % (sudo_args, self.tempdir),
             '%s rm %s/u-boot-env.bin' % (sudo_args, self.temp_bootdir_path),
             '%s rm /tmp/temp_snowball_make_boot_files' % (sudo_args),
             '%s rm %s/startfiles.cfg' % (sudo_args, self.temp_bootdir_path)]
@@ -1602,10 +1719,9 @@ class TestPopulateRawPartitionAndroid(TestCaseWithFixtures):
         fixture = MockCmdRunnerPopenFixture()
         self.useFixture(fixture)
         expected_commands = [
-            'sudo -E dd if=/dev/zero of= bs=512 conv=notrunc count=32 seek=33',
-            ('sudo -E dd if=boot/u-boot-mmc-spl.bin of= '
-             'bs=512 conv=notrunc seek=1'),
-            'sudo -E dd if=boot/u-boot.bin of= bs=512 conv=notrunc seek=65']
+            dd_command('/dev/zero', '', count=16384, seek=16896),
+            dd_command('boot/u-boot-mmc-spl.bin', '', seek=512),
+            dd_command('boot/u-boot.bin', '', seek=33280)]
         self.useFixture(MockSomethingFixture(os.path, 'getsize',
                                              lambda file: 1))
 
@@ -1624,10 +1740,9 @@ class TestPopulateRawPartitionAndroid(TestCaseWithFixtures):
         fixture = MockCmdRunnerPopenFixture()
         self.useFixture(fixture)
         expected_commands = [
-            'sudo -E dd if=/dev/zero of= bs=512 conv=notrunc count=32 seek=33',
-            ('sudo -E dd if=boot/u-boot-mmc-spl.bin of= bs=512 '
-             'conv=notrunc seek=1'),
-            'sudo -E dd if=boot/u-boot.bin of= bs=512 conv=notrunc seek=65']
+            dd_command('/dev/zero', '', count=16384, seek=16896),
+            dd_command('boot/u-boot-mmc-spl.bin', '', seek=512),
+            dd_command('boot/u-boot.bin', '', seek=33280)]
         self.useFixture(MockSomethingFixture(os.path, 'getsize',
                                              lambda file: 1))
 
@@ -1641,11 +1756,9 @@ class TestPopulateRawPartitionAndroid(TestCaseWithFixtures):
         fixture = MockCmdRunnerPopenFixture()
         self.useFixture(fixture)
         expected_commands = [
-            ('sudo -E dd if=/dev/zero of= bs=512 conv=notrunc count=32 '
-             'seek=1073'),
-            ('sudo -E dd if=boot/u-boot-mmc-spl.bin of= bs=512 '
-             'conv=notrunc seek=1'),
-            'sudo -E dd if=boot/u-boot.bin of= bs=512 conv=notrunc seek=49']
+            dd_command('/dev/zero', '', count=16384, seek=549376),
+            dd_command('boot/u-boot-mmc-spl.bin', '', seek=512),
+            dd_command('boot/u-boot.bin', '', seek=25088)]
         self.useFixture(MockSomethingFixture(os.path, 'getsize',
                                              lambda file: 1))
 
@@ -2281,6 +2394,209 @@ class TestUnpackBinaryTarball(TestCaseWithFixtures):
             self.tarball_fixture.get_tarball(), tmp_dir, as_root=False)
         self.assertEqual(rc, 0)
 
+    def test_unpack_binary_tarball_rootfs_dir(self):
+        tmp_dir = self.useFixture(CreateTempDirFixture()).get_temp_dir()
+        rc = unpack_binary_tarball(
+            self.tarball_fixture.get_tarball(), tmp_dir, as_root=False,
+            rootfs_dir='tarball')
+        self.assertEqual(rc, 0)
+        # The rootfs directory itself is stripped from the extracted paths.
+        self.assertEqual([], os.listdir(tmp_dir))
+
+    def test_unpack_binary_tarball_strips_rootfs_dir(self):
+        fixture = self.useFixture(MockCmdRunnerPopenFixture())
+        unpack_binary_tarball(
+            'binary.tar.gz', 'unpack_dir', as_root=False,
+            rootfs_dir='binary/boot/filesystem.dir')
+        self.assertEqual(
+            ['tar --numeric-owner -C unpack_dir -xf binary.tar.gz '
+             '--strip-components=3 binary/boot/filesystem.dir'],
+            fixture.mock.commands_executed)
+
+    def test_unpack_binary_tarball_parallel_decompressor(self):
+        self.useFixture(MockSomethingFixture(
+            unpack_binary_tarball_module, 'has_command',
+            lambda command: command == 'pigz'))
+        fixture = self.useFixture(MockCmdRunnerPopenFixture())
+        tarball = self.tarball_fixture.get_tarball()
+        unpack_binary_tarball(tarball, 'unpack_dir', as_root=False)
+        self.assertEqual(
+            ['tar --numeric-owner -C unpack_dir '
+             '--use-compress-program=pigz -xf %s' % tarball],
+            fixture.mock.commands_executed)
+
+    def test_detect_compression(self):
+        self.assertEqual(
+            'gzip', detect_compression(self.tarball_fixture.get_tarball()))
+
+    def test_detect_compression_unknown(self):
+        self.assertEqual(
+            None, detect_compression(self.createTempFileAsFixture()))
+
+    def test_detect_compression_missing_file(self):
+        self.assertEqual(None, detect_compression('/nonexistent/file'))
+
+    def test_get_parallel_decompressor(self):
+        self.useFixture(MockSomethingFixture(
+            unpack_binary_tarball_module, 'has_command',
+            lambda command: command == 'pbzip2'))
+        self.assertEqual('pbzip2', get_parallel_decompressor('bzip2'))
+        self.assertEqual(None, get_parallel_decompressor('gzip'))
+        self.assertEqual(None, get_parallel_decompressor(None))
+
+    def _make_rootfs_tarball(self, prefix=''):
+        tarball = os.path.join(
+            self.tar_dir_fixture.get_temp_dir(), 'binary.tar.gz')
+        tar = tarfile.open(tarball, 'w:gz')
+        info = tarfile.TarInfo(prefix + 'binary')
+        info.type = tarfile.DIRTYPE
+        tar.addfile(info)
+        for name, data in [
+                ('binary/etc/hostname', 'linaro\n'),
+                ('binary/usr/share/doc/bash/README', 'Bash\n'),
+                ('binary/usr/share/doc/bash/copyright', 'GPL\n'),
+                ('binary/usr/share/man/man1/bash.1', '.TH BASH\n')]:
+            info = tarfile.TarInfo(prefix + name)
+            info.size = len(data)
+            tar.addfile(info, StringIO(data))
+        info = tarfile.TarInfo(prefix + 'binary/usr/share/doc/bash/README.old')
+        info.type = tarfile.LNKTYPE
+        info.linkname = prefix + 'binary/usr/share/doc/bash/README'
+        tar.addfile(info)
+        tar.close()
+        return tarball
+
+    def _list_extracted_files(self, unpack_dir):
+        extracted = []
+        for dirpath, dirnames, filenames in os.walk(unpack_dir):
+            extracted.extend(
+                os.path.relpath(os.path.join(dirpath, name), unpack_dir)
+                for name in filenames)
+        return sorted(extracted)
+
+    def test_unpack_binary_tarball_dot_prefixed_rootfs_dir(self):
+        # The rootfs directory is given as named in the tarball, and the
+        # leading './' is stripped along with it.
+        tarball = self._make_rootfs_tarball(prefix='./')
+        rootfs_dir = TarballIndex(tarball).get_name('binary')
+        self.assertEqual('./binary', rootfs_dir)
+        tmp_dir = self.useFixture(CreateTempDirFixture()).get_temp_dir()
+        rc = unpack_binary_tarball(
+            tarball, tmp_dir, as_root=False, rootfs_dir=rootfs_dir)
+        self.assertEqual(0, rc)
+        self.assertIn('etc/hostname', self._list_extracted_files(tmp_dir))
+        tmp_dir = self.useFixture(CreateTempDirFixture()).get_temp_dir()
+        rc = unpack_binary_tarball(
+            tarball, tmp_dir, as_root=False, rootfs_dir=rootfs_dir,
+            path_filter=path_filter.PathFilter([(False, '/usr/*')]))
+        self.assertEqual(0, rc)
+        self.assertEqual(['etc/hostname'], self._list_extracted_files(tmp_dir))
+
+    def test_unpack_binary_tarball_with_path_filter(self):
+        tmp_dir = self.useFixture(CreateTempDirFixture()).get_temp_dir()
+        rootfs_filter = path_filter.PathFilter.parse(
+            'path-exclude=/usr/share/doc/*\n'
+            'path-include=/usr/share/doc/*/copyright\n'
+            'path-exclude=/usr/share/man/*\n')
+        rc = unpack_binary_tarball(
+            self._make_rootfs_tarball(), tmp_dir, as_root=False,
+            rootfs_dir='binary', path_filter=rootfs_filter)
+        self.assertEqual(0, rc)
+        self.assertEqual(
+            ['etc/hostname', 'usr/share/doc/bash/copyright'],
+            self._list_extracted_files(tmp_dir))
+
+    def test_unpack_binary_tarball_with_path_filter_failure(self):
+        # The filter's error is raised, not that of the decompressor or tar
+        # it leaves without input.
+        def mock_filter_tarball(source, dest, path_filter, root=''):
+            raise tarfile.ReadError("unexpected end of data")
+
+        self.useFixture(MockSomethingFixture(
+            unpack_binary_tarball_module, 'filter_tarball',
+            mock_filter_tarball))
+        tmp_dir = self.useFixture(CreateTempDirFixture()).get_temp_dir()
+        self.assertRaises(
+            tarfile.ReadError, unpack_binary_tarball,
+            self._make_rootfs_tarball(), tmp_dir, as_root=False,
+            rootfs_dir='binary',
+            path_filter=path_filter.PathFilter([(False, '/usr/*')]))
+
+
+class TestPathFilter(TestCaseWithFixtures):
+
+    def test_parse(self):
+        rootfs_filter = path_filter.PathFilter.parse(
+            '# No docs\n'
+            '\n'
+            'path-exclude=/usr/share/doc/*\n'
+            'path-include = /usr/share/doc/*/copyright\n')
+        self.assertEqual(
+            [(False, '/usr/share/doc/*'),
+             (True, '/usr/share/doc/*/copyright')],
+            rootfs_filter.rules)
+
+    def test_parse_invalid_rule(self):
+        self.assertRaises(
+            ValueError, path_filter.PathFilter.parse, 'exclude=/usr/share/*')
+        self.assertRaises(
+            ValueError, path_filter.PathFilter.parse, 'path-exclude=')
+
+    def test_is_included(self):
+        rootfs_filter = path_filter.PathFilter(
+            [(False, '/usr/share/doc/*'),
+             (True, '/usr/share/doc/*/copyright')])
+        self.assertTrue(rootfs_filter.is_included('/etc/hostname'))
+        self.assertFalse(
+            rootfs_filter.is_included('/usr/share/doc/bash/README'))
+        # The last rule matching wins, and * matches / too.
+        self.assertTrue(
+            rootfs_filter.is_included('/usr/share/doc/bash/copyright'))
+        self.assertFalse(
+            rootfs_filter.is_included('/usr/share/doc/bash/examples/x'))
+
+    def test_to_dpkg_config(self):
+        rootfs_filter = path_filter.PathFilter(
+            [(False, '/usr/share/doc/*'),
+             (True, '/usr/share/doc/*/copyright')])
+        self.assertEqual(
+            'path-exclude=/usr/share/doc/*\n'
+            'path-include=/usr/share/doc/*/copyright\n',
+            rootfs_filter.to_dpkg_config())
+
+    def test_filter_tarball_keeps_what_is_outside_the_rootfs(self):
+        source = StringIO()
+        tar = tarfile.open(fileobj=source, mode='w')
+        for name in ['./binary/usr/share/doc/README', './boot/README']:
+            info = tarfile.TarInfo(name)
+            info.size = 1
+            tar.addfile(info, StringIO('x'))
+        tar.close()
+        source.seek(0)
+        dest = StringIO()
+        excluded = path_filter.filter_tarball(
+            source, dest, path_filter.PathFilter([(False, '/usr/share/*')]),
+            root='binary')
+        self.assertEqual(1, excluded)
+        dest.seek(0)
+        self.assertEqual(
+            ['./boot/README'], tarfile.open(fileobj=dest).getnames())
+
+    def test_install_path_filter(self):
+        fixture = self.useFixture(MockCmdRunnerPopenFixture())
+        path_filter.install_path_filter(
+            '/rootfs', path_filter.PathFilter([(False, '/usr/share/doc/*')]))
+        config_dir = '/rootfs/etc/dpkg/dpkg.cfg.d'
+        self.assertEqual('%s mkdir -p %s' % (sudo_args, config_dir),
+                         fixture.mock.commands_executed[0])
+        tmpfile = fixture.mock.calls[1][-2]
+        self.assertEqual(
+            '%s mv -f %s %s/linaro-image-tools-rootfs-filter' % (
+                sudo_args, tmpfile, config_dir),
+            fixture.mock.commands_executed[1])
+        self.assertEqual(
+            'path-exclude=/usr/share/doc/*\n', open(tmpfile).read())
+
 
 class TestGetUuid(TestCaseWithFixtures):
 
@@ -2364,8 +2680,7 @@ class TestBoards(TestCaseWithFixtures):
         install_mx5_boot_loader(imx_file, "boot_device_or_file",
                                 BoardConfig.LOADER_MIN_SIZE_S)
         expected = [
-            '%s dd if=%s of=boot_device_or_file bs=512 '
-            'conv=notrunc seek=2' % (sudo_args, imx_file)]
+            dd_command(imx_file, 'boot_device_or_file', seek=1024)]
         self.assertEqual(expected, fixture.mock.commands_executed)
 
     def test_install_mx5_boot_loader_too_large(self):
@@ -2400,12 +2715,10 @@ class TestBoards(TestCaseWithFixtures):
             "%s/%s/SPL" % ("chroot_dir", bootloader_flavor),
             "%s/%s/uboot" % ("chroot_dir", bootloader_flavor), "boot_disk")
         expected = [
-            '%s dd if=chroot_dir/%s/SPL of=boot_disk bs=512 conv=notrunc '
-            'seek=%d' % (sudo_args, bootloader_flavor,
-                         board_conf.samsung_bl1_start),
-            '%s dd if=chroot_dir/%s/uboot of=boot_disk bs=512 conv=notrunc '
-            'seek=%d' % (sudo_args, bootloader_flavor,
-                         board_conf.samsung_bl2_start)]
+            dd_command('chroot_dir/%s/SPL' % bootloader_flavor, 'boot_disk',
+                       seek=board_conf.samsung_bl1_start * 512),
+            dd_command('chroot_dir/%s/uboot' % bootloader_flavor, 'boot_disk',
+                       seek=board_conf.samsung_bl2_start * 512)]
         self.assertEqual(expected, fixture.mock.commands_executed)
 
     def _set_up_board_config(self, board_name):
@@ -2445,12 +2758,10 @@ class TestBoards(TestCaseWithFixtures):
             board_conf._get_samsung_bootloader(chroot_dir_value),
             "boot_disk")
         expected = [
-            '%s dd if=chroot_dir/%s/SPL of=boot_disk bs=512 conv=notrunc '
-            'seek=%d' % (sudo_args, bootloader_flavor,
-                         board_conf.samsung_bl1_start),
-            '%s dd if=chroot_dir/%s/uboot of=boot_disk bs=512 conv=notrunc '
-            'seek=%d' % (sudo_args, bootloader_flavor,
-                         board_conf.samsung_bl2_start)]
+            dd_command('chroot_dir/%s/SPL' % bootloader_flavor, 'boot_disk',
+                       seek=board_conf.samsung_bl1_start * 512),
+            dd_command('chroot_dir/%s/uboot' % bootloader_flavor, 'boot_disk',
+                       seek=board_conf.samsung_bl2_start * 512)]
         self.assertEqual(expected, fixture.mock.commands_executed)
 
     def test_install_origen_quad_u_boot(self):
@@ -2464,12 +2775,10 @@ class TestBoards(TestCaseWithFixtures):
             board_conf._get_samsung_bootloader(chroot_dir_value),
             "boot_disk")
         expected = [
-            '%s dd if=chroot_dir/%s/SPL of=boot_disk bs=512 conv=notrunc '
-            'seek=%d' % (sudo_args, bootloader_flavor,
-                         board_conf.samsung_bl1_start),
-            '%s dd if=chroot_dir/%s/uboot of=boot_disk bs=512 conv=notrunc '
-            'seek=%d' % (sudo_args, bootloader_flavor,
-                         board_conf.samsung_bl2_start)]
+            dd_command('chroot_dir/%s/SPL' % bootloader_flavor, 'boot_disk',
+                       seek=board_conf.samsung_bl1_start * 512),
+            dd_command('chroot_dir/%s/uboot' % bootloader_flavor, 'boot_disk',
+                       seek=board_conf.samsung_bl2_start * 512)]
         self.assertEqual(expected, fixture.mock.commands_executed)
 
     def test_install_arndale_u_boot(self):
@@ -2483,12 +2792,10 @@ class TestBoards(TestCaseWithFixtures):
             board_conf._get_samsung_bootloader(chroot_dir_value),
             "boot_disk")
         expected = [
-            '%s dd if=chroot_dir/%s/SPL of=boot_disk bs=512 conv=notrunc '
-            'seek=%d' % (sudo_args, bootloader_flavor,
-                         board_conf.samsung_bl1_start),
-            '%s dd if=chroot_dir/%s/uboot of=boot_disk bs=512 conv=notrunc '
-            'seek=%d' % (sudo_args, bootloader_flavor,
-                         board_conf.samsung_bl2_start)]
+            dd_command('chroot_dir/%s/SPL' % bootloader_flavor, 'boot_disk',
+                       seek=board_conf.samsung_bl1_start * 512),
+            dd_command('chroot_dir/%s/uboot' % bootloader_flavor, 'boot_disk',
+                       seek=board_conf.samsung_bl2_start * 512)]
         self.assertEqual(expected, fixture.mock.commands_executed)
 
     def test_get_plain_boot_script_contents(self):
@@ -2665,8 +2972,10 @@ class TestCreatePartitions(TestCaseWithFixtures):
         self.assertEqual(
             ['%s parted -s %s mklabel msdos' % (sudo_args, self.media.path),
              '%s sfdisk -l %s' % (sudo_args, self.media.path),
+             'udevadm settle --timeout=%d' % UDEV_SETTLE_TIMEOUT,
              'sync',
-             '%s sfdisk -l %s' % (sudo_args, self.media.path)],
+             '%s sfdisk -l %s' % (sudo_args, self.media.path),
+             'udevadm settle --timeout=%d' % UDEV_SETTLE_TIMEOUT],
             popen_fixture.mock.commands_executed)
         # Notice that we create all partitions in a single sfdisk run because
         # every time we run sfdisk it actually repartitions the device,
@@ -2688,8 +2997,10 @@ class TestCreatePartitions(TestCaseWithFixtures):
         self.assertEqual(
             ['%s parted -s %s mklabel msdos' % (sudo_args, self.media.path),
              '%s sfdisk -l %s' % (sudo_args, self.media.path),
+             'udevadm settle --timeout=%d' % UDEV_SETTLE_TIMEOUT,
              'sync',
-             '%s sfdisk -l %s' % (sudo_args, self.media.path)],
+             '%s sfdisk -l %s' % (sudo_args, self.media.path),
+             'udevadm settle --timeout=%d' % UDEV_SETTLE_TIMEOUT],
             popen_fixture.mock.commands_executed)
         # Notice that we create all partitions in a single sfdisk run because
         # every time we run sfdisk it actually repartitions the device,
@@ -2710,8 +3021,10 @@ class TestCreatePartitions(TestCaseWithFixtures):
         self.assertEqual(
             ['%s parted -s %s mklabel msdos' % (sudo_args, self.media.path),
              '%s sfdisk -l %s' % (sudo_args, self.media.path),
+             'udevadm settle --timeout=%d' % UDEV_SETTLE_TIMEOUT,
              'sync',
-             '%s sfdisk -l %s' % (sudo_args, self.media.path)],
+             '%s sfdisk -l %s' % (sudo_args, self.media.path),
+             'udevadm settle --timeout=%d' % UDEV_SETTLE_TIMEOUT],
             popen_fixture.mock.commands_executed)
         # Notice that we create all partitions in a single sfdisk run because
         # every time we run sfdisk it actually repartitions the device,
@@ -2733,8 +3046,10 @@ class TestCreatePartitions(TestCaseWithFixtures):
         self.assertEqual(
             ['%s parted -s %s mklabel msdos' % (sudo_args, self.media.path),
              '%s sfdisk -l %s' % (sudo_args, self.media.path),
+             'udevadm settle --timeout=%d' % UDEV_SETTLE_TIMEOUT,
              'sync',
-             '%s sfdisk -l %s' % (sudo_args, self.media.path)],
+             '%s sfdisk -l %s' % (sudo_args, self.media.path),
+             'udevadm settle --timeout=%d' % UDEV_SETTLE_TIMEOUT],
             popen_fixture.mock.commands_executed)
         # Notice that we create all partitions in a single sfdisk run because
         # every time we run sfdisk it actually repartitions the device,
@@ -2756,8 +3071,10 @@ class TestCreatePartitions(TestCaseWithFixtures):
         self.assertEqual(
             ['%s parted -s %s mklabel msdos' % (sudo_args, self.media.path),
              '%s sfdisk -l %s' % (sudo_args, self.media.path),
+             'udevadm settle --timeout=%d' % UDEV_SETTLE_TIMEOUT,
              'sync',
-             '%s sfdisk -l %s' % (sudo_args, self.media.path)],
+             '%s sfdisk -l %s' % (sudo_args, self.media.path),
+             'udevadm settle --timeout=%d' % UDEV_SETTLE_TIMEOUT],
             popen_fixture.mock.commands_executed)
         # Notice that we create all partitions in a single sfdisk run because
         # every time we run sfdisk it actually repartitions the device,
@@ -2777,8 +3094,10 @@ class TestCreatePartitions(TestCaseWithFixtures):
         self.assertEqual(
             ['%s parted -s %s mklabel msdos' % (sudo_args, self.media.path),
              '%s sfdisk -l %s' % (sudo_args, self.media.path),
+             'udevadm settle --timeout=%d' % UDEV_SETTLE_TIMEOUT,
              'sync',
-             '%s sfdisk -l %s' % (sudo_args, self.media.path)],
+             '%s sfdisk -l %s' % (sudo_args, self.media.path),
+             'udevadm settle --timeout=%d' % UDEV_SETTLE_TIMEOUT],
             popen_fixture.mock.commands_executed)
         self.assertEqual(
             [('63,106432,0x0C,*\n106496,,,-', HEADS, SECTORS, '',
@@ -2790,22 +3109,21 @@ class TestCreatePartitions(TestCaseWithFixtures):
         sfdisk_fixture = self.useFixture(MockRunSfdiskCommandsFixture())
 
         tmpfile = self.createTempFileAsFixture()
+        with open(tmpfile, 'wb') as fd:
+            fd.truncate(128 * 1024 ** 2)
         board_conf = get_board_config('beagle')
         board_conf.hwpack_format = HardwarepackHandler.FORMAT_1
         create_partitions(board_conf, Media(tmpfile), HEADS, SECTORS, '')
 
         # Unlike the test for partitioning of a regular block device, in this
-        # case parted was not called as there's no existing partition table
-        # for us to overwrite on the image file.
-        self.assertEqual(
-            ['%s sfdisk -l %s' % (sudo_args, tmpfile),
-             'sync',
-             '%s sfdisk -l %s' % (sudo_args, tmpfile)],
-            popen_fixture.mock.commands_executed)
-
+        # case neither parted nor sfdisk were called, as the partition table
+        # of an image file is written directly.
+        self.assertEqual(None, popen_fixture.mock.calls)
+        self.assertEqual(None, sfdisk_fixture.mock.calls)
         self.assertEqual(
-            [('63,106432,0x0C,*\n106496,,,-', HEADS, SECTORS, '', tmpfile)],
-            sfdisk_fixture.mock.calls)
+            [(1, 63, 106432, 0x0C, True),
+             (2, 106496, 128 * 2048 - 106496, 0x83, False)],
+            read_partition_table(tmpfile))
 
     def test_run_sfdisk_commands(self):
         tmpfile = self.createTempFileAsFixture()
@@ -2875,6 +3193,178 @@ class TestCreatePartitions(TestCaseWithFixtures):
                           wait_partition_to_settle,
                           media)
 
+    def test_wait_partition_to_settle_does_not_sleep_if_ready(self):
+        sleeps = []
+        self.useFixture(MockSomethingFixture(time, 'sleep', sleeps.append))
+        self.useFixture(MockSomethingFixture(os, 'getuid', lambda: 1000))
+        popen_fixture = self.useFixture(MockCmdRunnerPopenFixture())
+        wait_partition_to_settle(Media('/dev/xdz'))
+        self.assertEqual([], sleeps)
+        self.assertEqual(
+            ['%s sfdisk -l /dev/xdz' % sudo_args,
+             'udevadm settle --timeout=%d' % UDEV_SETTLE_TIMEOUT],
+            popen_fixture.mock.commands_executed)
+
+    def test_wait_partition_to_settle_polls_until_timeout(self):
+        sleeps = []
+        runs = []
+
+        def mock_run(args, **kwargs):
+            runs.append(args)
+            raise cmd_runner.SubcommandNonZeroReturnValue(args, 1)
+
+        self.useFixture(MockSomethingFixture(time, 'sleep', sleeps.append))
+        self.useFixture(MockSomethingFixture(cmd_runner, 'run', mock_run))
+        self.useFixture(MockSomethingFixture(
+            partitions, 'PARTITION_SETTLE_POLL_INTERVAL', 0.5))
+        self.useFixture(MockSomethingFixture(
+            partitions, 'PARTITION_SETTLE_TIMEOUT', 2))
+        self.assertRaises(cmd_runner.SubcommandNonZeroReturnValue,
+                          wait_partition_to_settle, Media('/dev/xdz'))
+        self.assertEqual(5, len(runs))
+        self.assertEqual([0.5] * 4, sleeps)
+
+    def test_wait_partition_to_settle_captures_stderr(self):
+        runs = []
+
+        def mock_run(args, **kwargs):
+            runs.append(kwargs)
+            raise cmd_runner.SubcommandNonZeroReturnValue(
+                args, 1, stderr='attempt %d\n' % len(runs))
+
+        self.useFixture(MockSomethingFixture(time, 'sleep', lambda s: None))
+        self.useFixture(MockSomethingFixture(cmd_runner, 'run', mock_run))
+        self.useFixture(MockSomethingFixture(
+            partitions, 'PARTITION_SETTLE_TIMEOUT', 2))
+        e = self.assertRaises(cmd_runner.SubcommandNonZeroReturnValue,
+                              wait_partition_to_settle, Media('/dev/xdz'))
+        self.assertEqual(
+            [subprocess.PIPE] * len(runs),
+            [kwargs['stderr'] for kwargs in runs])
+        self.assertEqual('attempt %d\n' % len(runs), e.stderr)
+
+
+def read_partition_table(path):
+    """Return the (number, start, size, id, bootable) of each partition.
+
+    The start and size are in sectors.
+    """
+    def read_entries(fd, sector):
+        fd.seek(sector * 512 + 446)
+        table = fd.read(66)
+        assert table[64:] == '\x55\xaa', "No partition table at %d" % sector
+        entries = []
+        for i in range(4):
+            status, partition_id, start, size = struct.unpack(
+                '<B3xB3xII', table[i * 16:(i + 1) * 16])
+            if partition_id != 0:
+                entries.append((start, size, partition_id, status == 0x80))
+        return entries
+
+    partitions = []
+    with open(path, 'rb') as fd:
+        extended = None
+        for number, entry in enumerate(read_entries(fd, 0)):
+            partitions.append((number + 1,) + entry)
+            if entry[2] == 0x05:
+                extended = entry[0]
+        ebr = extended
+        while ebr is not None:
+            entries = read_entries(fd, ebr)
+            start, size, partition_id, bootable = entries[0]
+            partitions.append(
+                (len(partitions) + 1, ebr + start, size, partition_id,
+                 bootable))
+            ebr = None
+            if len(entries) > 1:
+                ebr = extended + entries[1][0]
+    return partitions
+
+
+class TestMbr(TestCaseWithFixtures):
+
+    android_sfdisk_cmd = (
+        '63,32768,0x0C,*\n32831,65536,L\n98367,65536,L\n294975,-,E\n'
+        '294975,131072,L\n426047,,,-')
+    snowball_android_sfdisk_cmd = (
+        '256,7936,0xDA\n8192,24639,0x0C,*\n32831,65536,L\n'
+        '98367,-,E\n98367,65536,L\n294975,131072,L\n426047,,,-')
+    # 256 MiB
+    disk_size = 524288
+
+    def _create_image(self):
+        tmpfile = self.createTempFileAsFixture()
+        with open(tmpfile, 'wb') as fd:
+            fd.truncate(self.disk_size * 512)
+        return tmpfile
+
+    def test_parse_normal_layout(self):
+        self.assertEqual(
+            [(1, 63, 106432, 0x0C, True),
+             (2, 106496, self.disk_size - 106496, 0x83, False)],
+            [(p.number, p.start, p.size, p.partition_id, p.bootable)
+             for p in mbr.parse_sfdisk_commands(
+                 '63,106432,0x0C,*\n106496,,,-', self.disk_size, SECTORS)])
+
+    def test_write_android_layout(self):
+        # The same offsets sfdisk gives, see TestPartitionSetup: the first
+        # logical partition of each EBR chain has to make room for its EBR.
+        tmpfile = self._create_image()
+        mbr.write_partition_table(
+            tmpfile, self.android_sfdisk_cmd, HEADS, SECTORS)
+        self.assertEqual(
+            [(1, 63, 32768, 0x0C, True),
+             (2, 32831, 65536, 0x83, False),
+             (3, 98367, 65536, 0x83, False),
+             (4, 294975, self.disk_size - 294975, 0x05, False),
+             (5, 294975 + 32, 131072 - 32, 0x83, False),
+             (6, 426047 + 32, self.disk_size - 426047 - 32, 0x83, False)],
+            read_partition_table(tmpfile))
+
+    def test_write_snowball_android_layout(self):
+        tmpfile = self._create_image()
+        partitions = mbr.write_partition_table(
+            tmpfile, self.snowball_android_sfdisk_cmd, HEADS, SECTORS)
+        expected = [
+            (1, 256, 7936, 0xDA, False),
+            (2, 8192, 24639, 0x0C, True),
+            (3, 32831, 65536, 0x83, False),
+            (4, 98367, self.disk_size - 98367, 0x05, False),
+            (5, 98367 + 32, 65536 - 32, 0x83, False),
+            # There's room for the EBR before this one.
+            (6, 294975, 131072, 0x83, False),
+            (7, 426047 + 32, self.disk_size - 426047 - 32, 0x83, False)]
+        self.assertEqual(expected, read_partition_table(tmpfile))
+        self.assertEqual(
+            expected,
+            [(p.number, p.start, p.size, p.partition_id, p.bootable)
+             for p in partitions])
+
+    def test_keeps_boot_code(self):
+        tmpfile = self._create_image()
+        with open(tmpfile, 'r+b') as fd:
+            fd.write('\xeb' * 446)
+        mbr.write_partition_table(
+            tmpfile, '63,106432,0x0C,*\n106496,,,-', HEADS, SECTORS)
+        with open(tmpfile, 'rb') as fd:
+            self.assertEqual('\xeb' * 446, fd.read(446))
+
+    def test_chs_beyond_1024_cylinders(self):
+        self.assertEqual('\xfe\xff\xff', mbr._chs(1024 * 4096, 128, 32))
+        # Cylinder 1, head 2, sector 4.
+        self.assertEqual(
+            '\x02\x04\x01', mbr._chs(4096 + 2 * 32 + 3, 128, 32))
+
+    def test_logical_partition_without_extended(self):
+        self.assertRaises(
+            ValueError, mbr.parse_sfdisk_commands,
+            '1,10\n11,10\n21,10\n31,10\n41,10', self.disk_size, SECTORS)
+
+    def test_partition_too_large(self):
+        self.assertRaises(
+            ValueError, mbr.parse_sfdisk_commands,
+            '63,%d,0x0C,*' % self.disk_size, self.disk_size, SECTORS)
+
 
 class TestPartitionSetup(TestCaseWithFixtures):
 
@@ -3161,13 +3651,7 @@ class TestPartitionSetup(TestCaseWithFixtures):
         self.assertEqual(
             # This is the call that would create a 2 GiB image file.
             ['dd of=%s bs=1 seek=2147483648 count=0' % tmpfile,
-             '%s sfdisk -l %s' % (sudo_args, tmpfile),
-             # This call would partition the image file.
-             '%s sfdisk --force -D -uS -H %s -S %s -C 1024 %s' % (
-                 sudo_args, HEADS, SECTORS, tmpfile),
-             # Make sure changes are written to disk.
-             'sync',
-             '%s sfdisk -l %s' % (sudo_args, tmpfile),
+             # The image file is partitioned without running sfdisk.
              '%s mkfs.vfat -F 32 %s -n boot' % (sudo_args, bootfs_dev),
              '%s mkfs.ext3 %s -L root' % (sudo_args, rootfs_dev)],
             popen_fixture.mock.commands_executed)
@@ -3196,10 +3680,12 @@ class TestPartitionSetup(TestCaseWithFixtures):
         self.assertEqual(
             ['%s parted -s %s mklabel msdos' % (sudo_args, tmpfile),
              '%s sfdisk -l %s' % (sudo_args, tmpfile),
+             'udevadm settle --timeout=%d' % UDEV_SETTLE_TIMEOUT,
              '%s sfdisk --force -D -uS -H %s -S %s %s' % (
                  sudo_args, HEADS, SECTORS, tmpfile),
              'sync',
              '%s sfdisk -l %s' % (sudo_args, tmpfile),
+             'udevadm settle --timeout=%d' % UDEV_SETTLE_TIMEOUT,
              # Since the partitions are mounted, setup_partitions will umount
              # them before running mkfs.
              '%s umount %s' % (sudo_args, bootfs_dev),
@@ -3208,6 +3694,121 @@ class TestPartitionSetup(TestCaseWithFixtures):
              '%s mkfs.ext3 %s -L root' % (sudo_args, rootfs_dev)],
             popen_fixture.mock.commands_executed)
 
+    def test_format_partitions_concurrently(self):
+        self.useFixture(MockSomethingFixture(os, 'getuid', lambda: 0))
+        stdout = StringIO()
+        self.useFixture(MockSomethingFixture(sys, 'stdout', stdout))
+        mkfs_commands = [
+            ('boot partition', ['sh', '-c', 'echo formatted boot']),
+            ('root partition', ['sh', '-c', 'echo root failed >&2; exit 1']),
+            ('data partition', ['sh', '-c', 'echo formatted data']),
+        ]
+        e = self.assertRaises(
+            cmd_runner.SubcommandNonZeroReturnValue,
+            partitions.format_partitions, mkfs_commands, mkfs_jobs=2)
+        self.assertEqual(mkfs_commands[1][1], e.command)
+        # The output of each command follows its own header.
+        self.assertEqual(
+            "\nFormating boot partition\n\nformatted boot\n"
+            "\nFormating root partition\n\nroot failed\n"
+            "\nFormating data partition\n\nformatted data\n",
+            stdout.getvalue())
+
+    def test_get_mkfs_options_default(self):
+        self.assertEqual([], partitions.get_mkfs_options('ext4'))
+        self.assertEqual(
+            ['-E', 'nodiscard'],
+            partitions.get_mkfs_options('ext4', 'default', ['nodiscard']))
+
+    def test_get_mkfs_options_fast_image(self):
+        self.assertEqual(
+            ['-E', 'nodiscard,lazy_itable_init=1', '-J', 'size=16'],
+            partitions.get_mkfs_options('ext4', 'fast-image', ['nodiscard']))
+        # ext2 has no journal.
+        self.assertEqual(
+            ['-E', 'lazy_itable_init=1,nodiscard'],
+            partitions.get_mkfs_options('ext2', 'fast-image'))
+        self.assertEqual(
+            ['--nodiscard'],
+            partitions.get_mkfs_options('btrfs', 'fast-image'))
+        self.assertEqual([], partitions.get_mkfs_options('vfat', 'fast-image'))
+
+    def test_get_mkfs_options_sdcard(self):
+        # The partitions were discarded by discard_partitions() already.
+        self.assertEqual(
+            ['-E', 'nodiscard'], partitions.get_mkfs_options('ext3', 'sdcard'))
+        self.assertEqual(
+            ['--nodiscard'], partitions.get_mkfs_options('btrfs', 'sdcard'))
+        self.assertEqual([], partitions.get_mkfs_options('vfat', 'sdcard'))
+
+    def test_setup_partitions_with_format_profile(self):
+        self.useFixture(MockSomethingFixture(
+            sys, 'stdout', open('/dev/null', 'w')))
+        self.useFixture(MockSomethingFixture(
+            partitions, 'is_partition_mounted', lambda part: False))
+        tmpfile = self.createTempFileAsFixture()
+        self.useFixture(MockSomethingFixture(
+            partitions, '_get_device_file_for_partition_number',
+            lambda dev, partition: '%s%d' % (tmpfile, partition)))
+        media = Media(tmpfile)
+        media.is_block_device = True
+        popen_fixture = self.useFixture(MockCmdRunnerPopenFixture())
+        profiler = profiling.enable()
+        self.addCleanup(profiling.disable)
+
+        bootfs_dev, rootfs_dev = setup_partitions(
+            get_board_config('beagle'), media, '2G', 'boot', 'root', 'ext4',
+            False, False, True, format_profile='fast-image')
+        self.assertEqual(
+            ['%s mkfs.ext4 -E lazy_itable_init=1,nodiscard -J size=16 %s '
+             '-L root' % (sudo_args, rootfs_dev)],
+            popen_fixture.mock.commands_executed)
+        self.assertEqual(
+            {'name': 'fast-image',
+             'mkfs_options': {'ext4': [
+                 '-E', 'lazy_itable_init=1,nodiscard', '-J', 'size=16']}},
+            profiler.metadata['format_profile'])
+
+    def test_setup_partitions_with_sdcard_profile_discards(self):
+        self.useFixture(MockSomethingFixture(
+            sys, 'stdout', open('/dev/null', 'w')))
+        self.useFixture(MockSomethingFixture(
+            partitions, 'is_partition_mounted', lambda part: False))
+        tmpfile = self.createTempFileAsFixture()
+        self.useFixture(MockSomethingFixture(
+            partitions, '_get_device_file_for_partition_number',
+            lambda dev, partition: '%s%d' % (tmpfile, partition)))
+        media = Media(tmpfile)
+        media.is_block_device = True
+        popen_fixture = self.useFixture(MockCmdRunnerPopenFixture())
+        profiler = profiling.enable()
+        self.addCleanup(profiling.disable)
+
+        bootfs_dev, rootfs_dev = setup_partitions(
+            get_board_config('beagle'), media, '2G', 'boot', 'root', 'ext4',
+            False, True, True, format_profile='sdcard')
+        self.assertEqual(
+            ['%s blkdiscard %s' % (sudo_args, bootfs_dev),
+             '%s blkdiscard %s' % (sudo_args, rootfs_dev),
+             '%s mkfs.vfat -F 32 %s -n boot' % (sudo_args, bootfs_dev),
+             '%s mkfs.ext4 -E nodiscard %s -L root' % (sudo_args, rootfs_dev)],
+            popen_fixture.mock.commands_executed)
+        self.assertEqual(
+            {'name': 'sdcard',
+             'mkfs_options': {'ext4': ['-E', 'nodiscard']},
+             'discarded': [bootfs_dev, rootfs_dev]},
+            profiler.metadata['format_profile'])
+
+    def test_discard_partitions_skips_failures(self):
+        def mock_run(args, **kwargs):
+            if args[1] == 'boot':
+                raise cmd_runner.SubcommandNonZeroReturnValue(args, 1)
+            return MockCmdRunnerPopen()(args)
+
+        self.useFixture(MockSomethingFixture(cmd_runner, 'run', mock_run))
+        self.assertEqual(
+            ['root'], partitions.discard_partitions(['boot', 'root']))
+
     def test_get_device_file_for_partition_number_raises_DBusException(self):
         def mock_get_udisks_device_path(d):
             raise dbus.exceptions.DBusException
@@ -3274,6 +3875,67 @@ class TestPartitionSetup(TestCaseWithFixtures):
         self.assertIsNotNone(_get_device_file_for_partition_number(
             media.path, partition))
 
+    def _create_sysfs_device(self, name, numbers):
+        # Create a fake device file with the given partitions, and the sysfs
+        # entries for them.
+        tempdir = self.useFixture(CreateTempDirFixture()).get_temp_dir()
+        sys_class_block = os.path.join(tempdir, 'sys')
+        dev_dir = os.path.join(tempdir, 'dev')
+        os.makedirs(os.path.join(sys_class_block, name, 'queue'))
+        os.makedirs(dev_dir)
+        self.useFixture(MockSomethingFixture(
+            partitions, 'SYS_CLASS_BLOCK', sys_class_block))
+        open(os.path.join(dev_dir, name), 'w').close()
+        for number in numbers:
+            self._add_sysfs_partition(
+                sys_class_block, dev_dir, name, number)
+        return sys_class_block, dev_dir
+
+    def _add_sysfs_partition(self, sys_class_block, dev_dir, name, number):
+        part_name = '%sp%d' % (name, number)
+        part_dir = os.path.join(sys_class_block, name, part_name)
+        os.makedirs(part_dir)
+        with open(os.path.join(part_dir, 'partition'), 'w') as fd:
+            fd.write('%d\n' % number)
+        open(os.path.join(dev_dir, part_name), 'w').close()
+
+    def test_get_device_file_for_partition_number_from_sysfs(self):
+        popen_fixture = self.useFixture(MockCmdRunnerPopenFixture())
+        sys_class_block, dev_dir = self._create_sysfs_device(
+            'mmcblk0', [1, 2, 5])
+        self.assertEqual(
+            os.path.join(dev_dir, 'mmcblk0p5'),
+            _get_device_file_for_partition_number(
+                os.path.join(dev_dir, 'mmcblk0'), 5))
+        # Neither udev nor UDisks were needed.
+        self.assertEqual(None, popen_fixture.mock.calls)
+
+    def test_get_device_file_for_partition_number_waits_for_udev(self):
+        sys_class_block, dev_dir = self._create_sysfs_device(
+            'mmcblk0', [1])
+        settled = []
+
+        def mock_udev_settle():
+            settled.append(True)
+            self._add_sysfs_partition(
+                sys_class_block, dev_dir, 'mmcblk0', 2)
+
+        self.useFixture(MockSomethingFixture(
+            partitions, '_udev_settle', mock_udev_settle))
+        self.assertEqual(
+            os.path.join(dev_dir, 'mmcblk0p2'),
+            _get_device_file_for_partition_number(
+                os.path.join(dev_dir, 'mmcblk0'), 2))
+        self.assertEqual([True], settled)
+
+    def test_udev_settle(self):
+        popen_fixture = self.useFixture(MockCmdRunnerPopenFixture())
+        partitions._udev_settle()
+        self.assertEqual(
+            ['udevadm settle --timeout=%d' %
+             partitions.UDEV_SETTLE_TIMEOUT],
+            popen_fixture.mock.commands_executed)
+
 
 class TestException(Exception):
     """Just a test exception."""
@@ -3477,6 +4139,16 @@ class TestPopulateBoot(TestCaseWithFixtures):
             expected_calls, self.popen_fixture.mock.commands_executed)
         self.assertEquals(self.expected_args, self.saved_args)
 
+    def test_populate_boot_without_boot_partition(self):
+        # Without a boot partition the files are only staged in boot_disk.
+        self.prepare_config(BoardConfig())
+        self.config.populate_boot(
+            'chroot_dir', 'rootfs_id', None, 'boot_disk',
+            'boot_device_or_file', False, False, [])
+        self.assertEquals(
+            ['mkdir -p boot_disk'], self.popen_fixture.mock.commands_executed)
+        self.assertEquals(self.expected_args, self.saved_args)
+
     def test_populate_boot_no_bootloader_flavor(self):
         self.prepare_config(BoardConfig())
         self.config.bootloader_file_in_boot_part = True
@@ -3539,13 +4211,42 @@ class TestPopulateRootFS(TestCaseWithFixtures):
             '%s mount /dev/rootfs %s' % (sudo_args, root_disk),
             '%s mv %s %s %s' % (
                 sudo_args, contents_bin, contents_etc, root_disk),
-            '%s dd if=/dev/zero of=%s bs=1M count=100' % (
-                sudo_args, swap_file),
+            '%s fallocate -l 100M %s' % (sudo_args, swap_file),
             '%s mkswap %s' % (sudo_args, swap_file),
             'sync',
             '%s umount %s' % (sudo_args, root_disk)]
         self.assertEqual(expected, popen_fixture.mock.commands_executed)
 
+    def test_finalize_rootfs(self):
+        def fake_append_to_fstab(disk, additions):
+            self.lines_added_to_fstab = additions
+
+        def fake_create_flash_kernel_config(disk, mmc_device_id,
+                                            partition_offset):
+            self.create_flash_kernel_config_called = True
+
+        self.useFixture(MockSomethingFixture(
+            sys, 'stdout', open('/dev/null', 'w')))
+        self.useFixture(MockSomethingFixture(
+            rootfs, 'append_to_fstab', fake_append_to_fstab))
+        self.useFixture(MockSomethingFixture(
+            rootfs, 'create_flash_kernel_config',
+            fake_create_flash_kernel_config))
+        popen_fixture = self.useFixture(MockCmdRunnerPopenFixture())
+        root_disk = self.useFixture(CreateTempDirFixture()).tempdir
+
+        finalize_rootfs(
+            root_disk, rootfs_type='ext4', rootfs_id='UUID=uuid',
+            should_create_swap=False, swap_size=None, mmc_device_id=0,
+            partition_offset=0)
+
+        # Nothing is mounted or moved; the rootfs is expected to be in place.
+        self.assertEqual(
+            ['UUID=uuid / ext4  errors=remount-ro 0 1'],
+            self.lines_added_to_fstab)
+        self.assertEqual(True, self.create_flash_kernel_config_called)
+        self.assertEqual(None, popen_fixture.mock.calls)
+
     def test_create_flash_kernel_config(self):
         fixture = self.useFixture(MockCmdRunnerPopenFixture())
         tempdir = self.useFixture(CreateTempDirFixture()).tempdir
@@ -3596,6 +4297,20 @@ class TestPopulateRootFS(TestCaseWithFixtures):
         self.assertEqual(['%s mv %s /tmp/' % (sudo_args, file1)],
                          popen_fixture.mock.commands_executed)
 
+    def test_move_contents_across_filesystems(self):
+        tempdir = self.useFixture(CreateTempDirFixture()).tempdir
+        popen_fixture = self.useFixture(MockCmdRunnerPopenFixture())
+        self.useFixture(MockSomethingFixture(
+            rootfs, '_is_same_filesystem', lambda path, other_path: False))
+
+        move_contents(tempdir, '/mnt/root')
+
+        self.assertEqual(
+            ['%s %s -m linaro_image_tools.media_create.copy_tree %s '
+             '/mnt/root --jobs 4 --remove-source' % (
+                 sudo_args, sys.executable, tempdir)],
+            popen_fixture.mock.commands_executed)
+
     def test_has_space_left_for_swap(self):
         statvfs = os.statvfs('/')
         space_left = statvfs.f_bavail * statvfs.f_bsize
@@ -3724,6 +4439,660 @@ class TestPopulateRootFS(TestCaseWithFixtures):
         f.close()
         self.assertEquals("\nfoo\nbar\n", contents)
 
+    def test_create_swap_file(self):
+        fixture = self.useFixture(MockCmdRunnerPopenFixture())
+        rootfs.create_swap_file('/mnt/SWAP.swap', 1024)
+        self.assertEqual(
+            ['%s fallocate -l 1024M /mnt/SWAP.swap' % sudo_args,
+             '%s mkswap /mnt/SWAP.swap' % sudo_args],
+            fixture.mock.commands_executed)
+
+    def test_create_swap_file_without_fallocate(self):
+        commands = []
+
+        class Proc(object):
+
+            def __init__(self, args):
+                self.args = args
+
+            def communicate(self, input=None):
+                return self.wait(), None
+
+            def wait(self):
+                if self.args[0] == 'fallocate':
+                    raise cmd_runner.SubcommandNonZeroReturnValue(
+                        self.args, 1)
+                return 0
+
+        def run(args, **kwargs):
+            commands.append(' '.join(args))
+            return Proc(args)
+
+        self.useFixture(MockSomethingFixture(cmd_runner, 'run', run))
+        rootfs.create_swap_file('/mnt/SWAP.swap', 1024)
+        self.assertEqual(
+            ['fallocate -l 1024M /mnt/SWAP.swap',
+             'dd if=/dev/zero of=/mnt/SWAP.swap bs=1M count=1024',
+             'mkswap /mnt/SWAP.swap'],
+            commands)
+
+    def test_protected_file_edits(self):
+        fixture = self.useFixture(MockCmdRunnerPopenFixture())
+        tempdir = self.useFixture(CreateTempDirFixture()).get_temp_dir()
+        os.mkdir(os.path.join(tempdir, 'etc'))
+        open(os.path.join(tempdir, 'etc', 'fstab'), 'w').close()
+        with rootfs.protected_file_edits():
+            append_to_fstab(tempdir, ['foo'])
+            create_flash_kernel_config(
+                tempdir, mmc_device_id=0, boot_partition_number=1)
+            self.assertEqual(None, fixture.mock.calls)
+        # Both files are written by a single command.
+        self.assertEqual(
+            ['%s tar -x -p --same-owner -f - -C /' % sudo_args],
+            fixture.mock.commands_executed)
+
+    def test_protected_file_edits_writes_nothing_on_failure(self):
+        fixture = self.useFixture(MockCmdRunnerPopenFixture())
+
+        def fail():
+            with rootfs.protected_file_edits():
+                write_data_to_protected_file('/etc/nonexistant', 'foo')
+                raise RuntimeError('boom')
+
+        self.assertRaises(RuntimeError, fail)
+        self.assertEqual(None, fixture.mock.calls)
+
+    def test_make_edits_tarball(self):
+        tempdir = self.useFixture(CreateTempDirFixture()).get_temp_dir()
+        fstab = os.path.join(tempdir, 'fstab')
+        open(fstab, 'w').close()
+        os.chmod(fstab, 0600)
+        new_file = os.path.join(tempdir, 'flash-kernel.conf')
+        tarball = rootfs._make_edits_tarball(
+            {fstab: 'foo\n', new_file: 'bar\n'})
+        tar = tarfile.open(fileobj=StringIO(tarball))
+        [new_member, fstab_member] = tar.getmembers()
+        self.assertEqual(fstab.lstrip('/'), fstab_member.name)
+        self.assertEqual(0600, fstab_member.mode)
+        self.assertEqual(os.stat(fstab).st_uid, fstab_member.uid)
+        self.assertEqual('foo\n', tar.extractfile(fstab_member).read())
+        self.assertEqual(new_file.lstrip('/'), new_member.name)
+        self.assertEqual(0644, new_member.mode)
+        self.assertEqual(0, new_member.uid)
+        self.assertEqual('bar\n', tar.extractfile(new_member).read())
+
+
+class TestFsImage(TestCaseWithFixtures):
+
+    def setUp(self):
+        super(TestFsImage, self).setUp()
+        self.tempdir = self.useFixture(CreateTempDirFixture()).get_temp_dir()
+
+    def test_make_rootfs_image_ext4(self):
+        fixture = self.useFixture(MockCmdRunnerPopenFixture())
+        fs_image = os.path.join(self.tempdir, 'root.img')
+        make_rootfs_image(
+            'rootfs_dir', fs_image, 4 * 1024 * 1024, 'ext4', 'rootfs',
+            'the-uuid')
+        self.assertEqual(
+            ['%s mkfs.ext4 -F -q -E nodiscard -d rootfs_dir -L rootfs '
+             '-U the-uuid %s' % (sudo_args, fs_image)],
+            fixture.mock.commands_executed)
+        self.assertEqual(4 * 1024 * 1024, os.path.getsize(fs_image))
+
+    def test_make_rootfs_image_btrfs(self):
+        fixture = self.useFixture(MockCmdRunnerPopenFixture())
+        fs_image = os.path.join(self.tempdir, 'root.img')
+        make_rootfs_image(
+            'rootfs_dir', fs_image, 1024, 'btrfs', 'rootfs', 'the-uuid')
+        self.assertEqual(
+            ['%s mkfs.btrfs -f --rootdir rootfs_dir -L rootfs -U the-uuid '
+             '%s' % (sudo_args, fs_image)],
+            fixture.mock.commands_executed)
+
+    def test_make_rootfs_image_fast_image(self):
+        fixture = self.useFixture(MockCmdRunnerPopenFixture())
+        fs_image = os.path.join(self.tempdir, 'root.img')
+        make_rootfs_image(
+            'rootfs_dir', fs_image, 1024, 'ext4', 'rootfs', 'the-uuid',
+            format_profile='fast-image')
+        self.assertEqual(
+            ['%s mkfs.ext4 -F -q -E nodiscard,lazy_itable_init=1 '
+             '-J size=16 -d rootfs_dir -L rootfs -U the-uuid %s' % (
+                 sudo_args, fs_image)],
+            fixture.mock.commands_executed)
+
+    def test_make_rootfs_image_sdcard_profile_does_not_discard(self):
+        fixture = self.useFixture(MockCmdRunnerPopenFixture())
+        fs_image = os.path.join(self.tempdir, 'root.img')
+        make_rootfs_image(
+            'rootfs_dir', fs_image, 1024, 'ext4', 'rootfs', 'the-uuid',
+            format_profile='sdcard')
+        self.assertEqual(
+            ['%s mkfs.ext4 -F -q -E nodiscard -d rootfs_dir -L rootfs '
+             '-U the-uuid %s' % (sudo_args, fs_image)],
+            fixture.mock.commands_executed)
+
+    def test_make_rootfs_image_unsupported(self):
+        self.useFixture(MockCmdRunnerPopenFixture())
+        self.assertRaises(
+            ValueError, make_rootfs_image, 'rootfs_dir',
+            os.path.join(self.tempdir, 'root.img'), 1024, 'xfs', 'rootfs',
+            'the-uuid')
+
+    def test_make_bootfs_image(self):
+        fixture = self.useFixture(MockCmdRunnerPopenFixture())
+        boot_dir = os.path.join(self.tempdir, 'boot')
+        os.makedirs(os.path.join(boot_dir, 'dtbs'))
+        open(os.path.join(boot_dir, 'uImage'), 'w').close()
+        fs_image = os.path.join(self.tempdir, 'boot.img')
+        make_bootfs_image(boot_dir, fs_image, 64 * 1024 * 1024, 32, 'boot')
+        self.assertEqual(
+            ['mkfs.vfat -C -F 32 -n boot %s 65536' % fs_image,
+             'mcopy -s -p -i %s %s/dtbs %s/uImage ::' % (
+                 fs_image, boot_dir, boot_dir)],
+            fixture.mock.commands_executed)
+
+    def test_splice_fs_image(self):
+        image_file = os.path.join(self.tempdir, 'image')
+        with open(image_file, 'wb') as fd:
+            fd.truncate(8 * 1024 * 1024)
+        fs_image = os.path.join(self.tempdir, 'fs.img')
+        with open(fs_image, 'wb') as fd:
+            fd.write('start')
+            fd.seek(2 * 1024 * 1024)
+            # Blocks of zeros which were written are written to the image
+            # file too, so that they're not left out of its block map.
+            fd.write('\0' * 8192 + 'end')
+        splice_fs_image(fs_image, image_file, 1024 * 1024)
+        with open(image_file, 'rb') as fd:
+            data = fd.read()
+        self.assertEqual(8 * 1024 * 1024, len(data))
+        self.assertEqual('start', data[1024 * 1024:1024 * 1024 + 5])
+        self.assertEqual(
+            'end', data[3 * 1024 * 1024 + 8192:3 * 1024 * 1024 + 8195])
+        self.assertEqual(len(data) - 8, data.count('\0'))
+        self.assertEqual(
+            [(256, 256), (768, 770)], get_mapped_ranges(image_file))
+
+
+class TestBmap(TestCaseWithFixtures):
+
+    def setUp(self):
+        super(TestBmap, self).setUp()
+        tempdir = self.useFixture(CreateTempDirFixture()).get_temp_dir()
+        self.image_file = os.path.join(tempdir, 'sd.img')
+        with open(self.image_file, 'wb') as fd:
+            fd.truncate(64 * 1024 * 1024)
+            fd.seek(5000)
+            fd.write('data' * 3000)
+            fd.seek(40 * 1024 * 1024)
+            fd.write('x')
+
+    def test_get_mapped_ranges(self):
+        self.assertEqual(
+            [(1, 4), (10240, 10240)], get_mapped_ranges(self.image_file))
+
+    def test_get_mapped_ranges_without_seek_data(self):
+        def no_seek_data(fd, size):
+            raise OSError(errno.EINVAL, 'Invalid argument')
+        self.useFixture(MockSomethingFixture(
+            bmap, '_get_data_extents', no_seek_data))
+        # Without SEEK_DATA there's no telling holes from blocks of zeros
+        # that were written, so the whole image is mapped.
+        self.assertEqual([(0, 16383)], get_mapped_ranges(self.image_file))
+
+    def test_generate_bmap(self):
+        contents = generate_bmap(self.image_file)
+        self.assertIn('<ImageSize> 67108864 </ImageSize>', contents)
+        self.assertIn('<BlocksCount> 16384 </BlocksCount>', contents)
+        self.assertIn('<MappedBlocksCount> 5 </MappedBlocksCount>', contents)
+        with open(self.image_file, 'rb') as fd:
+            fd.seek(4096)
+            range_checksum = hashlib.sha256(fd.read(4 * 4096)).hexdigest()
+        self.assertIn(
+            '<Range chksum="%s"> 1-4 </Range>' % range_checksum, contents)
+        self.assertIn('> 10240 </Range>', contents)
+
+    def test_generate_bmap_file_checksum(self):
+        # The checksum of the bmap is that of its contents with the checksum
+        # itself replaced by zeros.
+        contents = generate_bmap(self.image_file)
+        checksum = re.search(
+            '<BmapFileChecksum> (.*) </BmapFileChecksum>', contents).group(1)
+        self.assertEqual(
+            checksum,
+            hashlib.sha256(contents.replace(checksum, '0' * 64)).hexdigest())
+
+    def test_write_bmap(self):
+        self.assertEqual(
+            self.image_file + '.bmap', write_bmap(self.image_file))
+        self.assertEqual(
+            generate_bmap(self.image_file),
+            open(self.image_file + '.bmap').read())
+
+
+class TestFlash(TestCaseWithFixtures):
+
+    def setUp(self):
+        super(TestFlash, self).setUp()
+        self.tempdir = self.useFixture(CreateTempDirFixture()).get_temp_dir()
+        self.image_file = os.path.join(self.tempdir, 'sd.img')
+        with open(self.image_file, 'wb') as fd:
+            fd.truncate(64 * 1024 * 1024)
+            fd.seek(5000)
+            fd.write('data' * 3000)
+            fd.seek(40 * 1024 * 1024)
+            fd.write('x')
+        # A regular file standing in for the device.
+        self.device = os.path.join(self.tempdir, 'device')
+        with open(self.device, 'wb') as fd:
+            fd.truncate(64 * 1024 * 1024)
+
+    def test_get_write_ranges(self):
+        mib = 1024 * 1024
+        self.assertEqual(
+            [(0, 4 * mib), (40 * mib, 44 * mib)],
+            get_write_ranges(self.image_file))
+
+    def test_get_write_ranges_merges_small_holes(self):
+        self.assertEqual(
+            [(0, 44 * 1024 * 1024)],
+            get_write_ranges(
+                self.image_file, min_skipped_hole=64 * 1024 * 1024))
+
+    def test_get_write_ranges_stops_at_end_of_image(self):
+        with open(self.image_file, 'r+b') as fd:
+            fd.truncate(40 * 1024 * 1024 + 10)
+        self.assertEqual(
+            (40 * 1024 * 1024, 40 * 1024 * 1024 + 10),
+            get_write_ranges(self.image_file)[-1])
+
+    def test_write_image(self):
+        progress = []
+        write_image(self.image_file, self.device, chunk_size=4096,
+                    progress=lambda done, total: progress.append(done))
+        self.assertEqual(
+            open(self.image_file, 'rb').read(),
+            open(self.device, 'rb').read())
+        # Four blocks for the data at 5000 and one for that at 40MiB, then
+        # the same again for the verification.
+        self.assertEqual([4096, 8192, 12288, 16384, 20480] * 2, progress)
+
+    def test_write_image_verification_failure(self):
+        self.useFixture(MockSomethingFixture(
+            flash, '_copy_ranges', lambda *args: None))
+        self.assertRaises(
+            FlashVerificationError, write_image, self.image_file,
+            self.device, chunk_size=4096)
+
+    def test_write_image_without_verification(self):
+        self.useFixture(MockSomethingFixture(
+            flash, '_copy_ranges', lambda *args: None))
+        write_image(
+            self.image_file, self.device, verify=False, chunk_size=4096)
+
+    def test_get_block_device_size(self):
+        os.makedirs(os.path.join(self.tempdir, 'mmcblk0'))
+        with open(os.path.join(self.tempdir, 'mmcblk0', 'size'), 'w') as fd:
+            fd.write('7744512\n')
+        self.useFixture(MockSomethingFixture(
+            flash, 'SYS_CLASS_BLOCK', self.tempdir))
+        self.assertEqual(
+            7744512 * 512, get_block_device_size('/dev/mmcblk0'))
+
+    def test_flash_image(self):
+        fixture = self.useFixture(MockCmdRunnerPopenFixture())
+        flash_image('sd.img', '/dev/mmcblk0')
+        self.assertEqual(1, len(fixture.mock.commands_executed))
+        self.assertTrue(fixture.mock.commands_executed[0].endswith(
+            ' -m linaro_image_tools.media_create.flash sd.img /dev/mmcblk0'))
+
+    def test_flash_image_machine_readable(self):
+        fixture = self.useFixture(MockCmdRunnerPopenFixture())
+        flash._run_flash_helper(
+            'sd.img', '/dev/mmcblk0', False, machine_readable=True).wait()
+        self.assertTrue(fixture.mock.commands_executed[0].endswith(
+            ' sd.img /dev/mmcblk0 --no-verify --machine-readable'))
+
+
+class TestFlashImageToDevices(TestCaseWithFixtures):
+
+    def mock_helpers(self, scripts):
+        # Each device's helper is a shell script printing what the real one
+        # would.
+        def run_helper(image_file, device, verify, machine_readable=False,
+                       stdout=None, stderr=None):
+            return cmd_runner.run(
+                ['sh', '-c', scripts[device]], stdout=stdout, stderr=stderr)
+        self.useFixture(MockSomethingFixture(
+            flash, '_run_flash_helper', run_helper))
+
+    def test_all_devices_written(self):
+        self.mock_helpers({
+            '/dev/sdb': 'echo write 5 10; echo write 10 10; echo verify 10 10',
+            '/dev/sdc': 'echo write 10 10; echo verify 10 10',
+        })
+        reports = []
+        jobs = flash_image_to_devices(
+            'sd.img', ['/dev/sdb', '/dev/sdc'],
+            report=lambda jobs: reports.append(
+                [job.describe() for job in jobs]))
+        self.assertEqual(['/dev/sdb', '/dev/sdc'], [j.device for j in jobs])
+        self.assertTrue(all(job.succeeded for job in jobs))
+        self.assertEqual([10, 10], [job.written for job in jobs])
+        self.assertTrue(
+            reports[-1][0].startswith('/dev/sdb: done, verified'))
+
+    def test_failure_is_isolated(self):
+        self.mock_helpers({
+            '/dev/sdb': 'echo write 4 10; echo Input/output error; exit 1',
+            '/dev/sdc': 'echo write 10 10; echo verify 10 10',
+        })
+        failed, succeeded = flash_image_to_devices(
+            'sd.img', ['/dev/sdb', '/dev/sdc'])
+        self.assertEqual(1, failed.returncode)
+        self.assertEqual(['Input/output error'], failed.output)
+        self.assertEqual(
+            '/dev/sdb: FAILED: Input/output error', failed.describe())
+        self.assertTrue(succeeded.succeeded)
+
+    def test_describe_progress(self):
+        self.mock_helpers({'/dev/sdb': 'true'})
+        job = FlashJob('sd.img', '/dev/sdb')
+        job._handle_line('write 25 100')
+        self.assertTrue(job.describe().startswith('/dev/sdb: writing 25% ('))
+        job._handle_line('verify 50 100')
+        self.assertEqual('/dev/sdb: verifying 50%', job.describe())
+        job.proc.wait()
+
+
+class TestCopyTree(TestCaseWithFixtures):
+
+    def setUp(self):
+        super(TestCopyTree, self).setUp()
+        tempdir = self.useFixture(CreateTempDirFixture()).get_temp_dir()
+        self.source = os.path.join(tempdir, 'source')
+        self.target = os.path.join(tempdir, 'target')
+        os.makedirs(os.path.join(self.source, 'etc', 'default'))
+        os.mkdir(self.target)
+
+    def write_file(self, path, data):
+        path = os.path.join(self.source, path)
+        with open(path, 'w') as fd:
+            fd.write(data)
+        return path
+
+    def test_copy_tree(self):
+        self.write_file('etc/hostname', 'linaro\n')
+        self.write_file('etc/default/rcS', 'UTC=yes\n')
+        os.symlink('hostname', os.path.join(self.source, 'etc', 'link'))
+        copy_tree.copy_tree(self.source, self.target, jobs=2)
+        self.assertEqual(
+            'linaro\n',
+            open(os.path.join(self.target, 'etc', 'hostname')).read())
+        self.assertEqual(
+            'UTC=yes\n',
+            open(os.path.join(self.target, 'etc', 'default', 'rcS')).read())
+        self.assertEqual(
+            'hostname', os.readlink(os.path.join(self.target, 'etc', 'link')))
+        # The source is left alone.
+        self.assertTrue(
+            os.path.exists(os.path.join(self.source, 'etc', 'hostname')))
+
+    def test_copy_tree_preserves_modes_and_times(self):
+        path = self.write_file('etc/shadow', 'root:*:15000:0:99999:7:::\n')
+        os.chmod(path, 0640)
+        os.utime(path, (1000000000, 1000000000))
+        os.chmod(os.path.join(self.source, 'etc', 'default'), 0700)
+        copy_tree.copy_tree(self.source, self.target)
+        st = os.stat(os.path.join(self.target, 'etc', 'shadow'))
+        self.assertEqual(0640, stat.S_IMODE(st.st_mode))
+        self.assertEqual(1000000000, int(st.st_mtime))
+        self.assertEqual(0700, stat.S_IMODE(os.stat(
+            os.path.join(self.target, 'etc', 'default')).st_mode))
+
+    def test_copy_tree_preserves_hardlinks(self):
+        path = self.write_file('etc/hostname', 'linaro\n')
+        os.link(path, os.path.join(self.source, 'etc', 'default', 'hostname'))
+        copy_tree.copy_tree(self.source, self.target, jobs=2)
+        self.assertEqual(
+            os.stat(os.path.join(self.target, 'etc', 'hostname')).st_ino,
+            os.stat(os.path.join(
+                self.target, 'etc', 'default', 'hostname')).st_ino)
+
+    def test_copy_tree_preserves_holes(self):
+        path = os.path.join(self.source, 'swap')
+        with open(path, 'wb') as fd:
+            fd.write('data')
+            fd.truncate(16 * 1024 * 1024)
+        copy_tree.copy_tree(self.source, self.target)
+        copied = os.path.join(self.target, 'swap')
+        self.assertEqual(16 * 1024 * 1024, os.path.getsize(copied))
+        self.assertEqual(bmap.get_data_extents(path),
+                         bmap.get_data_extents(copied))
+        self.assertEqual('data\0', open(copied).read(5))
+
+    def test_copy_tree_preserves_xattrs(self):
+        path = self.write_file('etc/hostname', 'linaro\n')
+        copy_tree._set_xattr(path, 'user.test', 'value')
+        if copy_tree._list_xattrs(path) != ['user.test']:
+            self.skip("No user extended attributes on %s" % self.source)
+        copy_tree.copy_tree(self.source, self.target)
+        self.assertEqual('value', copy_tree._get_xattr(
+            os.path.join(self.target, 'etc', 'hostname'), 'user.test'))
+
+    def test_copy_tree_copies_fifos(self):
+        os.mkfifo(os.path.join(self.source, 'initctl'))
+        copy_tree.copy_tree(self.source, self.target)
+        self.assertTrue(stat.S_ISFIFO(
+            os.lstat(os.path.join(self.target, 'initctl')).st_mode))
+
+    def test_copy_tree_reports_progress(self):
+        self.write_file('etc/hostname', 'linaro\n')
+        self.write_file('etc/default/rcS', 'UTC=yes\n')
+        reports = []
+        copy_tree.copy_tree(
+            self.source, self.target,
+            progress=lambda done, total, seconds: reports.append(
+                (done, total)))
+        self.assertEqual((15, 15), reports[-1])
+
+    def test_copy_tree_overwrites_files(self):
+        self.write_file('etc/hostname', 'linaro\n')
+        os.mkdir(os.path.join(self.target, 'etc'))
+        with open(os.path.join(self.target, 'etc', 'hostname'), 'w') as fd:
+            fd.write('previous contents\n')
+        copy_tree.copy_tree(self.source, self.target)
+        self.assertEqual(
+            'linaro\n',
+            open(os.path.join(self.target, 'etc', 'hostname')).read())
+
+    def test_copy_tree_failure(self):
+        self.write_file('etc/hostname', 'linaro\n')
+
+        def fail(source, dest, st, counter):
+            raise IOError(errno.EIO, 'I/O error')
+
+        self.useFixture(MockSomethingFixture(copy_tree, '_copy_file', fail))
+        self.assertRaises(
+            IOError, copy_tree.copy_tree, self.source, self.target, jobs=2)
+
+    def test_copy_tree_fails_on_unlistable_directory(self):
+        self.write_file('etc/default/rcS', 'UTC=yes\n')
+        unreadable = os.path.join(self.source, 'etc', 'default')
+        listdir = os.listdir
+
+        def mock_listdir(path):
+            if path == unreadable:
+                raise OSError(errno.EACCES, 'Permission denied', path)
+            return listdir(path)
+
+        self.useFixture(MockSomethingFixture(os, 'listdir', mock_listdir))
+        self.assertRaises(
+            OSError, copy_tree.copy_tree, self.source, self.target)
+
+    def test_remove_contents(self):
+        self.write_file('etc/hostname', 'linaro\n')
+        os.symlink('etc', os.path.join(self.source, 'link'))
+        copy_tree.remove_contents(self.source)
+        self.assertEqual([], os.listdir(self.source))
+
+
+class TestRootfsCache(TestCaseWithFixtures):
+
+    def setUp(self):
+        super(TestRootfsCache, self).setUp()
+        self.cache_dir = self.useFixture(
+            CreateTempDirFixture()).get_temp_dir()
+
+    def make_file(self, contents):
+        path = self.createTempFileAsFixture()
+        with open(path, 'w') as fd:
+            fd.write(contents)
+        return path
+
+    def make_entry(self, key, size, last_used):
+        entry_dir = os.path.join(self.cache_dir, key)
+        os.makedirs(os.path.join(entry_dir, 'tree'))
+        with open(os.path.join(entry_dir, 'size'), 'w') as fd:
+            fd.write(str(size))
+        stamp = os.path.join(entry_dir, 'last-used')
+        open(stamp, 'w').close()
+        os.utime(stamp, (last_used, last_used))
+
+    def test_get_cache_key(self):
+        binary = self.make_file('binary')
+        hwpack1 = self.make_file('hwpack1')
+        hwpack2 = self.make_file('hwpack2')
+        script = self.make_file('script')
+        key = get_cache_key(binary, [hwpack1, hwpack2], script)
+        self.assertEqual(
+            key, get_cache_key(binary, [hwpack1, hwpack2], script))
+        self.assertNotEqual(
+            key, get_cache_key(binary, [hwpack2, hwpack1], script))
+        self.assertNotEqual(
+            key, get_cache_key(binary, [hwpack1, hwpack2], script,
+                               extra=['btrfs-tools=True']))
+        with open(script, 'w') as fd:
+            fd.write('changed script')
+        self.assertNotEqual(
+            key, get_cache_key(binary, [hwpack1, hwpack2], script))
+
+    def try_exclusive_lock(self):
+        """Return whether another run could evict entries right now."""
+        with open(os.path.join(self.cache_dir, 'lock'), 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError, e:
+                if e.errno != errno.EWOULDBLOCK:
+                    raise
+                return False
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            return True
+
+    def test_lookup_miss(self):
+        cache = RootfsCache(self.cache_dir, 1000)
+        self.assertEqual(None, cache.lookup('key'))
+        self.assertTrue(self.try_exclusive_lock())
+
+    def test_lookup_incomplete_entry(self):
+        # An entry without its size was not fully stored.
+        os.makedirs(os.path.join(self.cache_dir, 'key', 'tree'))
+        cache = RootfsCache(self.cache_dir, 1000)
+        self.assertEqual(None, cache.lookup('key'))
+
+    def test_lookup_hit(self):
+        self.make_entry('key', 10, 0)
+        cache = RootfsCache(self.cache_dir, 1000)
+        self.addCleanup(cache.release)
+        self.assertEqual(
+            os.path.join(self.cache_dir, 'key', 'tree'), cache.lookup('key'))
+        self.assertNotEqual(
+            0, os.path.getmtime(
+                os.path.join(self.cache_dir, 'key', 'last-used')))
+
+    def test_store(self):
+        fixture = self.useFixture(MockCmdRunnerPopenFixture('1234\ttree'))
+        cache = RootfsCache(self.cache_dir, 1000000)
+        cache.store('key', '/tmp/rootfs')
+        tree = os.path.join(self.cache_dir, 'key', 'tree')
+        # The tree is copied in a directory of its own, so that runs storing
+        # the same key don't get in each other's way.
+        [tmp_dir] = glob.glob(os.path.join(self.cache_dir, 'key', 'tree.*'))
+        tmp_tree = os.path.join(tmp_dir, 'tree')
+        self.assertEqual(
+            ['%s cp -a /tmp/rootfs %s' % (sudo_args, tmp_tree),
+             '%s du -sb %s' % (sudo_args, tmp_tree),
+             '%s rm -rf %s' % (sudo_args, tree),
+             '%s mv %s %s' % (sudo_args, tmp_tree, tree),
+             '%s rm -rf %s' % (sudo_args, tmp_dir)],
+            fixture.mock.commands_executed)
+        self.assertEqual(
+            '1234', open(os.path.join(self.cache_dir, 'key', 'size')).read())
+
+    def test_copy_to(self):
+        fixture = self.useFixture(MockCmdRunnerPopenFixture())
+        cache = RootfsCache(self.cache_dir, 1000)
+        cache.copy_to('key', '/mnt/root')
+        self.assertEqual(
+            ['%s cp -a %s/key/tree/. /mnt/root' % (sudo_args, self.cache_dir)],
+            fixture.mock.commands_executed)
+
+    def test_lookup_hit_locks_until_copied(self):
+        # The entry found can't be evicted by another run before it's
+        # copied.
+        self.make_entry('key', 10, 0)
+        self.useFixture(MockCmdRunnerPopenFixture())
+        cache = RootfsCache(self.cache_dir, 1000)
+        self.addCleanup(cache.release)
+        cache.lookup('key')
+        self.assertFalse(self.try_exclusive_lock())
+        cache.clone('key', '/tmp/rootfs')
+        self.assertTrue(self.try_exclusive_lock())
+
+    def test_copy_to_waits_for_stores(self):
+        fixture = self.useFixture(MockCmdRunnerPopenFixture())
+        cache = RootfsCache(self.cache_dir, 1000)
+        lock = open(os.path.join(self.cache_dir, 'lock'), 'a')
+        self.addCleanup(lock.close)
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        copier = threading.Thread(
+            target=cache.copy_to, args=('key', '/mnt/root'))
+        copier.start()
+        copier.join(0.2)
+        self.assertTrue(copier.is_alive())
+        self.assertEqual(None, fixture.mock.calls)
+        fcntl.flock(lock, fcntl.LOCK_UN)
+        copier.join()
+        self.assertEqual(1, len(fixture.mock.commands_executed))
+
+    def test_evict_least_recently_used(self):
+        self.make_entry('old', 600, 1000)
+        self.make_entry('older', 600, 100)
+        self.make_entry('new', 600, 2000)
+        fixture = self.useFixture(MockCmdRunnerPopenFixture())
+        cache = RootfsCache(self.cache_dir, 1300)
+        cache.evict()
+        self.assertEqual(
+            ['%(sudo)s rm -rf %(entry)s/size %(entry)s/last-used '
+             '%(entry)s/tree' % dict(
+                 sudo=sudo_args,
+                 entry=os.path.join(self.cache_dir, 'older'))],
+            fixture.mock.commands_executed)
+
+    def test_evict_keeps_given_key(self):
+        self.make_entry('old', 600, 1000)
+        self.make_entry('new', 600, 2000)
+        fixture = self.useFixture(MockCmdRunnerPopenFixture())
+        cache = RootfsCache(self.cache_dir, 500)
+        cache.evict(keep='new')
+        self.assertEqual(
+            ['%(sudo)s rm -rf %(entry)s/size %(entry)s/last-used '
+             '%(entry)s/tree' % dict(
+                 sudo=sudo_args, entry=os.path.join(self.cache_dir, 'old'))],
+            fixture.mock.commands_executed)
+
 
 class TestCheckDevice(TestCaseWithFixtures):
 
@@ -3990,6 +5359,56 @@ class TestInstallHWPack(TestCaseWithFixtures):
             "%s %s" % (sudo_args, line % keywords) for line in expected]
         self.assertEquals(expected, fixture.mock.commands_executed)
 
+    def test_install_merged_hwpacks(self):
+        self.useFixture(MockSomethingFixture(
+            sys, 'stdout', open('/dev/null', 'w')))
+        fixture = self.useFixture(MockCmdRunnerPopenFixture())
+        chroot_dir = 'chroot_dir'
+        tmp_dir = 'tmp_dir'
+        self.mock_prepare_chroot(chroot_dir, tmp_dir)
+        prefer_dir = preferred_tools_dir()
+
+        hwpack_dir = tempfile.mkdtemp()
+        hwpack_tgz_locations = []
+        for hwpack_file_name in ['hwpack1.tgz', 'hwpack2.tgz']:
+            hwpack_tgz_location = os.path.join(hwpack_dir, hwpack_file_name)
+            hwpack_tgz_locations.append(hwpack_tgz_location)
+            self.create_minimal_v3_hwpack(
+                hwpack_tgz_location, hwpack_file_name, "4", "armel")
+
+        # Both hwpacks are verified, so --force-yes is passed.
+        install_merged_hwpacks(
+            chroot_dir, tmp_dir, prefer_dir, False,
+            ['hwpack1.tgz', 'hwpack2.tgz'], False, *hwpack_tgz_locations,
+            skip_installed=True)
+        linaro_hwpack_install = find_command(
+            'linaro-hwpack-install', prefer_dir=prefer_dir)
+        expected = [
+            'prepare_chroot %(chroot_dir)s %(tmp_dir)s',
+            'cp %(linaro_hwpack_install)s %(chroot_dir)s/usr/bin',
+            'mount proc %(chroot_dir)s/proc -t proc',
+            'chroot %(chroot_dir)s true',
+            'cp %(hwpack1)s %(chroot_dir)s',
+            'cp %(hwpack2)s %(chroot_dir)s',
+            ('%(chroot_args)s %(chroot_dir)s linaro-hwpack-install '
+             '--force-yes --skip-installed '
+             '--hwpack-version 4 --hwpack-arch armel '
+             '--hwpack-name hwpack1.tgz /hwpack1.tgz '
+             '--hwpack-version 4 --hwpack-arch armel '
+             '--hwpack-name hwpack2.tgz /hwpack2.tgz'),
+            'rm -f %(chroot_dir)s/hwpack2.tgz',
+            'rm -f %(chroot_dir)s/hwpack1.tgz',
+            'umount -v %(chroot_dir)s/proc',
+            'rm -f %(chroot_dir)s/usr/bin/linaro-hwpack-install']
+        keywords = dict(
+            chroot_dir=chroot_dir, tmp_dir=tmp_dir, chroot_args=chroot_args,
+            linaro_hwpack_install=linaro_hwpack_install,
+            hwpack1=hwpack_tgz_locations[0],
+            hwpack2=hwpack_tgz_locations[1])
+        expected = [
+            "%s %s" % (sudo_args, line % keywords) for line in expected]
+        self.assertEquals(expected, fixture.mock.commands_executed)
+
     def test_install_packages(self):
         self.useFixture(MockSomethingFixture(
             sys, 'stdout', open('/dev/null', 'w')))
@@ -4097,3 +5516,314 @@ class TestInstallHWPack(TestCaseWithFixtures):
         def clear_atexits():
             linaro_image_tools.media_create.chroot_utils.local_atexit = []
         self.addCleanup(clear_atexits)
+
+
+class TestHostInstall(TestCaseWithFixtures):
+
+    status = textwrap.dedent("""\
+        Package: dpkg
+        Status: install ok installed
+        Architecture: armel
+        Version: 1.16.1
+
+        Package: libc6
+        Status: install ok installed
+        Architecture: armel
+        Version: 2.15-0ubuntu10
+        Provides: glibc-2.13-1
+        """)
+
+    def setUp(self):
+        super(TestHostInstall, self).setUp()
+        self.tempdir = self.useFixture(CreateTempDirFixture()).get_temp_dir()
+
+    def make_deb(self, name, version, control='', files={}, scripts={}):
+        build_dir = os.path.join(self.tempdir, 'build-%s' % name)
+        os.makedirs(os.path.join(build_dir, 'DEBIAN'))
+        with open(os.path.join(build_dir, 'DEBIAN', 'control'), 'w') as fd:
+            fd.write("Package: %s\nVersion: %s\nArchitecture: armel\n"
+                     "Maintainer: Nobody\n%sDescription: Dummy\n" % (
+                         name, version, control))
+        for script, data in scripts.items():
+            path = os.path.join(build_dir, 'DEBIAN', script)
+            with open(path, 'w') as fd:
+                fd.write(data)
+            os.chmod(path, 0755)
+        for path, data in files.items():
+            path = os.path.join(build_dir, path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as fd:
+                fd.write(data)
+        deb = os.path.join(self.tempdir, '%s_%s_armel.deb' % (name, version))
+        proc = subprocess.Popen(
+            ['dpkg-deb', '-b', build_dir, deb],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        proc.communicate()
+        self.assertEqual(0, proc.returncode)
+        return deb
+
+    def make_hwpack_dir(self, *debs):
+        hwpack_dir = os.path.join(self.tempdir, 'hwpack')
+        os.makedirs(os.path.join(hwpack_dir, 'pkgs'))
+        os.mkdir(os.path.join(hwpack_dir, 'sources.list.d'))
+        with open(os.path.join(hwpack_dir, 'FORMAT'), 'w') as fd:
+            fd.write('1.0\n')
+        manifest = []
+        for deb in debs:
+            name, version, _ = os.path.basename(deb).split('_')
+            manifest.append('%s=%s\n' % (name, version))
+            shutil.copy(deb, os.path.join(hwpack_dir, 'pkgs'))
+        with open(os.path.join(hwpack_dir, 'manifest'), 'w') as fd:
+            fd.write(''.join(manifest))
+        return hwpack_dir
+
+    def get_status(self, text=None):
+        from debian.deb822 import Deb822
+        return list(Deb822.iter_paragraphs(StringIO(text or self.status)))
+
+    def write_rootfs_file(self, path, data):
+        path = os.path.join(self.tempdir, 'rootfs', path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as fd:
+            fd.write(data)
+
+    def plan(self, hwpack_dir, status=None):
+        """Return the names of the packages to install and those left."""
+        packages, left = host_install.plan_install(
+            hwpack_dir, host_install.read_manifest(hwpack_dir), 'armel',
+            self.get_status(status), os.path.join(self.tempdir, 'rootfs'))
+        return [package.name for package in packages], left
+
+    def test_plan_install(self):
+        hwpack_dir = self.make_hwpack_dir(
+            self.make_deb('foo', '1.0', 'Depends: libc6 (>= 2.15), bar\n'),
+            self.make_deb('bar', '2.0', 'Depends: glibc-2.13-1\n'))
+        self.assertEqual((['foo', 'bar'], []), self.plan(hwpack_dir))
+
+    def test_plan_install_leaves_installed_packages_out(self):
+        hwpack_dir = self.make_hwpack_dir(
+            self.make_deb('libc6', '2.15-0ubuntu10'),
+            self.make_deb('foo', '1.0'))
+        self.assertEqual((['foo'], []), self.plan(hwpack_dir))
+
+    def test_plan_install_maintainer_scripts(self):
+        # Only the package with maintainer scripts, and those depending on
+        # it, are left to linaro-hwpack-install.
+        hwpack_dir = self.make_hwpack_dir(
+            self.make_deb('foo', '1.0', scripts={'postinst': '#!/bin/sh\n'}),
+            self.make_deb('hwpack-board', '1.0', 'Depends: foo\n'),
+            self.make_deb('bar', '1.0'))
+        self.assertEqual(
+            (['bar'],
+             ['foo has maintainer scripts (postinst)',
+              'the dependency of hwpack-board on foo is not in the rootfs']),
+            self.plan(hwpack_dir))
+
+    def test_plan_install_unmet_dependency(self):
+        hwpack_dir = self.make_hwpack_dir(
+            self.make_deb('foo', '1.0', 'Depends: libc6 (>= 2.16) | baz\n'))
+        self.assertEqual(
+            ([],
+             ['the dependency of foo on libc6 | baz is not in the rootfs']),
+            self.plan(hwpack_dir))
+
+    def test_plan_install_other_version_installed(self):
+        hwpack_dir = self.make_hwpack_dir(self.make_deb('libc6', '2.16'))
+        self.assertEqual(
+            ([], ['another version of libc6 is in the rootfs']),
+            self.plan(hwpack_dir))
+
+    def test_plan_install_file_of_other_package(self):
+        self.write_rootfs_file(
+            'var/lib/dpkg/info/libc6.list', '/.\n/etc\n/etc/foo.conf\n')
+        hwpack_dir = self.make_hwpack_dir(
+            self.make_deb('foo', '1.0', files={'etc/foo.conf': 'foo\n'}),
+            self.make_deb('bar', '1.0', files={'etc/bar.conf': 'bar\n'}))
+        self.assertEqual(
+            (['bar'], ['/etc/foo.conf of foo belongs to libc6']),
+            self.plan(hwpack_dir))
+
+    def test_plan_install_same_file_in_two_packages(self):
+        hwpack_dir = self.make_hwpack_dir(
+            self.make_deb('foo', '1.0', files={'etc/foo.conf': 'foo\n'}),
+            self.make_deb('bar', '1.0', files={'etc/foo.conf': 'bar\n'}))
+        self.assertEqual(
+            (['foo'], ['/etc/foo.conf of bar belongs to foo']),
+            self.plan(hwpack_dir))
+
+    def test_plan_install_diverted_file(self):
+        self.write_rootfs_file(
+            'var/lib/dpkg/diversions',
+            '/etc/foo.conf\n/etc/foo.conf.real\nlibc6\n')
+        hwpack_dir = self.make_hwpack_dir(
+            self.make_deb('foo', '1.0', files={'etc/foo.conf': 'foo\n'}))
+        self.assertEqual(
+            ([], ['/etc/foo.conf of foo is diverted']), self.plan(hwpack_dir))
+
+    def test_plan_install_triggering_file(self):
+        self.write_rootfs_file(
+            'var/lib/dpkg/info/man-db.triggers',
+            '# Comment\ninterest-noawait /usr/share/man\ninterest ldconfig\n')
+        hwpack_dir = self.make_hwpack_dir(
+            self.make_deb('foo', '1.0', files={
+                'usr/share/man/man1/foo.1': '.TH FOO\n'}),
+            self.make_deb('bar', '1.0', files={
+                'usr/share/doc/bar/README': 'bar\n'}))
+        self.assertEqual(
+            (['bar'], ['/usr/share/man/man1/foo.1 of foo triggers man-db']),
+            self.plan(hwpack_dir))
+
+    def test_plan_install_filtered_file_does_not_trigger(self):
+        self.write_rootfs_file(
+            'var/lib/dpkg/info/man-db.triggers',
+            'interest-noawait /usr/share/man\n')
+        hwpack_dir = self.make_hwpack_dir(
+            self.make_deb('foo', '1.0', files={
+                'usr/share/man/man1/foo.1': '.TH FOO\n'}))
+        packages, left = host_install.plan_install(
+            hwpack_dir, host_install.read_manifest(hwpack_dir), 'armel',
+            self.get_status(), os.path.join(self.tempdir, 'rootfs'),
+            path_filter.PathFilter([(False, '/usr/share/man/*')]))
+        self.assertEqual(
+            (['foo'], []), ([package.name for package in packages], left))
+
+    def test_install_hwpack_on_host(self):
+        # The files are written directly rather than as root.
+        self.useFixture(MockSomethingFixture(cmd_runner, 'SUDO_ARGS', []))
+
+        def write_file(path, data):
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as fd:
+                fd.write(data)
+        self.useFixture(MockSomethingFixture(
+            host_install, 'write_data_to_protected_file', write_file))
+        rootfs_dir = os.path.join(self.tempdir, 'rootfs')
+        write_file(os.path.join(rootfs_dir, 'var/lib/dpkg/status'),
+                   self.status)
+        hwpack_dir = self.make_hwpack_dir(
+            self.make_deb('hwpack-board', '1.0', 'Depends: foo\n'),
+            self.make_deb(
+                'foo', '1.0', files={'etc/foo.conf': 'foo\n',
+                                     'DEBIAN/conffiles': '/etc/foo.conf\n'}))
+        write_file(os.path.join(hwpack_dir, 'sources.list.d', 'board'),
+                   'deb http://example.com/ precise main\n')
+
+        host_install.install_hwpack_on_host(
+            rootfs_dir, hwpack_dir, 'board', '1.0', 'armel')
+
+        self.assertEqual(
+            'foo\n', open(os.path.join(rootfs_dir, 'etc/foo.conf')).read())
+        info_dir = os.path.join(rootfs_dir, 'var/lib/dpkg/info')
+        self.assertEqual(
+            ['/.', '/etc', '/etc/foo.conf'],
+            open(os.path.join(info_dir, 'foo.list')).read().splitlines())
+        self.assertEqual(
+            '/etc/foo.conf\n',
+            open(os.path.join(info_dir, 'foo.conffiles')).read())
+        status = self.get_status(
+            open(os.path.join(rootfs_dir, 'var/lib/dpkg/status')).read())
+        self.assertEqual(
+            ['dpkg', 'libc6', 'hwpack-board', 'foo'],
+            [stanza['Package'] for stanza in status])
+        self.assertEqual('install ok installed', status[3]['Status'])
+        self.assertEqual(
+            '\n /etc/foo.conf %s' % hashlib.md5('foo\n').hexdigest(),
+            status[3]['Conffiles'])
+        self.assertEqual(
+            'Package: foo\nArchitecture: armel\nAuto-Installed: 1\n',
+            open(os.path.join(
+                rootfs_dir, 'var/lib/apt/extended_states')).read())
+        self.assertEqual(
+            'deb http://example.com/ precise main\n',
+            open(os.path.join(
+                rootfs_dir, 'etc/apt/sources.list.d/hwpack.board')).read())
+
+    def test_install_hwpack_on_host_leaves_packages(self):
+        self.useFixture(MockSomethingFixture(cmd_runner, 'SUDO_ARGS', []))
+        self.useFixture(MockSomethingFixture(
+            host_install, 'write_data_to_protected_file',
+            self.write_rootfs_file))
+        rootfs_dir = os.path.join(self.tempdir, 'rootfs')
+        self.write_rootfs_file('var/lib/dpkg/status', self.status)
+        hwpack_dir = self.make_hwpack_dir(
+            self.make_deb(
+                'linux-image', '1.0', scripts={'postinst': '#!/bin/sh\n'}),
+            self.make_deb('u-boot', '1.0', files={'boot/u-boot.bin': 'x'}))
+        self.assertEqual(
+            ['linux-image has maintainer scripts (postinst)'],
+            host_install.install_hwpack_on_host(
+                rootfs_dir, hwpack_dir, 'board', '1.0', 'armel'))
+        self.assertEqual(
+            'x', open(os.path.join(rootfs_dir, 'boot/u-boot.bin')).read())
+        status = self.get_status(
+            open(os.path.join(rootfs_dir, 'var/lib/dpkg/status')).read())
+        self.assertEqual(
+            ['dpkg', 'libc6', 'u-boot'],
+            [stanza['Package'] for stanza in status])
+
+    def test_install_hwpack_on_host_keeps_directory_symlinks(self):
+        self.useFixture(MockSomethingFixture(cmd_runner, 'SUDO_ARGS', []))
+        self.useFixture(MockSomethingFixture(
+            host_install, 'write_data_to_protected_file',
+            self.write_rootfs_file))
+        rootfs_dir = os.path.join(self.tempdir, 'rootfs')
+        self.write_rootfs_file('var/lib/dpkg/status', self.status)
+        os.mkdir(os.path.join(rootfs_dir, 'run'))
+        os.symlink('../run', os.path.join(rootfs_dir, 'var/run'))
+        hwpack_dir = self.make_hwpack_dir(
+            self.make_deb('foo', '1.0', files={'var/run/foo/README': 'x'}))
+        host_install.install_hwpack_on_host(
+            rootfs_dir, hwpack_dir, 'board', '1.0', 'armel')
+        self.assertTrue(os.path.islink(os.path.join(rootfs_dir, 'var/run')))
+        self.assertEqual(
+            'x', open(os.path.join(rootfs_dir, 'run/foo/README')).read())
+
+    def make_hwpack(self, architecture='armel'):
+        hwpack = os.path.join(self.tempdir, 'hwpack.tgz')
+        tar = tarfile.open(hwpack, mode='w:gz')
+        metadata = ("name: board\nversion: 1.0\narchitecture: %s\n"
+                    "format: 3.0\n" % architecture)
+        info = tarfile.TarInfo('metadata')
+        info.size = len(metadata)
+        tar.addfile(info, StringIO(metadata))
+        tar.close()
+        return hwpack
+
+    def test_install_hwpacks_on_host_falls_back(self):
+        self.useFixture(MockSomethingFixture(
+            host_install, 'install_hwpack_on_host',
+            MagicMock(side_effect=host_install.NotInstallableOnHost('no'))))
+        self.write_rootfs_file('var/lib/dpkg/status', self.status)
+        hwpack = self.make_hwpack()
+        self.assertEqual(
+            [hwpack, 'other.tgz'],
+            host_install.install_hwpacks_on_host(
+                os.path.join(self.tempdir, 'rootfs'), self.tempdir,
+                [hwpack, 'other.tgz']))
+
+    def test_install_hwpacks_on_host_leaves_rest_of_hwpack(self):
+        self.useFixture(MockSomethingFixture(
+            host_install, 'install_hwpack_on_host',
+            MagicMock(return_value=['foo has maintainer scripts (postinst)'])))
+        self.write_rootfs_file('var/lib/dpkg/status', self.status)
+        hwpack = self.make_hwpack()
+        self.assertEqual(
+            [hwpack, 'other.tgz'],
+            host_install.install_hwpacks_on_host(
+                os.path.join(self.tempdir, 'rootfs'), self.tempdir,
+                [hwpack, 'other.tgz']))
+
+    def test_install_hwpacks_on_host_checks_architecture_first(self):
+        # The hwpack isn't even extracted for another architecture.
+        self.useFixture(MockSomethingFixture(
+            tarfile.TarFile, 'extractall',
+            MagicMock(side_effect=AssertionError)))
+        self.write_rootfs_file('var/lib/dpkg/status', self.status)
+        hwpack = self.make_hwpack('armhf')
+        self.assertEqual(
+            [hwpack],
+            host_install.install_hwpacks_on_host(
+                os.path.join(self.tempdir, 'rootfs'), self.tempdir, [hwpack]))
@@ -17,20 +17,139 @@
 # You should have received a copy of the GNU General Public License
 # along with Linaro Image Tools.  If not, see <http://www.gnu.org/licenses/>.
 
+import subprocess
+import sys
+
 from linaro_image_tools import cmd_runner
+from linaro_image_tools.media_create.path_filter import filter_tarball
+from linaro_image_tools.utils import has_command
 
+# The magic bytes at the start of a file for each compression we know about.
+COMPRESSION_MAGIC = [
+    ('gzip', '\x1f\x8b'),
+    ('bzip2', 'BZh'),
+    ('xz', '\xfd7zXZ\x00'),
+    ('zstd', '\x28\xb5\x2f\xfd'),
+]
+# Multi-threaded decompressors for each compression, in order of preference.
+# They are passed to tar's --use-compress-program, so they must behave like
+# gzip when given -d.
+PARALLEL_DECOMPRESSORS = {
+    'gzip': ['pigz'],
+    'bzip2': ['lbzip2', 'pbzip2'],
+    'xz': ['xz -T0'],
+    'zstd': ['zstd -T0'],
+}
 
-def unpack_android_binary_tarball(tarball, unpack_dir, as_root=True):
-    proc = cmd_runner.run(
-        ['tar', '--numeric-owner', '-C', unpack_dir, '-jxf', tarball],
-        as_root=as_root)
-    proc.wait()
-    return proc.returncode
+
+def detect_compression(path):
+    """Return the compression used by the given file, by its magic bytes.
+
+    Returns None if the compression is unknown or the file can't be read.
+    """
+    try:
+        with open(path, 'rb') as fd:
+            header = fd.read(6)
+    except IOError:
+        return None
+    for compression, magic in COMPRESSION_MAGIC:
+        if header.startswith(magic):
+            return compression
+    return None
+
+
+def get_parallel_decompressor(compression):
+    """Return a multi-threaded decompressor for the given compression.
+
+    Returns None if there's none installed.
+    """
+    for decompressor in PARALLEL_DECOMPRESSORS.get(compression, []):
+        if has_command(decompressor.split()[0]):
+            return decompressor
+    return None
 
 
-def unpack_binary_tarball(tarball, unpack_dir, as_root=True):
-    proc = cmd_runner.run(
-        ['tar', '--numeric-owner', '-C', unpack_dir, '-xf', tarball],
-        as_root=as_root)
+def _unpack_filtered(tarball, unpack_dir, as_root, extra_args, path_filter,
+                     path_filter_root):
+    # The tarball is decompressed to a pipe and filtered on its way to tar.
+    args = ['tar', '--numeric-owner', '-C', unpack_dir, '-xf', '-']
+    args.extend(extra_args)
+    tar = cmd_runner.run(args, stdin=subprocess.PIPE, as_root=as_root)
+    compression = detect_compression(tarball)
+    decompressor = None
+    if compression is None:
+        source = open(tarball, 'rb')
+    else:
+        program = get_parallel_decompressor(compression) or compression
+        decompressor = cmd_runner.run(
+            program.split() + ['-dc', tarball], stdout=subprocess.PIPE)
+        source = decompressor.stdout
+    try:
+        filter_tarball(source, tar.stdin, path_filter, path_filter_root)
+    except:
+        exc_info = sys.exc_info()
+        source.close()
+        tar.stdin.close()
+        # Their failure is most likely caused by this one, which is the one
+        # worth reporting.
+        for proc in (decompressor, tar):
+            if proc is not None:
+                proc.except_on_cmd_fail = False
+                proc.wait()
+        raise exc_info[0], exc_info[1], exc_info[2]
+    source.close()
+    tar.stdin.close()
+    if decompressor is not None:
+        decompressor.wait()
+    tar.wait()
+    return tar.returncode
+
+
+def _unpack(tarball, unpack_dir, as_root, default_extract_args,
+            extra_args=None):
+    args = ['tar', '--numeric-owner', '-C', unpack_dir]
+    decompressor = get_parallel_decompressor(detect_compression(tarball))
+    if decompressor is not None:
+        args.extend(
+            ['--use-compress-program=%s' % decompressor, '-xf', tarball])
+    else:
+        args.extend(default_extract_args + [tarball])
+    if extra_args is not None:
+        args.extend(extra_args)
+    proc = cmd_runner.run(args, as_root=as_root)
     proc.wait()
     return proc.returncode
+
+
+def unpack_android_binary_tarball(tarball, unpack_dir, as_root=True):
+    return _unpack(tarball, unpack_dir, as_root, ['-jxf'])
+
+
+def unpack_binary_tarball(tarball, unpack_dir, as_root=True, rootfs_dir='',
+                          path_filter=None, path_filter_root=None):
+    """Unpack the given binary tarball into unpack_dir.
+
+    If a multi-threaded decompressor is available for the tarball's
+    compression, tar is fed through it; otherwise tar decompresses it itself.
+
+    :param rootfs_dir: The directory inside the tarball which holds the
+        rootfs (e.g. 'binary'), named as in the tarball (e.g. './binary').
+        If given, only that directory is extracted and its leading
+        components are stripped, so that the rootfs ends up directly under
+        unpack_dir.
+    :param path_filter: A PathFilter for the files of the rootfs, which are
+        then left out as the tarball is extracted; or None.
+    :param path_filter_root: The directory inside the tarball which holds
+        the rootfs, for path_filter; defaults to rootfs_dir.
+    """
+    extra_args = []
+    if rootfs_dir:
+        depth = len(rootfs_dir.strip('/').split('/'))
+        extra_args.extend(['--strip-components=%d' % depth, rootfs_dir])
+    if path_filter is not None:
+        if path_filter_root is None:
+            path_filter_root = rootfs_dir
+        return _unpack_filtered(
+            tarball, unpack_dir, as_root, extra_args, path_filter,
+            path_filter_root)
+    return _unpack(tarball, unpack_dir, as_root, ['-xf'], extra_args)
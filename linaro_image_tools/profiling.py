@@ -0,0 +1,242 @@
+# Copyright (C) 2012 Linaro
+#
+# This file is part of Linaro Image Tools.
+#
+# Linaro Image Tools is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Linaro Image Tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Linaro Image Tools.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Timing and resource usage of the stages of a run.
+
+Code wraps its major stages in stage(), which does nothing unless profiling
+was enabled with enable(); write_report() then writes what was recorded,
+either as JSON or in the Chrome trace event format (for chrome://tracing).
+
+For each stage the wall time, CPU time, bytes read and written from storage
+and peak RSS are recorded.  All but the wall time are measured for the whole
+process, including the subprocesses it waited for, so stages running at the
+same time are each charged for what the others used.  The peak RSS is the
+largest of the process and any of its subprocesses so far, as the kernel
+doesn't track it for a period of time.
+"""
+
+import atexit
+from contextlib import contextmanager
+import json
+import os
+import resource
+import sys
+import threading
+import time
+
+from linaro_image_tools import cmd_runner
+from linaro_image_tools.__version__ import __version__
+
+REPORT_FORMATS = ['json', 'chrome']
+
+_profiler = None
+
+
+def _read_io_counters():
+    """Return the bytes read and written from storage by this process.
+
+    These include the subprocesses which were waited for, and are 0 if the
+    kernel doesn't do I/O accounting.
+    """
+    counters = {}
+    try:
+        with open('/proc/self/io') as fd:
+            for line in fd:
+                name, _, value = line.partition(':')
+                counters[name] = int(value)
+    except (IOError, ValueError):
+        pass
+    return counters.get('read_bytes', 0), counters.get('write_bytes', 0)
+
+
+def _sample():
+    """Return the current resource usage of this process."""
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    read_bytes, write_bytes = _read_io_counters()
+    return {
+        'time': time.time(),
+        'cpu_time': (own.ru_utime + own.ru_stime + children.ru_utime +
+                     children.ru_stime),
+        'read_bytes': read_bytes,
+        'write_bytes': write_bytes,
+        # In kilobytes on Linux.
+        'peak_rss': max(own.ru_maxrss, children.ru_maxrss) * 1024,
+    }
+
+
+class Profiler(object):
+    """Records the resource usage of the stages of a run."""
+
+    def __init__(self):
+        self.started = time.time()
+        self.records = []
+        # How the run was set up, e.g. the mkfs options used.
+        self.metadata = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        before = _sample()
+        try:
+            yield
+        finally:
+            after = _sample()
+            record = {
+                'name': name,
+                'thread': threading.current_thread().name,
+                'start': before['time'] - self.started,
+                'wall_time': after['time'] - before['time'],
+                'cpu_time': after['cpu_time'] - before['cpu_time'],
+                'read_bytes': after['read_bytes'] - before['read_bytes'],
+                'write_bytes': after['write_bytes'] - before['write_bytes'],
+                'peak_rss': after['peak_rss'],
+            }
+            with self._lock:
+                self.records.append(record)
+
+    def to_json(self):
+        return {
+            'version': __version__,
+            'command': sys.argv,
+            'wall_time': time.time() - self.started,
+            'metadata': self.metadata,
+            'stages': sorted(self.records, key=lambda r: r['start']),
+        }
+
+    def to_chrome_trace(self):
+        pid = os.getpid()
+        threads = {}
+        events = []
+        for record in sorted(self.records, key=lambda r: r['start']):
+            tid = threads.setdefault(record['thread'], len(threads) + 1)
+            args = dict(
+                (key, value) for key, value in record.items()
+                if key not in ('name', 'thread', 'start'))
+            events.append({
+                'name': record['name'],
+                'ph': 'X',
+                'pid': pid,
+                'tid': tid,
+                # In microseconds.
+                'ts': int(record['start'] * 1000000),
+                'dur': int(record['wall_time'] * 1000000),
+                'args': args,
+            })
+        for thread, tid in threads.items():
+            events.append({
+                'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid,
+                'args': {'name': thread}})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms',
+                'otherData': self.metadata}
+
+    def write_report(self, path, report_format='json'):
+        """Write what was recorded to the file at path.
+
+        :param report_format: One of REPORT_FORMATS.
+        """
+        if report_format == 'json':
+            report = self.to_json()
+        elif report_format == 'chrome':
+            report = self.to_chrome_trace()
+        else:
+            raise ValueError("Unknown report format: %s" % report_format)
+        with open(path, 'w') as fd:
+            json.dump(report, fd, indent=2, sort_keys=True)
+            fd.write('\n')
+
+
+def enable():
+    """Start recording the stages run from now on.
+
+    :return: The Profiler doing the recording.
+    """
+    global _profiler
+    _profiler = Profiler()
+    return _profiler
+
+
+def disable():
+    global _profiler
+    _profiler = None
+
+
+def is_enabled():
+    return _profiler is not None
+
+
+@contextmanager
+def stage(name):
+    """Record the resource usage of the code run within this context.
+
+    Does nothing unless profiling was enabled.
+    """
+    profiler = _profiler
+    if profiler is None:
+        yield
+    else:
+        with profiler.stage(name):
+            yield
+
+
+def set_metadata(name, value):
+    """Record how the run was set up, in the report.
+
+    Does nothing unless profiling was enabled.
+    """
+    profiler = _profiler
+    if profiler is not None:
+        profiler.metadata[name] = value
+
+
+def write_report(path, report_format='json'):
+    """Write what was recorded since enable() to the file at path."""
+    _profiler.write_report(path, report_format)
+
+
+def add_profiling_options(parser):
+    """Add the --profile options to the given ArgumentParser."""
+    parser.add_argument(
+        '--profile', dest='profile', metavar='FILE',
+        help=('Write the wall time, CPU time, bytes read and written and '
+              'peak RSS of each stage of the run to FILE.'))
+    parser.add_argument(
+        '--profile-format', dest='profile_format', default='json',
+        choices=REPORT_FORMATS,
+        help=('The format of the --profile report: plain JSON, or the Chrome '
+              'trace event format, to be loaded in chrome://tracing. '
+              'Default: json'))
+    parser.add_argument(
+        '--trace-commands', dest='trace_commands', metavar='FILE',
+        help=('Record every command run, with its start and end time, exit '
+              'code and output size, to FILE, and print the slowest ones and '
+              'the time spent in each program at exit.'))
+
+
+def setup_profiling(args):
+    """Enable profiling and tracing as asked to by the command line options.
+
+    The reports are written when the program exits, whether or not it
+    succeeds.
+    """
+    if args.trace_commands is not None:
+        cmd_runner.enable_tracing(args.trace_commands)
+    if args.profile is None:
+        return
+    profiler = enable()
+    atexit.register(
+        profiler.write_report, args.profile, args.profile_format)
@@ -0,0 +1,350 @@
+# Copyright (C) 2012 Linaro
+#
+# This file is part of Linaro Image Tools.
+#
+# Linaro Image Tools is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Linaro Image Tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Linaro Image Tools.  If not, see <http://www.gnu.org/licenses/>.
+
+"""File operations as root, without a sudo for each of them.
+
+The functions here (copy(), move(), make_dirs(), ...) run the equivalent
+coreutils command through cmd_runner as root, one sudo per call.  Once
+start() was called they are instead sent to a helper process, started as
+root with a single sudo, which carries them out in-process.  Operations
+made within a batch() are sent to the helper together.
+
+The helper reads requests from its stdin, one per line, each being a JSON
+list of operations; it replies to each with a line holding a JSON object
+whose "error" is null, or describes the first operation that failed, in
+which case the remaining operations of the request are not carried out.
+
+  python -m linaro_image_tools.root_helper
+"""
+
+from contextlib import contextmanager
+import atexit
+import base64
+import errno
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+
+from linaro_image_tools import cmd_runner
+
+# The size of the reads and writes of write_blocks().
+WRITE_BLOCKS_BUFFER_SIZE = 1024 * 1024
+
+_helper = None
+_lock = threading.Lock()
+_batches = threading.local()
+
+
+class RootHelperError(Exception):
+    """A file operation carried out by the root helper failed."""
+
+
+def _copy(source, dest, verbose=False):
+    # Like cp, without options.
+    if os.path.isdir(dest):
+        dest = os.path.join(dest, os.path.basename(source))
+    existed = os.path.exists(dest)
+    shutil.copyfile(source, dest)
+    if not existed:
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(dest, os.stat(source).st_mode & 0777 & ~umask)
+    if verbose:
+        sys.stderr.write("'%s' -> '%s'\n" % (source, dest))
+
+
+def _move(source, dest):
+    # Like mv -f.
+    shutil.move(source, dest)
+
+
+def _make_dirs(path):
+    # Like mkdir -p.
+    try:
+        os.makedirs(path)
+    except OSError, e:
+        if e.errno != errno.EEXIST or not os.path.isdir(path):
+            raise
+
+
+def _remove(path):
+    # Like rm -f.
+    try:
+        os.unlink(path)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def _write_file(path, data):
+    # The data is written to a new file which is then renamed over path, so
+    # that path is never seen half written.
+    tmp_path = path + '.tmp-root-helper'
+    with open(tmp_path, 'wb') as fd:
+        fd.write(base64.b64decode(data))
+    os.rename(tmp_path, path)
+
+
+def _write_blocks(output_file, writes):
+    # Like a dd conv=notrunc for each write, but opening and syncing
+    # output_file only once.
+    fd = os.open(output_file, os.O_WRONLY | os.O_CREAT, 0644)
+    try:
+        for input_file, offset, length, skip in writes:
+            with open(input_file, 'rb') as source:
+                if skip:
+                    source.seek(skip)
+                os.lseek(fd, offset, os.SEEK_SET)
+                remaining = length
+                while remaining is None or remaining > 0:
+                    size = WRITE_BLOCKS_BUFFER_SIZE
+                    if remaining is not None:
+                        size = min(size, remaining)
+                    data = source.read(size)
+                    if not data:
+                        break
+                    written = 0
+                    while written < len(data):
+                        written += os.write(fd, data[written:])
+                    if remaining is not None:
+                        remaining -= len(data)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _chmod(mode, path):
+    os.chmod(path, int(mode, 8))
+
+
+def _chown(owner, path):
+    import grp
+    import pwd
+    user, _, group = owner.partition(':')
+    uid = gid = -1
+    if user:
+        uid = pwd.getpwnam(user).pw_uid
+    if group:
+        gid = grp.getgrnam(group).gr_gid
+    os.chown(path, uid, gid)
+
+
+OPERATIONS = {
+    'copy': _copy,
+    'move': _move,
+    'make_dirs': _make_dirs,
+    'remove': _remove,
+    'write_file': _write_file,
+    'write_blocks': _write_blocks,
+    'chmod': _chmod,
+    'chown': _chown,
+}
+
+
+def run_operations(operations):
+    """Carry out the given operations, stopping at the first failure.
+
+    :param operations: A list of [name, arg, ...] lists.
+    :return: A dict whose "error" is None if all the operations succeeded,
+        or describes the one that failed.
+    """
+    for operation in operations:
+        name, args = operation[0], operation[1:]
+        try:
+            OPERATIONS[name](*args)
+        except (EnvironmentError, KeyError, TypeError, ValueError), e:
+            return {'error': '%s %s: %s' % (
+                name, ' '.join(str(arg) for arg in args), e)}
+    return {'error': None}
+
+
+def _serve(requests, replies):
+    for line in iter(requests.readline, ''):
+        replies.write(json.dumps(run_operations(json.loads(line))) + '\n')
+        replies.flush()
+
+
+class _Helper(object):
+    """The client side of a root helper process."""
+
+    def __init__(self):
+        self.proc = cmd_runner.run_module(
+            'linaro_image_tools.root_helper', as_root=True,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def run(self, operations):
+        with _lock:
+            self.proc.stdin.write(json.dumps(operations) + '\n')
+            self.proc.stdin.flush()
+            reply = self.proc.stdout.readline()
+        if not reply:
+            raise RootHelperError("The root helper exited unexpectedly")
+        error = json.loads(reply)['error']
+        if error is not None:
+            raise RootHelperError(error)
+
+    def stop(self):
+        self.proc.stdin.close()
+        self.proc.wait()
+
+
+class _InProcessHelper(object):
+    """Carries out the operations directly, when already running as root."""
+
+    def run(self, operations):
+        error = run_operations(operations)['error']
+        if error is not None:
+            raise RootHelperError(error)
+
+    def stop(self):
+        pass
+
+
+def start():
+    """Have the file operations carried out by a root helper from now on.
+
+    The helper is stopped when the program exits.
+    """
+    global _helper
+    if _helper is not None:
+        return
+    if os.getuid() == 0:
+        _helper = _InProcessHelper()
+    else:
+        _helper = _Helper()
+    atexit.register(stop)
+
+
+def stop():
+    """Stop the root helper; the file operations use sudo again."""
+    global _helper
+    helper, _helper = _helper, None
+    if helper is not None:
+        helper.stop()
+
+
+def is_running():
+    return _helper is not None
+
+
+@contextmanager
+def batch():
+    """Send the operations made within this context to the helper at once.
+
+    They're sent when the context exits, so any failure is only reported
+    then.  Without a running helper this does nothing.
+    """
+    if getattr(_batches, 'operations', None) is not None:
+        # Already batching.
+        yield
+        return
+    _batches.operations = []
+    try:
+        yield
+        operations = _batches.operations
+    finally:
+        _batches.operations = None
+    if operations and _helper is not None:
+        _helper.run(operations)
+
+
+def _run(operation, fallback_args):
+    if _helper is None and fallback_args is None:
+        # There's no command doing the same; only possible as root.
+        _InProcessHelper().run([operation])
+    elif _helper is None:
+        cmd_runner.run(fallback_args, as_root=True).wait()
+    elif getattr(_batches, 'operations', None) is not None:
+        _batches.operations.append(operation)
+    else:
+        _helper.run([operation])
+
+
+def copy(source, dest, verbose=False):
+    """Copy the file source to dest (a file or directory), as root."""
+    args = ['cp', source, dest]
+    if verbose:
+        args.insert(1, '-v')
+    _run(['copy', source, dest, verbose], args)
+
+
+def move(source, dest):
+    """Move source to dest, as root."""
+    _run(['move', source, dest], ['mv', '-f', source, dest])
+
+
+def make_dirs(path):
+    """Create the directory path and its parents, as root."""
+    _run(['make_dirs', path], ['mkdir', '-p', path])
+
+
+def remove(path):
+    """Remove the file path, if it exists, as root."""
+    _run(['remove', path], ['rm', '-f', path])
+
+
+def write_file(path, data):
+    """Replace the contents of the file path with data, as root.
+
+    Without a running helper, data is written to a temporary file which is
+    then moved over path.
+    """
+    if _helper is not None:
+        _run(['write_file', path, base64.b64encode(data)], None)
+        return
+    _, tmpfile = tempfile.mkstemp()
+    with open(tmpfile, 'w') as fd:
+        fd.write(data)
+    move(tmpfile, path)
+
+
+def can_write_blocks():
+    """Whether write_blocks() can be used, i.e. without a sudo."""
+    return _helper is not None or os.getuid() == 0
+
+
+def write_blocks(output_file, writes):
+    """Write the given files into output_file, as root.
+
+    output_file (a device or image file) is opened and synced only once,
+    and the files are copied with large reads and writes.  Only usable if
+    can_write_blocks().
+
+    :param writes: A list of (input_file, offset, length, skip) tuples:
+        the first length bytes (or all, if None) of input_file after its
+        first skip bytes are written at byte offset of output_file.
+    """
+    _run(['write_blocks', output_file, [list(write) for write in writes]],
+         None)
+
+
+def chmod(mode, path):
+    """Change the mode of path, given as an octal string, as root."""
+    _run(['chmod', mode, path], ['chmod', mode, path])
+
+
+def chown(owner, path):
+    """Change the owner of path, given as user[:group], as root."""
+    _run(['chown', owner, path], ['chown', owner, path])
+
+
+if __name__ == '__main__':
+    _serve(sys.stdin, sys.stdout)
@@ -0,0 +1,194 @@
+# Copyright (C) 2012 Linaro
+#
+# This file is part of Linaro Image Tools.
+#
+# Linaro Image Tools is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Linaro Image Tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Linaro Image Tools.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A small scheduler for running a graph of dependent stages.
+
+Each stage is a callable plus the names of the stages it depends on.  A
+stage is started as soon as all its dependencies have finished, so stages
+which don't depend on each other run concurrently, each on its own thread.
+"""
+
+import logging
+import sys
+import threading
+import time
+
+from linaro_image_tools.utils import DEFAULT_LOGGER_NAME
+
+logger = logging.getLogger(DEFAULT_LOGGER_NAME)
+
+# How long (in seconds) the main thread waits for a stage to finish before
+# checking again; waiting without a timeout would make it deaf to ^C.
+POLL_INTERVAL = 0.5
+
+
+class StageGraphError(Exception):
+    """The stages given to the scheduler don't form a valid graph."""
+
+
+class Stage(object):
+    """A named step of a pipeline.
+
+    :param name: The name of this stage, used by others to depend on it.
+    :param function: The callable to run.  It is given a dictionary mapping
+        the names of the stages that have already finished to their return
+        values.
+    :param depends: The names of the stages that must finish before this one
+        is started.
+    :param resource: An optional name of a resource this stage uses; the
+        number of stages using a given resource at the same time can be
+        limited when running the stages.
+    """
+
+    def __init__(self, name, function, depends=(), resource=None):
+        self.name = name
+        self.function = function
+        self.depends = tuple(depends)
+        self.resource = resource
+
+    def __repr__(self):
+        return '<Stage %s>' % self.name
+
+
+def _check_graph(stages):
+    names = set()
+    for stage in stages:
+        if stage.name in names:
+            raise StageGraphError("Duplicate stage: %s" % stage.name)
+        names.add(stage.name)
+    for stage in stages:
+        for dependency in stage.depends:
+            if dependency not in names:
+                raise StageGraphError(
+                    "Stage %s depends on unknown stage %s" % (
+                        stage.name, dependency))
+    # Make sure there are no cycles by doing a topological sort.
+    done = set()
+    pending = list(stages)
+    while pending:
+        ready = [stage for stage in pending
+                 if set(stage.depends).issubset(done)]
+        if not ready:
+            raise StageGraphError(
+                "Dependency cycle between stages: %s" % ', '.join(
+                    stage.name for stage in pending))
+        for stage in ready:
+            done.add(stage.name)
+            pending.remove(stage)
+
+
+def run_stages(stages, max_workers=1, resource_limits=None):
+    """Run the given stages, honouring their dependencies.
+
+    Stages are started in the order they're given whenever their
+    dependencies are satisfied, so with max_workers=1 they run one after the
+    other in exactly that order.
+
+    If a stage raises an exception no further stages are started; once the
+    ones already running have finished, the first exception raised is
+    re-raised here.
+
+    :param stages: A list of Stage instances.
+    :param max_workers: The maximum number of stages to run at the same time.
+    :param resource_limits: A dictionary mapping resource names to the
+        maximum number of stages using that resource that may run at the
+        same time.
+    :return: A dictionary mapping the name of each stage to its return value.
+    """
+    if max_workers < 1:
+        raise ValueError("max_workers must be at least 1")
+    if resource_limits is None:
+        resource_limits = {}
+    _check_graph(stages)
+
+    condition = threading.Condition()
+    results = {}
+    pending = list(stages)
+    running = {}
+    failures = []
+
+    def run_stage(stage, finished):
+        start = time.time()
+        try:
+            result = stage.function(finished)
+        except:
+            exc_info = sys.exc_info()
+            with condition:
+                failures.append((stage, exc_info))
+                del running[stage.name]
+                condition.notify()
+        else:
+            logger.debug("Stage %s finished in %.1fs" % (
+                stage.name, time.time() - start))
+            with condition:
+                results[stage.name] = result
+                del running[stage.name]
+                condition.notify()
+
+    def can_start(stage):
+        if not set(stage.depends).issubset(results):
+            return False
+        limit = resource_limits.get(stage.resource)
+        if stage.resource is not None and limit is not None:
+            in_use = len([other for other in running.values()
+                          if other.resource == stage.resource])
+            if in_use >= limit:
+                return False
+        return True
+
+    with condition:
+        while pending or running:
+            if not failures:
+                for stage in list(pending):
+                    if len(running) >= max_workers:
+                        break
+                    if not can_start(stage):
+                        continue
+                    pending.remove(stage)
+                    running[stage.name] = stage
+                    logger.debug("Starting stage %s" % stage.name)
+                    thread = threading.Thread(
+                        target=run_stage, name=stage.name,
+                        args=(stage, dict(results)))
+                    thread.daemon = True
+                    thread.start()
+            elif not running:
+                break
+            condition.wait(POLL_INTERVAL)
+
+    if failures:
+        stage, exc_info = failures[0]
+        logger.error("Stage %s failed" % stage.name)
+        raise exc_info[0], exc_info[1], exc_info[2]
+    return results
+
+
+def parse_resource_limits(limits):
+    """Parse a list of RESOURCE=N strings into a dictionary.
+
+    :raises ValueError: If any of the strings is not of that form.
+    """
+    parsed = {}
+    for limit in limits:
+        name, sep, value = limit.partition('=')
+        if not sep or not name:
+            raise ValueError("Invalid stage limit: %s" % limit)
+        value = int(value)
+        if value < 1:
+            raise ValueError("Invalid stage limit: %s" % limit)
+        parsed[name] = value
+    return parsed
@@ -28,6 +28,10 @@ from linaro_image_tools.utils import has_command
 def test_suite():
     module_names = [
         'linaro_image_tools.tests.test_cmd_runner',
+        'linaro_image_tools.tests.test_imports',
+        'linaro_image_tools.tests.test_profiling',
+        'linaro_image_tools.tests.test_root_helper',
+        'linaro_image_tools.tests.test_stages',
         'linaro_image_tools.tests.test_utils',
     ]
     # if pyflakes is installed and we're running from a bzr checkout...
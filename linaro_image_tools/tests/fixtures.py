@@ -124,6 +124,9 @@ class MockCmdRunnerPopen(object):
         self.child_finished = True
         return self.returncode
 
+    def poll(self):
+        return self.wait()
+
     @property
     def commands_executed(self):
         return [' '.join(args) for args in self.calls]
@@ -17,11 +17,15 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from StringIO import StringIO
+import json
 import os
+import subprocess
 
 from linaro_image_tools import cmd_runner
 from linaro_image_tools.testing import TestCaseWithFixtures
 from linaro_image_tools.tests.fixtures import (
+    CreateTempDirFixture,
     MockCmdRunnerPopenFixture,
     MockSomethingFixture,
 )
@@ -111,3 +115,121 @@ class TestCmdRunner(TestCaseWithFixtures):
         proc = cmd_runner.Popen('true')
         returncode = proc.wait()
         self.assertEqual(0, returncode)
+
+
+class TestGather(TestCaseWithFixtures):
+
+    def test_runs_commands_in_order(self):
+        fixture = self.useFixture(MockCmdRunnerPopenFixture())
+        self.useFixture(MockSomethingFixture(os, 'getuid', lambda: 1000))
+        returncodes = cmd_runner.gather(
+            [['foo', 'a'], ['foo', 'b']], as_root=True)
+        self.assertEqual([0, 0], returncodes)
+        self.assertEqual(
+            ['%s foo a' % sudo_args, '%s foo b' % sudo_args],
+            fixture.mock.commands_executed)
+
+    def test_runs_all_then_raises_first_failure(self):
+        tempdir = self.useFixture(CreateTempDirFixture()).get_temp_dir()
+        touched = os.path.join(tempdir, 'touched')
+        commands = [['true'], ['sh', '-c', 'exit 3'], ['false'],
+                    ['touch', touched]]
+        e = self.assertRaises(
+            cmd_runner.SubcommandNonZeroReturnValue,
+            cmd_runner.gather, commands, max_concurrency=2)
+        self.assertEqual(['sh', '-c', 'exit 3'], e.command)
+        self.assertEqual(3, e.retval)
+        self.assertTrue(os.path.exists(touched))
+
+    def test_max_concurrency(self):
+        running = []
+        most_running = []
+
+        class FakePopen(object):
+            def __init__(self, args, **kwargs):
+                self._my_args = args
+                self.polls = 0
+                running.append(self)
+                most_running.append(len(running))
+
+            def poll(self):
+                # Each command finishes the second time it's polled.
+                self.polls += 1
+                if self.polls < 2:
+                    return None
+                return 0
+
+            def wait(self):
+                running.remove(self)
+                return 0
+
+        self.useFixture(MockSomethingFixture(cmd_runner, 'Popen', FakePopen))
+        self.useFixture(MockSomethingFixture(
+            cmd_runner, 'GATHER_POLL_INTERVAL', 0))
+        returncodes = cmd_runner.gather(
+            [['true']] * 5, max_concurrency=2)
+        self.assertEqual([0] * 5, returncodes)
+        self.assertEqual(2, max(most_running))
+        self.assertEqual([], running)
+
+
+class TestCommandTracer(TestCaseWithFixtures):
+
+    def setUp(self):
+        super(TestCommandTracer, self).setUp()
+        self.tracer = cmd_runner.CommandTracer()
+        self.useFixture(MockSomethingFixture(
+            cmd_runner, '_tracer', self.tracer))
+
+    def test_records_commands(self):
+        cmd_runner.run(['true']).wait()
+        [record] = self.tracer.records
+        self.assertEqual(['true'], record['argv'])
+        self.assertEqual('true', record['binary'])
+        self.assertEqual(0, record['returncode'])
+        self.assertTrue(record['end'] >= record['start'])
+        self.assertEqual(None, record['output_size'])
+
+    def test_records_failures(self):
+        self.assertRaises(
+            cmd_runner.SubcommandNonZeroReturnValue,
+            cmd_runner.run(['false']).wait)
+        self.assertEqual(1, self.tracer.records[0]['returncode'])
+
+    def test_records_output_size(self):
+        proc = cmd_runner.run(['echo', 'hello'], stdout=subprocess.PIPE)
+        proc.communicate()
+        self.assertEqual(6, self.tracer.records[0]['output_size'])
+
+    def test_unwraps_sudo_and_chroot(self):
+        record = self.tracer.start(
+            cmd_runner.SUDO_ARGS + cmd_runner.CHROOT_ARGS +
+            ['/tmp/rootfs', '/usr/bin/apt-get', 'update'])
+        self.assertEqual('apt-get', record['binary'])
+        self.assertTrue(record['sudo'])
+        self.assertEqual('/tmp/rootfs', record['chroot'])
+
+    def test_summary(self):
+        for argv, duration in [(['sync'], 2), (['cp', 'a', 'b'], 1),
+                               (['sync'], 3)]:
+            record = self.tracer.start(argv)
+            self.tracer.finish(record, 0)
+            record['end'] = record['start'] + duration
+        self.tracer.start(['sleep', '10'])
+        summary = self.tracer.summary().splitlines()
+        self.assertEqual('4 commands run, 1 not waited for', summary[0])
+        self.assertEqual('Slowest commands:', summary[1])
+        self.assertEqual('      3.00s  sync', summary[2])
+        self.assertEqual('Totals per command:', summary[5])
+        self.assertEqual('      5.00s      2  sync', summary[6])
+        self.assertEqual('      1.00s      1  cp', summary[7])
+
+    def test_write_trace(self):
+        trace_file = self.createTempFileAsFixture()
+        self.tracer.trace_file = trace_file
+        cmd_runner.run(['true']).wait()
+        self.tracer.report(StringIO())
+        [line] = open(trace_file).readlines()
+        record = json.loads(line)
+        self.assertEqual(['true'], record['argv'])
+        self.assertTrue(record['duration'] >= 0)
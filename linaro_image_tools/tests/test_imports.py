@@ -0,0 +1,77 @@
+# Copyright (C) 2012 Linaro
+#
+# This file is part of Linaro Image Tools.
+#
+# Linaro Image Tools is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Linaro Image Tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import subprocess
+import sys
+
+from testtools import TestCase
+
+# The modules which are slow to import, and so must only be imported when
+# they're used rather than when the scripts start.
+HEAVY_MODULES = ['apt', 'apt_pkg', 'dbus', 'debian', 'parted', 'yaml']
+# How long, in seconds, loading a script may take at most.
+IMPORT_TIME_BUDGET = 1.0
+SCRIPTS = [
+    'linaro-android-media-create',
+    'linaro-media-create',
+    'linaro-media-flash',
+]
+TOP_DIR = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+
+LOAD_SCRIPT = """
+import imp, json, sys, time
+start = time.time()
+imp.load_source('script_under_test', sys.argv[1])
+print json.dumps({
+    'seconds': time.time() - start,
+    'modules': [name for name, module in sys.modules.items()
+                if module is not None],
+    })
+"""
+
+
+class TestScriptImports(TestCase):
+
+    def _load_script(self, script):
+        # In a new process, so that nothing was imported already.
+        path = os.path.join(TOP_DIR, script)
+        if not os.path.exists(path):
+            self.skip("%s is not in %s" % (script, TOP_DIR))
+        proc = subprocess.Popen(
+            [sys.executable, '-c', LOAD_SCRIPT, path], cwd=TOP_DIR,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = proc.communicate()
+        self.assertEqual(0, proc.returncode, stderr)
+        return json.loads(stdout)
+
+    def test_heavy_modules_are_not_imported(self):
+        for script in SCRIPTS:
+            modules = self._load_script(script)['modules']
+            imported = sorted(
+                name for name in modules
+                if name.split('.')[0] in HEAVY_MODULES)
+            self.assertEqual([], imported, "Imported by %s" % script)
+
+    def test_import_time_budget(self):
+        for script in SCRIPTS:
+            seconds = self._load_script(script)['seconds']
+            self.assertTrue(
+                seconds < IMPORT_TIME_BUDGET,
+                "Loading %s took %.2fs" % (script, seconds))
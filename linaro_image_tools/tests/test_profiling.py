@@ -0,0 +1,110 @@
+# Copyright (C) 2012 Linaro
+#
+# This file is part of Linaro Image Tools.
+#
+# Linaro Image Tools is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Linaro Image Tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Linaro Image Tools.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import json
+import os
+import tempfile
+
+from testtools import TestCase
+
+from linaro_image_tools import profiling
+
+
+class TestProfiling(TestCase):
+
+    def setUp(self):
+        super(TestProfiling, self).setUp()
+        self.addCleanup(profiling.disable)
+
+    def test_stage_does_nothing_when_disabled(self):
+        with profiling.stage('unpack'):
+            pass
+        self.assertFalse(profiling.is_enabled())
+
+    def test_stage_is_recorded(self):
+        profiler = profiling.enable()
+        with profiling.stage('unpack'):
+            pass
+        [record] = profiler.records
+        self.assertEqual('unpack', record['name'])
+        self.assertEqual(
+            ['cpu_time', 'name', 'peak_rss', 'read_bytes', 'start', 'thread',
+             'wall_time', 'write_bytes'],
+            sorted(record.keys()))
+        self.assertTrue(record['wall_time'] >= 0)
+        self.assertTrue(record['peak_rss'] > 0)
+
+    def test_stage_is_recorded_on_failure(self):
+        profiler = profiling.enable()
+
+        def fail():
+            with profiling.stage('unpack'):
+                raise RuntimeError('boom')
+
+        self.assertRaises(RuntimeError, fail)
+        self.assertEqual(['unpack'], [r['name'] for r in profiler.records])
+
+    def write_report(self, report_format):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        profiling.write_report(path, report_format)
+        return json.load(open(path))
+
+    def test_json_report(self):
+        profiling.enable()
+        with profiling.stage('partition'):
+            with profiling.stage('mkfs'):
+                pass
+        report = self.write_report('json')
+        self.assertEqual(
+            ['partition', 'mkfs'], [r['name'] for r in report['stages']])
+
+    def test_chrome_trace_report(self):
+        profiling.enable()
+        with profiling.stage('unpack'):
+            pass
+        events = self.write_report('chrome')['traceEvents']
+        self.assertEqual(['X', 'M'], [event['ph'] for event in events])
+        self.assertEqual('unpack', events[0]['name'])
+        self.assertIn('cpu_time', events[0]['args'])
+
+    def test_metadata_is_reported(self):
+        profiling.enable()
+        profiling.set_metadata('format_profile', {'name': 'fast-image'})
+        self.assertEqual(
+            {'format_profile': {'name': 'fast-image'}},
+            self.write_report('json')['metadata'])
+        self.assertEqual(
+            {'format_profile': {'name': 'fast-image'}},
+            self.write_report('chrome')['otherData'])
+
+    def test_set_metadata_does_nothing_when_disabled(self):
+        profiling.set_metadata('format_profile', {'name': 'fast-image'})
+        self.assertFalse(profiling.is_enabled())
+
+    def test_unknown_report_format(self):
+        profiling.enable()
+        self.assertRaises(
+            ValueError, profiling.write_report, 'report', 'yaml')
+
+    def test_setup_profiling_without_profile(self):
+        parser = argparse.ArgumentParser()
+        profiling.add_profiling_options(parser)
+        profiling.setup_profiling(parser.parse_args([]))
+        self.assertFalse(profiling.is_enabled())
@@ -0,0 +1,171 @@
+# Copyright (C) 2012 Linaro
+#
+# This file is part of Linaro Image Tools.
+#
+# Linaro Image Tools is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Linaro Image Tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Linaro Image Tools.  If not, see <http://www.gnu.org/licenses/>.
+
+from StringIO import StringIO
+import base64
+import json
+import os
+
+from linaro_image_tools import cmd_runner, root_helper
+from linaro_image_tools.testing import TestCaseWithFixtures
+from linaro_image_tools.tests.fixtures import (
+    CreateTempDirFixture,
+    MockCmdRunnerPopenFixture,
+    MockSomethingFixture,
+)
+
+
+sudo_args = " ".join(cmd_runner.SUDO_ARGS)
+
+
+class TestWithoutHelper(TestCaseWithFixtures):
+    """Without a running helper, the usual commands are run with sudo."""
+
+    def setUp(self):
+        super(TestWithoutHelper, self).setUp()
+        self.useFixture(MockSomethingFixture(os, 'getuid', lambda: 1000))
+        self.popen_fixture = self.useFixture(MockCmdRunnerPopenFixture())
+
+    def test_copy(self):
+        root_helper.copy('from', 'to')
+        root_helper.copy('from', 'to', verbose=True)
+        self.assertEqual(
+            ['%s cp from to' % sudo_args, '%s cp -v from to' % sudo_args],
+            self.popen_fixture.mock.commands_executed)
+
+    def test_move_make_dirs_remove(self):
+        root_helper.move('from', 'to')
+        root_helper.make_dirs('dir')
+        root_helper.remove('file')
+        self.assertEqual(
+            ['%s mv -f from to' % sudo_args, '%s mkdir -p dir' % sudo_args,
+             '%s rm -f file' % sudo_args],
+            self.popen_fixture.mock.commands_executed)
+
+    def test_write_file(self):
+        root_helper.write_file('path', 'data')
+        [command] = self.popen_fixture.mock.commands_executed
+        self.assertTrue(command.startswith('%s mv -f ' % sudo_args))
+        self.assertTrue(command.endswith(' path'))
+        os.remove(command.split()[-2])
+
+    def test_batch_does_nothing(self):
+        with root_helper.batch():
+            root_helper.make_dirs('dir')
+        self.assertEqual(
+            ['%s mkdir -p dir' % sudo_args],
+            self.popen_fixture.mock.commands_executed)
+
+
+class TestRunOperations(TestCaseWithFixtures):
+
+    def setUp(self):
+        super(TestRunOperations, self).setUp()
+        self.tempdir = self.useFixture(CreateTempDirFixture()).get_temp_dir()
+        self.source = os.path.join(self.tempdir, 'source')
+        with open(self.source, 'w') as fd:
+            fd.write('contents')
+
+    def path(self, *names):
+        return os.path.join(self.tempdir, *names)
+
+    def test_copy_into_directory(self):
+        os.mkdir(self.path('dir'))
+        result = root_helper.run_operations(
+            [['copy', self.source, self.path('dir')]])
+        self.assertEqual({'error': None}, result)
+        self.assertEqual('contents', open(self.path('dir', 'source')).read())
+
+    def test_move(self):
+        root_helper.run_operations([['move', self.source, self.path('moved')]])
+        self.assertFalse(os.path.exists(self.source))
+        self.assertEqual('contents', open(self.path('moved')).read())
+
+    def test_make_dirs_existing(self):
+        operations = [['make_dirs', self.path('a', 'b')]] * 2
+        self.assertEqual(
+            {'error': None}, root_helper.run_operations(operations))
+        self.assertTrue(os.path.isdir(self.path('a', 'b')))
+
+    def test_remove_missing(self):
+        self.assertEqual(
+            {'error': None},
+            root_helper.run_operations([['remove', self.path('missing')]]))
+
+    def test_write_file(self):
+        root_helper.run_operations(
+            [['write_file', self.source, base64.b64encode('new')]])
+        self.assertEqual('new', open(self.source).read())
+
+    def test_write_blocks(self):
+        output_file = self.path('output')
+        with open(output_file, 'w') as fd:
+            fd.write('x' * 20)
+        root_helper.run_operations([['write_blocks', output_file, [
+            [self.source, 2, None, 0], [self.source, 12, 3, 4]]]])
+        self.assertEqual(
+            'xxcontentsxxentxxxxx', open(output_file).read())
+
+    def test_chmod(self):
+        root_helper.run_operations([['chmod', '600', self.source]])
+        self.assertEqual(0600, os.stat(self.source).st_mode & 0777)
+
+    def test_stops_at_first_failure(self):
+        result = root_helper.run_operations(
+            [['move', self.path('missing'), self.path('to')],
+             ['remove', self.source]])
+        self.assertTrue(result['error'].startswith('move '))
+        self.assertTrue(os.path.exists(self.source))
+
+    def test_serve(self):
+        requests = StringIO(
+            json.dumps([['make_dirs', self.path('dir')]]) + '\n' +
+            json.dumps([['remove', self.path('dir')]]) + '\n')
+        replies = StringIO()
+        root_helper._serve(requests, replies)
+        [ok, failed] = [json.loads(line) for line in
+                        replies.getvalue().splitlines()]
+        self.assertEqual(None, ok['error'])
+        self.assertNotEqual(None, failed['error'])
+
+
+class TestWithHelper(TestCaseWithFixtures):
+
+    def setUp(self):
+        super(TestWithHelper, self).setUp()
+        self.popen_fixture = self.useFixture(MockCmdRunnerPopenFixture())
+        self.useFixture(MockSomethingFixture(
+            root_helper, '_helper', root_helper._InProcessHelper()))
+        self.tempdir = self.useFixture(CreateTempDirFixture()).get_temp_dir()
+
+    def test_no_commands_run(self):
+        path = os.path.join(self.tempdir, 'file')
+        root_helper.write_file(path, 'data')
+        self.assertEqual('data', open(path).read())
+        self.assertEqual(None, self.popen_fixture.mock.calls)
+
+    def test_batch(self):
+        path = os.path.join(self.tempdir, 'dir')
+        with root_helper.batch():
+            root_helper.make_dirs(path)
+            self.assertFalse(os.path.exists(path))
+        self.assertTrue(os.path.isdir(path))
+
+    def test_failure(self):
+        self.assertRaises(
+            root_helper.RootHelperError, root_helper.move,
+            os.path.join(self.tempdir, 'missing'), self.tempdir)
@@ -0,0 +1,122 @@
+# Copyright (C) 2012 Linaro
+#
+# This file is part of Linaro Image Tools.
+#
+# Linaro Image Tools is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Linaro Image Tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Linaro Image Tools.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+
+from testtools import TestCase
+
+from linaro_image_tools.stages import (
+    parse_resource_limits,
+    run_stages,
+    Stage,
+    StageGraphError,
+)
+
+
+class TestRunStages(TestCase):
+
+    def test_runs_in_order_with_one_worker(self):
+        calls = []
+        stages = [
+            Stage('a', lambda finished: calls.append('a')),
+            Stage('b', lambda finished: calls.append('b'), depends=['c']),
+            Stage('c', lambda finished: calls.append('c')),
+        ]
+        run_stages(stages, max_workers=1)
+        self.assertEqual(['a', 'c', 'b'], calls)
+
+    def test_returns_results(self):
+        stages = [
+            Stage('a', lambda finished: 1),
+            Stage('b', lambda finished: finished['a'] + 1, depends=['a']),
+        ]
+        self.assertEqual({'a': 1, 'b': 2}, run_stages(stages, max_workers=2))
+
+    def test_independent_stages_overlap(self):
+        # Each stage waits for the other to have started, so this would
+        # deadlock (and fail on the timeout) if they didn't run concurrently.
+        a_started = threading.Event()
+        b_started = threading.Event()
+
+        def a(finished):
+            a_started.set()
+            return b_started.wait(5)
+
+        def b(finished):
+            b_started.set()
+            return a_started.wait(5)
+
+        results = run_stages([Stage('a', a), Stage('b', b)], max_workers=2)
+        self.assertEqual({'a': True, 'b': True}, results)
+
+    def test_resource_limit(self):
+        lock = threading.Lock()
+        active = []
+        peak = []
+
+        def stage(finished):
+            with lock:
+                active.append(None)
+                peak.append(len(active))
+            with lock:
+                active.pop()
+
+        stages = [Stage(name, stage, resource='media') for name in 'abcd']
+        run_stages(stages, max_workers=4, resource_limits={'media': 1})
+        self.assertEqual([1, 1, 1, 1], peak)
+
+    def test_failure_is_reraised(self):
+        calls = []
+
+        def fail(finished):
+            raise RuntimeError('boom')
+
+        stages = [
+            Stage('a', fail),
+            Stage('b', lambda finished: calls.append('b'), depends=['a']),
+        ]
+        self.assertRaises(RuntimeError, run_stages, stages, max_workers=2)
+        self.assertEqual([], calls)
+
+    def test_unknown_dependency(self):
+        stages = [Stage('a', lambda finished: None, depends=['b'])]
+        self.assertRaises(StageGraphError, run_stages, stages)
+
+    def test_duplicate_stage(self):
+        stages = [Stage('a', lambda finished: None),
+                  Stage('a', lambda finished: None)]
+        self.assertRaises(StageGraphError, run_stages, stages)
+
+    def test_cycle(self):
+        stages = [Stage('a', lambda finished: None, depends=['b']),
+                  Stage('b', lambda finished: None, depends=['a'])]
+        self.assertRaises(StageGraphError, run_stages, stages)
+
+    def test_invalid_max_workers(self):
+        self.assertRaises(ValueError, run_stages, [], max_workers=0)
+
+
+class TestParseResourceLimits(TestCase):
+
+    def test_parse(self):
+        self.assertEqual(
+            {'media': 1, 'rootfs': 2},
+            parse_resource_limits(['media=1', 'rootfs=2']))
+
+    def test_invalid(self):
+        for limit in ['media', '=1', 'media=x', 'media=0']:
+            self.assertRaises(ValueError, parse_resource_limits, [limit])
@@ -36,6 +36,7 @@ from linaro_image_tools.tests.fixtures import (
 from linaro_image_tools.utils import (
     IncompatibleOptions,
     InvalidHwpackFile,
+    TarballIndex,
     UnableToFindPackageProvidingCommand,
     additional_android_option_checks,
     additional_option_checks,
@@ -74,6 +75,77 @@ class TestPathInTarfile(TestCaseWithFixtures):
                                                 self.tarfile_name))
 
 
+class TestTarballIndex(TestCaseWithFixtures):
+    def setUp(self):
+        super(TestTarballIndex, self).setUp()
+        self.tempdir = self.useFixture(CreateTempDirFixture()).get_temp_dir()
+        self.tarfile_name = os.path.join(self.tempdir, 'test_tarfile.tar.gz')
+        self.tempfile_added = self.createTempFileAsFixture()
+        with open(self.tempfile_added, 'w') as fd:
+            fd.write('some data')
+        self.tempfile_unused = self.createTempFileAsFixture()
+        with tarfile.open(self.tarfile_name, 'w:gz') as tar:
+            tar.add(self.tempfile_added)
+
+    def test_file_exists(self):
+        index = TarballIndex(self.tarfile_name)
+        self.assertIn(self.tempfile_added[1:], index)
+        self.assertIn('./' + self.tempfile_added[1:], index)
+
+    def test_file_does_not_exist(self):
+        index = TarballIndex(self.tarfile_name)
+        self.assertNotIn(self.tempfile_unused[1:], index)
+        self.assertEqual(None, index.get_member(self.tempfile_unused[1:]))
+
+    def test_get_member_size(self):
+        index = TarballIndex(self.tarfile_name)
+        _, size = index.get_member(self.tempfile_added[1:])
+        self.assertEqual(len('some data'), size)
+
+    def test_get_name(self):
+        index = TarballIndex(self.tarfile_name)
+        self.assertEqual(
+            self.tempfile_added[1:],
+            index.get_name('./' + self.tempfile_added[1:]))
+        self.assertEqual(None, index.get_name(self.tempfile_unused[1:]))
+
+    def test_get_name_dot_prefixed(self):
+        tarball = os.path.join(self.tempdir, 'dot.tar')
+        with tarfile.open(tarball, 'w') as tar:
+            info = tarfile.TarInfo('./binary/')
+            info.type = tarfile.DIRTYPE
+            tar.addfile(info)
+        index = TarballIndex(tarball)
+        self.assertIn('binary', index)
+        self.assertEqual('./binary', index.get_name('binary'))
+
+    def test_writes_sidecar(self):
+        TarballIndex(self.tarfile_name).load()
+        self.assertTrue(os.path.exists(self.tarfile_name + '.index'))
+
+    def test_reuses_sidecar(self):
+        TarballIndex(self.tarfile_name).load()
+
+        def fail_open(*args, **kwargs):
+            raise AssertionError("The tarball should not be opened again")
+        self.useFixture(MockSomethingFixture(tarfile, 'open', fail_open))
+        index = TarballIndex(self.tarfile_name)
+        self.assertIn(self.tempfile_added[1:], index)
+
+    def test_stale_sidecar_is_ignored(self):
+        sidecar = os.path.join(self.tempdir, 'sidecar')
+        with open(sidecar, 'w') as fd:
+            fd.write('{"key": {}, "members": {}}')
+        index = TarballIndex(self.tarfile_name, sidecar=sidecar)
+        self.assertIn(self.tempfile_added[1:], index)
+
+    def test_unwritable_sidecar(self):
+        sidecar = os.path.join(self.tempdir, 'missing-dir', 'sidecar')
+        index = TarballIndex(self.tarfile_name, sidecar=sidecar)
+        self.assertIn(self.tempfile_added[1:], index)
+        self.assertFalse(os.path.exists(sidecar))
+
+
 class TestVerifyFileIntegrity(TestCaseWithFixtures):
 
     filenames_in_shafile = ['verified-file1', 'verified-file2']
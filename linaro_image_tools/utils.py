@@ -17,6 +17,7 @@
 # You should have received a copy of the GNU General Public License
 # along with Linaro Image Tools.  If not, see <http://www.gnu.org/licenses/>.
 
+import json
 import os
 import platform
 import subprocess
@@ -34,6 +35,11 @@ DEFAULT_LOGGER_NAME = 'linaro_image_tools'
 BOOT_DIR_IN_TARBALL = "boot"
 # The name of the hwpack file found in the boot tarball.
 HWPACK_NAME = "config"
+# The suffix of the sidecar file where a TarballIndex is stored.
+TARBALL_INDEX_SUFFIX = '.index'
+# Bump this whenever what a TarballIndex stores in its sidecar changes, so
+# that the sidecars written before are ignored.
+TARBALL_INDEX_VERSION = 2
 
 
 # try_import was copied from python-testtools 0.9.12 and was originally
@@ -94,6 +100,114 @@ def path_in_tarfile_exists(path, tar_file):
         return exists
 
 
+class TarballIndex(object):
+    """An index of the members of a (possibly compressed) tarball.
+
+    The tarball is read only once, in a single streaming pass, recording the
+    name, data offset and size of each member.  The result is stored in a
+    sidecar file next to the tarball, keyed by the tarball's path, size and
+    mtime, so later runs against the same tarball don't have to decompress
+    it at all.  If the sidecar can't be written the index is just kept in
+    memory.
+    """
+
+    def __init__(self, tarball, sidecar=None):
+        self.tarball = tarball
+        if sidecar is None:
+            sidecar = tarball + TARBALL_INDEX_SUFFIX
+        self.sidecar = sidecar
+        self._members = None
+
+    @staticmethod
+    def _normalize(path):
+        if path.startswith('./'):
+            path = path[2:]
+        return path.rstrip('/')
+
+    def _get_key(self):
+        stat = os.stat(self.tarball)
+        return {'version': TARBALL_INDEX_VERSION,
+                'path': os.path.abspath(self.tarball),
+                'size': stat.st_size,
+                'mtime': stat.st_mtime}
+
+    def _read_sidecar(self, key):
+        try:
+            with open(self.sidecar) as fd:
+                data = json.load(fd)
+        except (IOError, ValueError):
+            return None
+        if not isinstance(data, dict) or data.get('key') != key:
+            return None
+        return data.get('members')
+
+    def _write_sidecar(self, key):
+        logger = logging.getLogger(DEFAULT_LOGGER_NAME)
+        tmp_sidecar = self.sidecar + '.tmp'
+        try:
+            with open(tmp_sidecar, 'w') as fd:
+                json.dump({'key': key, 'members': self._members}, fd)
+            os.rename(tmp_sidecar, self.sidecar)
+        except (IOError, OSError, ValueError) as e:
+            logger.debug("Could not write tarball index %s: %s" % (
+                self.sidecar, e))
+            if os.path.exists(tmp_sidecar):
+                os.remove(tmp_sidecar)
+
+    def _scan(self):
+        members = {}
+        tar = tarfile.open(self.tarball, 'r|*')
+        try:
+            for tarinfo in tar:
+                members[self._normalize(tarinfo.name)] = [
+                    tarinfo.offset_data, tarinfo.size,
+                    tarinfo.name.rstrip('/')]
+        finally:
+            tar.close()
+        return members
+
+    def load(self):
+        """Load the index from the sidecar, or build it if that's stale."""
+        key = self._get_key()
+        self._members = self._read_sidecar(key)
+        if self._members is None:
+            self._members = self._scan()
+            self._write_sidecar(key)
+        return self
+
+    @property
+    def members(self):
+        """A dict mapping member names to (data offset, size, name).
+
+        The keys are normalized, without any leading './', while the names
+        are as they're stored in the tarball.
+        """
+        if self._members is None:
+            self.load()
+        return self._members
+
+    def __contains__(self, path):
+        return self._normalize(path) in self.members
+
+    def get_member(self, path):
+        """Return the (data offset, size) of path, or None if not present."""
+        member = self.members.get(self._normalize(path))
+        if member is None:
+            return None
+        return tuple(member[:2])
+
+    def get_name(self, path):
+        """Return the name of path in the tarball, or None if not present.
+
+        That's the name tar has to be given to extract it, which may have a
+        leading './' the other methods don't care about.
+        """
+        member = self.members.get(self._normalize(path))
+        if member is None:
+            return None
+        return member[2]
+
+
 def verify_file_integrity(sig_file_list):
     """Verify a list of signature files.
 